@@ -0,0 +1,264 @@
+"""
+Preflight analysis of a downloaded pack.zip.
+
+Every sticker image is scanned in parallel, reading only the PNG/APNG chunk
+headers (IHDR, acTL, fcTL) and skipping the pixel data, to report its size,
+frame count and duration, a rough estimate of the WebM encoding work and
+whether the result will fit Telegram's video sticker limits:
+
+    python analyze.py sticker_dl/11537/pack.zip
+    python analyze.py sticker_dl/11537/pack.zip --json analysis.json
+    python downloader.py --analyze 11537
+
+The estimates are heuristics for planning, not measurements; benchmark.py
+gives real numbers for a machine.
+"""
+import argparse
+import json
+import math
+import re
+import sys
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from threading import local
+
+import apng
+from pipeline import extract_pack_info_from_metadata, raw_member_paths
+from utils import (
+    WEBM_DURATION_SEC_MAX,
+    WEBM_SIZE_KB_MAX,
+    StickerType,
+    sticker_type_properties,
+)
+
+ANALYZE_THREADS = 8
+# WebM output, see ImageProcessor.to_webm and the scale for webm in Pipeline.plan
+WEBM_FPS = 30
+WEBM_SIZE_PX = 512
+WEBM_EMOJI_SIZE_PX = 100
+# rough VP9 ("balanced" preset) throughput and output size per encoded pixel
+ENCODE_PIXELS_PER_SECOND = 4_000_000
+WEBM_BYTES_PER_PIXEL = 0.008
+
+COMPLIANT = "ok"
+TOO_LONG = "too_long"
+MAY_EXCEED_SIZE = "may_exceed_size"
+NOT_ANIMATED = "static"
+
+
+class StickerAnalysis:
+    def __init__(self, sticker_id, member, size):
+        self.sticker_id = sticker_id
+        self.member = member
+        # bytes of the PNG/APNG in the archive
+        self.size = size
+        self.width = 0
+        self.height = 0
+        self.frames = 1
+        self.plays = 0
+        # seconds of one play, 0 for a still image
+        self.duration = 0.0
+        self.est_encode_seconds = 0.0
+        self.est_webm_kb = 0.0
+        # COMPLIANT, TOO_LONG (sped up to fit), MAY_EXCEED_SIZE or NOT_ANIMATED
+        self.webm = NOT_ANIMATED
+        self.error = None
+
+    def estimate_webm(self, target_px):
+        # frames are rendered at a constant rate for at most the duration limit
+        if self.frames <= 1 or not self.width or not self.height:
+            return
+        scale = target_px / max(self.width, self.height)
+        pixels = round(self.width * scale) * round(self.height * scale)
+        frames = math.ceil(min(self.duration, WEBM_DURATION_SEC_MAX) * WEBM_FPS)
+        self.est_encode_seconds = frames * pixels / ENCODE_PIXELS_PER_SECOND
+        self.est_webm_kb = frames * pixels * WEBM_BYTES_PER_PIXEL / 1024
+        if self.duration > WEBM_DURATION_SEC_MAX:
+            self.webm = TOO_LONG
+        elif self.est_webm_kb > WEBM_SIZE_KB_MAX:
+            self.webm = MAY_EXCEED_SIZE
+        else:
+            self.webm = COMPLIANT
+
+    def to_dict(self):
+        return {
+            "sticker_id": self.sticker_id,
+            "member": self.member,
+            "size": self.size,
+            "width": self.width,
+            "height": self.height,
+            "frames": self.frames,
+            "plays": self.plays,
+            "duration": round(self.duration, 3),
+            "est_encode_seconds": round(self.est_encode_seconds, 3),
+            "est_webm_kb": round(self.est_webm_kb, 1),
+            "webm": self.webm,
+            "error": self.error,
+        }
+
+
+class PackAnalysis:
+    def __init__(self, pack_id, title, sticker_type):
+        self.pack_id = pack_id
+        self.title = title
+        self.sticker_type = sticker_type
+        self.stickers: list[StickerAnalysis] = []
+        self.elapsed = 0.0
+
+    def count(self, webm_status):
+        return sum(1 for s in self.stickers if s.webm == webm_status)
+
+    def to_dict(self):
+        return {
+            "pack_id": self.pack_id,
+            "title": self.title,
+            "sticker_type": self.sticker_type,
+            "elapsed": self.elapsed,
+            "summary": {
+                "stickers": len(self.stickers),
+                "frames": sum(s.frames for s in self.stickers),
+                "est_encode_seconds": round(
+                    sum(s.est_encode_seconds for s in self.stickers), 1
+                ),
+                "webm": {
+                    status: self.count(status)
+                    for status in (COMPLIANT, TOO_LONG, MAY_EXCEED_SIZE, NOT_ANIMATED)
+                },
+                "errors": sum(1 for s in self.stickers if s.error),
+            },
+            "stickers": [s.to_dict() for s in self.stickers],
+        }
+
+    def table_lines(self):
+        lines = [
+            f"{'sticker':>12} {'size':>9} {'w x h':>11} {'frames':>6}"
+            f" {'dur(s)':>7} {'enc(s)':>7} {'webm KB':>8}  webm"
+        ]
+        for s in self.stickers:
+            if s.error:
+                lines.append(f"{s.sticker_id:>12} error: {s.error}")
+                continue
+            lines.append(
+                f"{s.sticker_id:>12} {s.size:>9,} {f'{s.width}x{s.height}':>11}"
+                f" {s.frames:>6} {s.duration:>7.2f} {s.est_encode_seconds:>7.2f}"
+                f" {s.est_webm_kb:>8.0f}  {s.webm}"
+            )
+        summary = self.to_dict()["summary"]
+        lines.append(
+            f"{summary['stickers']} sticker(s), {summary['frames']} frame(s),"
+            f" ~{summary['est_encode_seconds']}s of WebM encoding;"
+            f" webm {COMPLIANT}: {summary['webm'][COMPLIANT]},"
+            f" {TOO_LONG}: {summary['webm'][TOO_LONG]},"
+            f" {MAY_EXCEED_SIZE}: {summary['webm'][MAY_EXCEED_SIZE]}"
+            f" (analyzed in {self.elapsed * 1000:.0f} ms)"
+        )
+        return lines
+
+
+def scan_png_headers(f, result: StickerAnalysis):
+    # IHDR/acTL/fcTL only, IDAT and fdAT data is skipped
+    delays = []
+    for chunk_type, data in apng.iter_chunks(f, skip_types=(b"IDAT", b"fdAT")):
+        if chunk_type == b"IHDR":
+            result.width, result.height = apng.parse_ihdr(data)[:2]
+        elif chunk_type == b"acTL":
+            result.frames, result.plays = apng.parse_actl(data)
+        elif chunk_type == b"fcTL":
+            if len(data) != 26:
+                raise apng.PNGFormatError("Bad fcTL chunk")
+            delays.append(apng.parse_fctl(data)["delay"])
+    if delays:
+        result.frames = len(delays)
+        # a plain sum of 30 frames of 0.1 s is just over a 3 s limit
+        result.duration = math.fsum(delays)
+
+
+def _sticker_members(names, is_emoji, sticker_type):
+    # the image each sticker is converted from, as in Pipeline.build_tasks
+    has_animation, _, has_popup, _, _ = sticker_type_properties(sticker_type)
+    sub_folder = "static"
+    if is_emoji:
+        sub_folder = "emoji"
+    elif has_popup:
+        sub_folder = "popup"
+    elif has_animation:
+        sub_folder = "animation"
+    members = []
+    for name, rel_path in raw_member_paths(names, is_emoji).items():
+        if match := re.fullmatch(rf"{sub_folder}/(\d+)\.png", rel_path):
+            members.append((match.group(1), name))
+    return sorted(members, key=lambda m: int(m[0]))
+
+
+def analyze_archive(path, threads=ANALYZE_THREADS, lang="en"):
+    """Return the PackAnalysis of a pack.zip."""
+    start = time.perf_counter()
+    with zipfile.ZipFile(path) as archive:
+        names = archive.namelist()
+        infos = {info.filename: info for info in archive.infolist()}
+        is_emoji = "meta.json" in names
+        metadata = json.loads(
+            archive.read("meta.json" if is_emoji else "productInfo.meta")
+        )
+    pack_id = str(metadata.get("packageId", ""))
+    pack_info = extract_pack_info_from_metadata(metadata, pack_id, lang, is_emoji)
+    sticker_type = StickerType(pack_info["sticker_type"])
+    analysis = PackAnalysis(pack_id, pack_info["title"], sticker_type.value)
+    target_px = WEBM_EMOJI_SIZE_PX if is_emoji else WEBM_SIZE_PX
+
+    # one ZipFile per worker thread, reads do not contend on a shared handle
+    archives = local()
+    opened = []
+
+    def analyze_member(sticker_id, member):
+        result = StickerAnalysis(sticker_id, member, infos[member].file_size)
+        if not hasattr(archives, "zip"):
+            archives.zip = zipfile.ZipFile(path)
+            opened.append(archives.zip)
+        try:
+            with archives.zip.open(member) as f:
+                scan_png_headers(f, result)
+            result.estimate_webm(target_px)
+        except (apng.PNGFormatError, zipfile.BadZipFile, OSError) as e:
+            result.error = str(e)
+        return result
+
+    members = _sticker_members(names, is_emoji, sticker_type)
+    try:
+        with ThreadPoolExecutor(threads, thread_name_prefix="Analyze") as pool:
+            analysis.stickers = list(pool.map(lambda m: analyze_member(*m), members))
+    finally:
+        for archive in opened:
+            archive.close()
+    analysis.elapsed = time.perf_counter() - start
+    return analysis
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description="Report frames, durations and WebM compliance of a pack.zip"
+    )
+    arg_parser.add_argument("archive", type=str, help="Path of a pack.zip")
+    arg_parser.add_argument(
+        "--json", type=str, metavar="JSON_FILE", help='Write JSON here, "-" for stdout'
+    )
+    arg_parser.add_argument("-t", "--threads", type=int, default=ANALYZE_THREADS)
+    arg_parser.add_argument("--lang", type=str, default="en", help="Title language")
+    args = arg_parser.parse_args()
+
+    analysis = analyze_archive(args.archive, args.threads, args.lang)
+    if args.json == "-":
+        json.dump(analysis.to_dict(), sys.stdout, indent=2, ensure_ascii=False)
+        print()
+        return
+    print(f"{analysis.title} ({analysis.pack_id}, {analysis.sticker_type})")
+    for line in analysis.table_lines():
+        print(line)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(analysis.to_dict(), f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+"""
+Minimal PNG/APNG chunk reader and writer built on the standard library.
+Only 8-bit RGBA is written, which is all the synthetic corpus needs.
+"""
+import hashlib
+import struct
+import zlib
+from fractions import Fraction
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# fcTL dispose_op
+DISPOSE_OP_NONE = 0
+DISPOSE_OP_BACKGROUND = 1
+DISPOSE_OP_PREVIOUS = 2
+# fcTL blend_op
+BLEND_OP_SOURCE = 0
+BLEND_OP_OVER = 1
+
+
+class PNGFormatError(ValueError):
+    pass
+
+
+def make_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    crc = zlib.crc32(chunk_type + data) & 0xFFFFFFFF
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", crc)
+
+
+def iter_chunks(f, skip_types=()):
+    """
+    Yield (chunk_type, data) from a binary file object positioned at the start of a PNG.
+    Data of chunks listed in skip_types is not kept (None is yielded instead),
+    which makes header-only scans cheap.
+    """
+    if f.read(8) != PNG_SIGNATURE:
+        raise PNGFormatError("Not a PNG file")
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            raise PNGFormatError("Truncated PNG")
+        length, chunk_type = struct.unpack(">I4s", header)
+        if chunk_type in skip_types:
+            _skip(f, length + 4)
+            data = None
+        else:
+            data = f.read(length)
+            f.read(4)  # crc
+        yield chunk_type, data
+        if chunk_type == b"IEND":
+            return
+
+
+def _skip(f, n):
+    try:
+        f.seek(n, 1)
+    except (OSError, ValueError):
+        # not seekable, e.g. a compressed zip member
+        while n > 0:
+            n -= len(f.read(min(n, 65536))) or n
+
+
+def parse_ihdr(data):
+    width, height, bit_depth, color_type, _, _, interlace = struct.unpack(
+        ">IIBBBBB", data
+    )
+    return width, height, bit_depth, color_type, interlace
+
+
+def png_bit_depth(path):
+    """Bits per sample of the PNG at path, from its IHDR."""
+    with open(path, "rb") as f:
+        chunk_type, data = next(iter_chunks(f))
+    if chunk_type != b"IHDR":
+        raise PNGFormatError("IHDR is not the first chunk")
+    return parse_ihdr(data)[2]
+
+
+def parse_actl(data):
+    num_frames, num_plays = struct.unpack(">II", data)
+    return num_frames, num_plays
+
+
+def parse_fctl(data):
+    (
+        seq,
+        width,
+        height,
+        x_offset,
+        y_offset,
+        delay_num,
+        delay_den,
+        dispose_op,
+        blend_op,
+    ) = struct.unpack(">IIIIIHHBB", data)
+    return {
+        "seq": seq,
+        "width": width,
+        "height": height,
+        "x_offset": x_offset,
+        "y_offset": y_offset,
+        "delay": fctl_delay_seconds(delay_num, delay_den),
+        "dispose_op": dispose_op,
+        "blend_op": blend_op,
+    }
+
+
+def fctl_delay_seconds(delay_num, delay_den):
+    # a zero denominator means 1/100 s per the APNG spec
+    return delay_num / (delay_den or 100)
+
+
+def animation_duration(path):
+    """Length of one play of an APNG in seconds, 0.0 for a still PNG."""
+    duration = 0.0
+    with open(path, "rb") as f:
+        for chunk_type, data in iter_chunks(f, skip_types=(b"IDAT", b"fdAT")):
+            if chunk_type == b"fcTL":
+                if len(data) != 26:
+                    raise PNGFormatError("Bad fcTL chunk")
+                duration += parse_fctl(data)["delay"]
+    return duration
+
+
+def image_digest(path):
+    """
+    Digest of the chunks that define the pixels of a (non-animated) PNG, so
+    that two files written by the same encoder compare equal when their
+    pixels do, whatever ancillary chunks (timestamps etc.) they carry.
+    """
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk_type, data in iter_chunks(f):
+            if chunk_type in (b"IHDR", b"PLTE", b"tRNS", b"IDAT"):
+                h.update(chunk_type)
+                h.update(data)
+    return h.hexdigest()
+
+
+def _delay_fraction(fctl):
+    delay_num, delay_den = struct.unpack(">HH", fctl[20:24])
+    return Fraction(delay_num, delay_den or 100)
+
+
+def _with_fctl_fields(fctl, seq, delay, dispose_op):
+    # fcTL with a new sequence number, delay and dispose_op
+    return (
+        struct.pack(">I", seq)
+        + fctl[4:20]
+        + struct.pack(">HHB", delay.numerator, delay.denominator, dispose_op)
+        + fctl[25:26]
+    )
+
+
+def collapse_duplicate_frames(in_path, out_path):
+    """
+    Merge every APNG frame that redraws exactly what the previous frame left
+    on the canvas into that frame, adding up their delays. Returns
+    (frames before, frames after); out_path is only written when frames
+    were merged. The rendered animation is unchanged.
+    """
+    head, frames, tail = [], [], []
+    with open(in_path, "rb") as f:
+        for chunk_type, data in iter_chunks(f):
+            if chunk_type == b"fcTL":
+                if len(data) != 26:
+                    raise PNGFormatError("Invalid fcTL chunk")
+                frames.append({"fctl": data, "type": None, "data": []})
+            elif chunk_type in (b"IDAT", b"fdAT") and frames:
+                frames[-1]["type"] = chunk_type
+                # fdAT starts with its sequence number
+                frames[-1]["data"].append(data if chunk_type == b"IDAT" else data[4:])
+            elif chunk_type == b"IEND":
+                tail.append((chunk_type, data))
+            elif not frames:
+                # includes an IDAT without fcTL: a default image outside the animation
+                head.append((chunk_type, data))
+            else:
+                tail.append((chunk_type, data))
+    if not any(t == b"acTL" for t, _ in head):
+        raise PNGFormatError("Not an APNG file")
+
+    kept = []
+    for frame in frames:
+        if kept and _redraws_previous(kept[-1], frame, is_first=len(kept) == 1):
+            prev = kept[-1]
+            delay = _delay_fraction(prev["fctl"]) + _delay_fraction(frame["fctl"])
+            delay = delay.limit_denominator(0xFFFF)
+            if delay.numerator <= 0xFFFF:
+                dispose_op = frame["fctl"][24]
+                if dispose_op == DISPOSE_OP_PREVIOUS:
+                    # restoring to the state before the dropped frame is showing
+                    # the merged frame, i.e. not disposing at all
+                    dispose_op = DISPOSE_OP_NONE
+                prev["fctl"] = _with_fctl_fields(prev["fctl"], 0, delay, dispose_op)
+                continue
+        kept.append(frame)
+    if len(kept) == len(frames):
+        return len(frames), len(kept)
+
+    seq = 0
+    with open(out_path, "wb") as f:
+        f.write(PNG_SIGNATURE)
+        for chunk_type, data in head:
+            if chunk_type == b"acTL":
+                data = struct.pack(">I", len(kept)) + data[4:]
+            f.write(make_chunk(chunk_type, data))
+        for frame in kept:
+            fctl = frame["fctl"]
+            f.write(make_chunk(b"fcTL", struct.pack(">I", seq) + fctl[4:]))
+            seq += 1
+            for data in frame["data"]:
+                if frame["type"] == b"IDAT":
+                    f.write(make_chunk(b"IDAT", data))
+                else:
+                    f.write(make_chunk(b"fdAT", struct.pack(">I", seq) + data))
+                    seq += 1
+        for chunk_type, data in tail:
+            f.write(make_chunk(chunk_type, data))
+    return len(frames), len(kept)
+
+
+def _redraws_previous(prev, frame, is_first):
+    # same pixels drawn with SOURCE over the same region, which prev also
+    # replaced (the first frame is drawn on a transparent canvas) and kept
+    return (
+        frame["type"] == b"fdAT"
+        and prev["fctl"][4:20] == frame["fctl"][4:20]
+        and prev["fctl"][24] == DISPOSE_OP_NONE
+        and (is_first or prev["fctl"][25] == BLEND_OP_SOURCE)
+        and frame["fctl"][25] == BLEND_OP_SOURCE
+        and b"".join(prev["data"]) == b"".join(frame["data"])
+    )
+
+
+def make_ihdr(width, height):
+    # 8-bit RGBA, deflate, adaptive filtering, no interlace
+    return make_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+
+
+def make_fctl(
+    seq,
+    width,
+    height,
+    delay_ms,
+    x_offset=0,
+    y_offset=0,
+    dispose_op=DISPOSE_OP_NONE,
+    blend_op=BLEND_OP_SOURCE,
+):
+    return make_chunk(
+        b"fcTL",
+        struct.pack(
+            ">IIIIIHHBB",
+            seq,
+            width,
+            height,
+            x_offset,
+            y_offset,
+            int(delay_ms),
+            1000,
+            dispose_op,
+            blend_op,
+        ),
+    )
+
+
+def encode_rgba(width, height, rgba: bytes, level=6) -> bytes:
+    # filter type 0 (None) on every scanline
+    stride = width * 4
+    raw = b"".join(
+        b"\x00" + rgba[y * stride : (y + 1) * stride] for y in range(height)
+    )
+    return zlib.compress(raw, level)
+
+
+def write_png(path, width, height, rgba: bytes):
+    with open(path, "wb") as f:
+        f.write(PNG_SIGNATURE)
+        f.write(make_ihdr(width, height))
+        f.write(make_chunk(b"IDAT", encode_rgba(width, height, rgba)))
+        f.write(make_chunk(b"IEND", b""))
+
+
+def write_apng(path, width, height, frames, delays_ms, num_plays=0):
+    """Write full-canvas RGBA frames as an APNG, frames[i] shown for delays_ms[i]."""
+    if len(frames) != len(delays_ms):
+        raise ValueError("frames and delays_ms must have the same length")
+    seq = 0
+    with open(path, "wb") as f:
+        f.write(PNG_SIGNATURE)
+        f.write(make_ihdr(width, height))
+        f.write(make_chunk(b"acTL", struct.pack(">II", len(frames), num_plays)))
+        for i, (rgba, delay) in enumerate(zip(frames, delays_ms)):
+            f.write(make_fctl(seq, width, height, delay))
+            seq += 1
+            data = encode_rgba(width, height, rgba)
+            if i == 0:
+                f.write(make_chunk(b"IDAT", data))
+            else:
+                f.write(make_chunk(b"fdAT", struct.pack(">I", seq) + data))
+                seq += 1
+        f.write(make_chunk(b"IEND", b""))
@@ -0,0 +1,308 @@
+"""
+In-process size optimization of animated PNG output (--optimize-png).
+
+The APNG is decoded into fully composed frames and written again:
+
+- Consecutive identical frames are merged, adding up their delays.
+- Every frame after the first is cropped to the rectangle that differs from
+  the canvas it is drawn on.
+- Each frame gets the cheapest combination of the previous frame's dispose_op
+  and its own blend_op. With BLEND_OP_OVER, pixels that do not change inside
+  the rectangle become fully transparent, which deflates to almost nothing.
+  OVER is only used where every changed pixel is opaque, so the result is
+  exact.
+- With at most 256 distinct colors (alpha included) over all frames, the
+  frames are stored as a palette image.
+- Frame data is deflated by Pillow at level 9, with adaptive filters.
+
+The original bytes are kept if the result is not smaller. tests/test_apngopt.py
+checks that the output of the generated corpus decodes to the source frames and
+delays; verify=True (the APNG_VERIFY=1 extra param) does the same for every file
+and keeps the original when it does not match, at about twice the cost.
+"""
+import io
+import os
+import struct
+from fractions import Fraction
+
+import numpy as np
+from PIL import Image
+
+from apng import (
+    BLEND_OP_OVER,
+    BLEND_OP_SOURCE,
+    DISPOSE_OP_BACKGROUND,
+    DISPOSE_OP_NONE,
+    DISPOSE_OP_PREVIOUS,
+    PNG_SIGNATURE,
+    PNGFormatError,
+    iter_chunks,
+    make_chunk,
+    png_bit_depth,
+)
+from framebuf import FrameBuffer
+
+PALETTE_COLORS = 256
+COMPRESS_LEVEL = 9
+# candidates are ranked by a fast deflate, the chosen one is deflated again
+RANK_COMPRESS_LEVEL = 3
+# fcTL delays are 16-bit fractions
+DELAY_MAX = 0xFFFF
+TRANSPARENT = (0, 0, 0, 0)
+
+
+class APNGOptimizeResult:
+    def __init__(self, size_before, frames_before):
+        self.size_before = size_before
+        self.size_after = size_before
+        self.frames_before = frames_before
+        self.frames_after = frames_before
+        self.palette = False
+        # with verify: the optimized file decoded to the source frames (False:
+        # kept the original because it did not)
+        self.verified = None
+
+    @property
+    def saved(self):
+        return self.size_before - self.size_after
+
+    def to_dict(self):
+        return {
+            "size_before": self.size_before,
+            "size_after": self.size_after,
+            "frames_before": self.frames_before,
+            "frames_after": self.frames_after,
+            "palette": self.palette,
+            "verified": self.verified,
+        }
+
+
+class _Frame:
+    def __init__(self, x, y, width, height, blend_op, pixels, data):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.blend_op = blend_op
+        self.pixels = pixels
+        # deflated scanlines, the content of IDAT/fdAT
+        self.data = data
+        self.delay = Fraction(0)
+        self.dispose_op = DISPOSE_OP_NONE
+
+
+def read_delays(path):
+    """(delays as Fractions of a second, plays) from the fcTL/acTL chunks."""
+    delays, plays = [], 0
+    with open(path, "rb") as f:
+        for chunk_type, data in iter_chunks(f, skip_types=(b"IDAT", b"fdAT")):
+            if chunk_type == b"acTL":
+                plays = struct.unpack(">I", data[4:8])[0]
+            elif chunk_type == b"fcTL":
+                if len(data) != 26:
+                    raise PNGFormatError("Bad fcTL chunk")
+                num, den = struct.unpack(">HH", data[20:24])
+                delays.append(Fraction(num, den or 100))
+    return delays, plays
+
+
+def merge_identical(frames, delays):
+    """Drop frames equal to the previous one, adding their delay to it."""
+    keep, merged = [0], [delays[0]]
+    for i in range(1, len(frames)):
+        total = merged[-1] + delays[i]
+        fits = total.limit_denominator(DELAY_MAX).numerator <= DELAY_MAX
+        if fits and np.array_equal(frames[i], frames[keep[-1]]):
+            merged[-1] = total
+        else:
+            keep.append(i)
+            merged.append(delays[i])
+    return frames[keep], merged
+
+
+class _Encoder:
+    """Deflates frame rectangles, as RGBA or as indexes into one palette."""
+
+    def __init__(self, frames):
+        packed = frames.reshape(-1, 4).view(np.uint32).ravel()
+        transparent = np.array([TRANSPARENT], np.uint8).view(np.uint32)
+        colors = np.union1d(np.unique(packed), transparent)
+        self.colors = colors if len(colors) <= PALETTE_COLORS else None
+        # IHDR fields and PLTE/tRNS chunks, from the first encoded frame
+        self.header = None
+        self.palette_chunks = []
+
+    def _image(self, pixels):
+        if self.colors is None:
+            return Image.fromarray(pixels, "RGBA")
+        packed = np.ascontiguousarray(pixels).view(np.uint32)[..., 0]
+        index = np.searchsorted(self.colors, packed).astype(np.uint8)
+        image = Image.fromarray(index, "P")
+        image.putpalette(self.colors.view(np.uint8).tobytes(), rawmode="RGBA")
+        return image
+
+    def encode(self, pixels, level=COMPRESS_LEVEL):
+        buf = io.BytesIO()
+        self._image(pixels).save(buf, format="PNG", compress_level=level)
+        buf.seek(0)
+        data, palette_chunks = [], []
+        for chunk_type, chunk in iter_chunks(buf):
+            if chunk_type == b"IHDR":
+                header = chunk[8:]
+            elif chunk_type in (b"PLTE", b"tRNS"):
+                palette_chunks.append((chunk_type, chunk))
+            elif chunk_type == b"IDAT":
+                data.append(chunk)
+        if self.header is None:
+            self.header, self.palette_chunks = header, palette_chunks
+        elif header != self.header:
+            raise PNGFormatError("Frames were encoded with different color types")
+        return b"".join(data)
+
+
+def _changed_box(canvas, target):
+    # (y0, y1, x0, x1) of the pixels that differ, a 1x1 box if none do
+    changed = np.any(canvas != target, axis=2)
+    rows = np.flatnonzero(changed.any(axis=1))
+    if not len(rows):
+        return 0, 1, 0, 1
+    cols = np.flatnonzero(changed.any(axis=0))
+    return rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+
+
+def _candidates(canvas, target, encoder: _Encoder):
+    # the frames that draw target onto canvas, SOURCE and (if exact) OVER
+    y0, y1, x0, x1 = _changed_box(canvas, target)
+    region = target[y0:y1, x0:x1]
+    blends = [(BLEND_OP_SOURCE, region)]
+    changed = np.any(canvas[y0:y1, x0:x1] != region, axis=2)
+    if np.all(region[..., 3][changed] == 255):
+        blends.append((BLEND_OP_OVER, np.where(changed[..., None], region, 0)))
+    for blend_op, pixels in blends:
+        pixels = pixels.astype(np.uint8)
+        data = encoder.encode(pixels, RANK_COMPRESS_LEVEL)
+        yield _Frame(x0, y0, x1 - x0, y1 - y0, blend_op, pixels, data)
+
+
+def _disposed(canvas, shown, frame: _Frame, dispose_op):
+    # the canvas the next frame is drawn on
+    if dispose_op == DISPOSE_OP_PREVIOUS:
+        return canvas
+    if dispose_op == DISPOSE_OP_BACKGROUND:
+        cleared = shown.copy()
+        y, x = frame.y, frame.x
+        cleared[y : y + frame.height, x : x + frame.width] = TRANSPARENT
+        return cleared
+    return shown
+
+
+def plan_frames(frames, encoder: _Encoder):
+    """
+    Return a _Frame per composed frame. The previous frame's dispose_op is
+    chosen together with each frame, picking the smallest frame data.
+    """
+    height, width = frames.shape[1:3]
+    first = _Frame(0, 0, width, height, BLEND_OP_SOURCE, frames[0], None)
+    planned = [first]
+    # canvas before the previous frame was drawn, fully transparent at first
+    before_prev = np.zeros_like(frames[0])
+    for i in range(1, len(frames)):
+        prev = planned[-1]
+        # PREVIOUS on the first frame means BACKGROUND, leave it out
+        dispose_ops = [DISPOSE_OP_NONE, DISPOSE_OP_BACKGROUND]
+        if i > 1:
+            dispose_ops.append(DISPOSE_OP_PREVIOUS)
+        best = None
+        for dispose_op in dispose_ops:
+            canvas = _disposed(before_prev, frames[i - 1], prev, dispose_op)
+            for frame in _candidates(canvas, frames[i], encoder):
+                if best is None or len(frame.data) < len(best[1].data):
+                    best = (dispose_op, frame, canvas)
+        prev.dispose_op, frame, before_prev = best
+        planned.append(frame)
+    for frame in planned:
+        frame.data = encoder.encode(frame.pixels)
+    return planned
+
+
+def write_apng(path, width, height, planned, plays, encoder: _Encoder):
+    seq = 0
+    with open(path, "wb") as f:
+        f.write(PNG_SIGNATURE)
+        f.write(make_chunk(b"IHDR", struct.pack(">II", width, height) + encoder.header))
+        for chunk_type, data in encoder.palette_chunks:
+            f.write(make_chunk(chunk_type, data))
+        f.write(make_chunk(b"acTL", struct.pack(">II", len(planned), plays)))
+        for i, frame in enumerate(planned):
+            delay = frame.delay.limit_denominator(DELAY_MAX)
+            fctl = struct.pack(
+                ">IIIIIHHBB",
+                seq,
+                frame.width,
+                frame.height,
+                frame.x,
+                frame.y,
+                delay.numerator,
+                delay.denominator,
+                frame.dispose_op,
+                frame.blend_op,
+            )
+            f.write(make_chunk(b"fcTL", fctl))
+            seq += 1
+            if i == 0:
+                f.write(make_chunk(b"IDAT", frame.data))
+            else:
+                f.write(make_chunk(b"fdAT", struct.pack(">I", seq) + frame.data))
+                seq += 1
+        f.write(make_chunk(b"IEND", b""))
+
+
+def decodes_to(path, frames, delays):
+    """Whether the APNG at path renders exactly frames, shown for delays."""
+    written, written_delays = FrameBuffer.from_file(path), read_delays(path)[0]
+    return np.array_equal(written.frames, frames) and [
+        d.limit_denominator(DELAY_MAX) for d in delays
+    ] == written_delays
+
+
+def optimize_apng(in_file, out_file, verify=False):
+    """
+    Write a smaller, pixel-identical version of the APNG in_file to out_file,
+    or the original bytes if that fails. verify decodes the result again
+    before keeping it. Returns an APNGOptimizeResult.
+    """
+    with open(in_file, "rb") as f:
+        original = f.read()
+    source = FrameBuffer.from_file(in_file)
+    delays, plays = read_delays(in_file)
+    result = APNGOptimizeResult(len(original), source.count)
+    if source.count < 2 or len(delays) != source.count or png_bit_depth(in_file) > 8:
+        # a still image, a default image outside the animation, or 16 bits per
+        # sample that the 8-bit frames would lose
+        with open(out_file, "wb") as f:
+            f.write(original)
+        return result
+
+    frames, delays = merge_identical(source.frames, delays)
+    encoder = _Encoder(frames)
+    planned = plan_frames(frames, encoder)
+    for frame, delay in zip(planned, delays):
+        frame.delay = delay
+    tmp_file = out_file + ".apngopt.tmp"
+    try:
+        write_apng(tmp_file, source.width, source.height, planned, plays, encoder)
+        size = os.path.getsize(tmp_file)
+        if verify and size < len(original):
+            result.verified = decodes_to(tmp_file, frames, delays)
+        if size < len(original) and result.verified is not False:
+            os.replace(tmp_file, out_file)
+            result.size_after = size
+            result.frames_after = len(planned)
+            result.palette = encoder.colors is not None
+            return result
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    with open(out_file, "wb") as f:
+        f.write(original)
+    return result
@@ -0,0 +1,383 @@
+"""
+Benchmarks for the processing engine.
+
+A synthetic APNG/PNG corpus is generated deterministically, then every
+Operation and a few complete ProcessTask chains are timed against it.
+Results are written as JSON and can be compared against a previous run:
+
+    python benchmark.py --out baseline.json
+    python benchmark.py --out current.json --compare baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from corpus import CORPUS, CorpusCase, generate_corpus
+from processing import (
+    ImageProcessor,
+    Operation,
+    OutputFormat,
+    ProcessTask,
+    ProcessorConfig,
+)
+from utils import ENCODER_PRESETS, WEBM_SIZE_KB_MAX
+
+DEFAULT_REPEAT = 3
+DEFAULT_REGRESSION_THRESHOLD = 0.10
+# emoji per ImageProcessor.run_batch call, as in a typical emoji pack
+EMOJI_BATCH_COUNT = 40
+RESULT_SCHEMA_VERSION = 1
+
+
+# complete chains as downloader.main builds them
+CHAINS = {
+    "png": (OutputFormat.APNG, [Operation.SCALE]),
+    "gif": (OutputFormat.GIF, [Operation.TO_GIF]),
+    "webm": (OutputFormat.WEBM, [Operation.SCALE, Operation.TO_WEBM]),
+    "mp4": (OutputFormat.MP4, [Operation.TO_MP4]),
+    "webp": (OutputFormat.WEBP, [Operation.TO_WEBP]),
+    "message_png": (OutputFormat.APNG, [Operation.OVERLAY, Operation.SCALE]),
+}
+# chains whose encoder follows the PRESET extra param
+PRESET_CHAINS = {"gif", "webm", "mp4", "webp"}
+
+
+def _operations_for_case(case: CorpusCase):
+    ops = [Operation.SCALE, Operation.REMOVE_ALPHA, Operation.TO_GIF, Operation.TO_WEBP]
+    if case.overlay:
+        ops.append(Operation.OVERLAY)
+    if case.has_animation:
+        ops.extend([Operation.TO_WEBM, Operation.TO_MP4])
+    return ops
+
+
+def _chains_for_case(case: CorpusCase):
+    chains = ["png", "gif", "webp"]
+    if case.overlay:
+        chains.append("message_png")
+    if case.has_animation:
+        chains.extend(["webm", "mp4"])
+    return chains
+
+
+def _scale_px(case: CorpusCase):
+    return 100 if case.is_emoji else 512
+
+
+def _time_runs(fn, repeat):
+    samples = []
+    for rep in range(repeat):
+        start = time.perf_counter()
+        out_path = fn(rep)
+        samples.append(time.perf_counter() - start)
+    return samples, out_path
+
+
+def _result(kind, name, case, samples, out_path):
+    return {
+        "key": f"{kind}:{name}:{case.name}",
+        "kind": kind,
+        "name": name,
+        "case": case.name,
+        "repeat": len(samples),
+        "seconds_min": min(samples),
+        "seconds_median": statistics.median(samples),
+        "output_bytes": os.path.getsize(out_path) if os.path.isfile(out_path) else 0,
+    }
+
+
+def bench_operation(op: Operation, case: CorpusCase, inputs, work_dir, repeat):
+    img, audio, overlay = inputs
+    config = ProcessorConfig(work_dir, case.sticker_type, OutputFormat.RAW, {})
+    processor = ImageProcessor(config)
+
+    def run_once(rep):
+        sticker_id = f"{case.name}_{op.value}_{rep}"
+        processor._current_sticker_id = sticker_id
+        out_path = os.path.join(work_dir, f"{sticker_id}.out")
+        task = ProcessTask(
+            sticker_id, img, audio, overlay, _scale_px(case), [op], out_path
+        )
+        processor.apply_operation(op, task, img, out_path)
+        return out_path
+
+    samples, out_path = _time_runs(run_once, repeat)
+    return _result("op", op.value, case, samples, out_path)
+
+
+def bench_chain(chain_name, case: CorpusCase, inputs, work_dir, repeat, preset=None):
+    img, audio, overlay = inputs
+    output_format, operations = CHAINS[chain_name]
+    extra_params = {"PRESET": preset} if preset else {}
+    config = ProcessorConfig(work_dir, case.sticker_type, output_format, extra_params)
+    processor = ImageProcessor(config)
+    # presets are benchmarked under their own keys, e.g. chain:webm@fast:anim_320_20f
+    name = f"{chain_name}@{preset}" if preset else chain_name
+
+    def run_once(rep):
+        sticker_id = f"{case.name}_{name}_{rep}"
+        out_path = os.path.join(work_dir, f"{sticker_id}.{output_format.value}")
+        processor.process_task(
+            ProcessTask(
+                sticker_id,
+                img,
+                audio,
+                overlay,
+                _scale_px(case),
+                list(operations),
+                out_path,
+            )
+        )
+        return out_path
+
+    samples, out_path = _time_runs(run_once, repeat)
+    return _result("chain", name, case, samples, out_path)
+
+
+def bench_emoji_batch(chain_name, case: CorpusCase, inputs, work_dir, repeat):
+    # a whole emoji pack through run_batch, compare with chain:<chain_name>:<case>
+    img, audio, overlay = inputs
+    output_format, operations = CHAINS[chain_name]
+    config = ProcessorConfig(work_dir, case.sticker_type, output_format, {})
+    name = f"{chain_name}x{EMOJI_BATCH_COUNT}"
+
+    def run_once(rep):
+        tasks = [
+            ProcessTask(
+                f"{case.name}_{name}_{rep}_{i}",
+                img,
+                audio,
+                overlay,
+                _scale_px(case),
+                list(operations),
+                os.path.join(
+                    work_dir, f"{case.name}_{name}_{rep}_{i}.{output_format.value}"
+                ),
+            )
+            for i in range(EMOJI_BATCH_COUNT)
+        ]
+        ImageProcessor(config).run_batch(tasks)
+        return tasks[-1].result_path
+
+    samples, out_path = _time_runs(run_once, repeat)
+    return _result("batch", name, case, samples, out_path)
+
+
+def run_benchmarks(
+    corpus_dir, work_dir, repeat, op_filter=None, case_filter=None, presets=None
+):
+    cases = [c for c in CORPUS if not case_filter or c.name in case_filter]
+    corpus = generate_corpus(corpus_dir, cases)
+    results = []
+    for case in cases:
+        inputs = corpus[case.name]
+        for op in _operations_for_case(case):
+            if op_filter and op.value not in op_filter:
+                continue
+            results.append(bench_operation(op, case, inputs, work_dir, repeat))
+            print(_format_result(results[-1]))
+        for chain_name in _chains_for_case(case):
+            if op_filter and chain_name not in op_filter:
+                continue
+            chain_presets = [None]
+            if presets and chain_name in PRESET_CHAINS:
+                chain_presets = presets
+            for preset in chain_presets:
+                results.append(
+                    bench_chain(chain_name, case, inputs, work_dir, repeat, preset)
+                )
+                print(_format_result(results[-1]))
+        if case.is_emoji:
+            for chain_name in ["png", "webm"] if case.has_animation else ["png"]:
+                if op_filter and chain_name not in op_filter:
+                    continue
+                results.append(
+                    bench_emoji_batch(chain_name, case, inputs, work_dir, repeat)
+                )
+                print(_format_result(results[-1]))
+    return results
+
+
+def _format_result(r):
+    return (
+        f"{r['key']:<45} median {r['seconds_median'] * 1000:9.1f} ms"
+        f"  min {r['seconds_min'] * 1000:9.1f} ms  {r['output_bytes'] / 1024:8.1f} KB"
+    )
+
+
+def summarize_chains(results):
+    """
+    Rows of (chain, cases, mean ms per sticker, mean KB, share over the WebM
+    size limit or None) over the corpus cases each chain (and preset) ran on.
+    """
+    by_name = {}
+    for r in results:
+        if r["kind"] == "chain":
+            by_name.setdefault(r["name"], []).append(r)
+    rows = []
+    for name, runs in by_name.items():
+        over = None
+        if name.split("@")[0] == "webm":
+            limit = WEBM_SIZE_KB_MAX * 1024
+            over = sum(r["output_bytes"] > limit for r in runs) / len(runs)
+        rows.append(
+            (
+                name,
+                len(runs),
+                statistics.mean(r["seconds_median"] for r in runs) * 1000,
+                statistics.mean(r["output_bytes"] for r in runs) / 1024,
+                over,
+            )
+        )
+    return rows
+
+
+def _format_summary(rows):
+    lines = [
+        "| Chain | Cases | ms/sticker | KB/sticker | Over WebM size limit |",
+        "|---|---|---|---|---|",
+    ]
+    for name, cases, ms, kb, over in rows:
+        over = "-" if over is None else f"{over:.0%}"
+        lines.append(f"| `{name}` | {cases} | {ms:.0f} | {kb:.1f} | {over} |")
+    return "\n".join(lines)
+
+
+def compare_results(current, baseline, threshold):
+    """Return (rows, regressions), matching results by key."""
+    base_by_key = {r["key"]: r for r in baseline["results"]}
+    rows, regressions = [], []
+    for r in current["results"]:
+        base = base_by_key.get(r["key"])
+        if base is None or not base["seconds_median"]:
+            continue
+        ratio = r["seconds_median"] / base["seconds_median"]
+        rows.append((r["key"], base["seconds_median"], r["seconds_median"], ratio))
+        if ratio > 1 + threshold:
+            regressions.append(r["key"])
+    return rows, regressions
+
+
+def _ffmpeg_version():
+    try:
+        import subprocess
+
+        out = subprocess.run(
+            ["ffmpeg", "-version"], capture_output=True, text=True
+        ).stdout
+        return out.splitlines()[0] if out else ""
+    except OSError:
+        return ""
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description="Benchmark sticker processing operations"
+    )
+    arg_parser.add_argument(
+        "--corpus-dir",
+        type=str,
+        help="Where to put the synthetic corpus, a temporary directory by default",
+    )
+    arg_parser.add_argument(
+        "--repeat", type=int, default=DEFAULT_REPEAT, help="Runs per measurement"
+    )
+    arg_parser.add_argument(
+        "--only",
+        type=str,
+        help="Comma separated operations/chains to run, e.g. to_webm,webm",
+    )
+    arg_parser.add_argument(
+        "--cases", type=str, help="Comma separated corpus case names to run"
+    )
+    arg_parser.add_argument(
+        "--presets",
+        type=str,
+        help="Comma separated encoder presets to time the gif/webm/mp4/webp chains with, "
+        f"e.g. {','.join(ENCODER_PRESETS)}",
+    )
+    arg_parser.add_argument("--out", type=str, help="Write results to this JSON file")
+    arg_parser.add_argument(
+        "--compare", type=str, help="Baseline JSON file to compare against"
+    )
+    arg_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_REGRESSION_THRESHOLD,
+        help="Relative slowdown of the median reported as a regression",
+    )
+    arg_parser.add_argument(
+        "--generate-only",
+        action="store_true",
+        help="Only write the synthetic corpus to --corpus-dir",
+    )
+    args = arg_parser.parse_args()
+    presets = args.presets.split(",") if args.presets else None
+    if presets and not set(presets) <= set(ENCODER_PRESETS):
+        arg_parser.error(f"--presets must be among {', '.join(ENCODER_PRESETS)}")
+
+    corpus_dir = args.corpus_dir or tempfile.mkdtemp(prefix="sticker_corpus_")
+    if args.generate_only:
+        generate_corpus(corpus_dir)
+        print("Corpus written to", corpus_dir)
+        return 0
+
+    work_dir = tempfile.mkdtemp(prefix="sticker_bench_")
+    try:
+        results = run_benchmarks(
+            corpus_dir,
+            work_dir,
+            args.repeat,
+            set(args.only.split(",")) if args.only else None,
+            set(args.cases.split(",")) if args.cases else None,
+            presets,
+        )
+    finally:
+        shutil.rmtree(work_dir)
+        if not args.corpus_dir:
+            shutil.rmtree(corpus_dir)
+
+    report = {
+        "schema": RESULT_SCHEMA_VERSION,
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "ffmpeg": _ffmpeg_version(),
+        },
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    summary = summarize_chains(results)
+    if summary:
+        print("-----------------Chains over the corpus:-----------------")
+        print(_format_summary(summary))
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        rows, regressions = compare_results(report, baseline, args.threshold)
+        print("-----------------Compared to baseline:-----------------")
+        for key, base, curr, ratio in rows:
+            flag = " REGRESSION" if key in regressions else ""
+            print(
+                f"{key:<45} {base * 1000:9.1f} ms -> {curr * 1000:9.1f} ms  x{ratio:.2f}{flag}"
+            )
+        if regressions:
+            print(f"{len(regressions)} regression(s) above {args.threshold:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,364 @@
+"""
+Persistent SQLite catalog of known packs.
+
+The catalog remembers what resolving a pack costs a page fetch or a metadata
+request for: pack metadata (type, titles and authors per language, sticker
+ids), author ids from store pages and yabe emoji numbers mapped to LINE pack
+ids. Pipeline checks it before going to the network, and it can be filled in
+bulk from files that are already on disk:
+
+    python catalog.py import sticker_dl/*/pack.zip saved_pages/*.html
+    python catalog.py search 白熊
+    python catalog.py search --author --contains line
+    python catalog.py refresh --older-than 30
+"""
+import argparse
+import glob
+import json
+import os
+import re
+import sqlite3
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock
+
+from pipeline import DEFAULT_DOWNLOAD_THREADS, extract_pack_info_from_metadata
+
+CATALOG_FILENAME = "catalog.sqlite3"
+DEFAULT_CATALOG_PATH = os.path.join("sticker_dl", CATALOG_FILENAME)
+# metadata older than this is fetched again by Pipeline
+CATALOG_MAX_AGE = 30 * 24 * 3600
+SEARCH_LIMIT = 50
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS packs (
+    pack_id TEXT NOT NULL,
+    is_emoji INTEGER NOT NULL,
+    sticker_type TEXT,
+    author_id TEXT,
+    sticker_ids TEXT,
+    metadata TEXT,
+    fetched_at REAL,
+    PRIMARY KEY (pack_id, is_emoji)
+);
+CREATE TABLE IF NOT EXISTS names (
+    pack_id TEXT NOT NULL,
+    is_emoji INTEGER NOT NULL,
+    lang TEXT NOT NULL,
+    title TEXT COLLATE NOCASE,
+    author TEXT COLLATE NOCASE,
+    PRIMARY KEY (pack_id, is_emoji, lang)
+);
+CREATE INDEX IF NOT EXISTS names_title ON names (title);
+CREATE INDEX IF NOT EXISTS names_author ON names (author);
+CREATE TABLE IF NOT EXISTS yabe (
+    yabe_id TEXT PRIMARY KEY,
+    pack_id TEXT NOT NULL,
+    fetched_at REAL
+);
+"""
+
+_STORE_URL_REGEX = re.compile(
+    r"store\.line\.me/(stickershop|emojishop)/product/([a-f0-9]+)"
+)
+_YABE_EMOJI_NUMBER_REGEX = re.compile(r"Emoji_Data\.php\?Number=(\d+)")
+_HTML_LANG_REGEX = re.compile(r"<html[^>]*\slang=\"([\w-]+)\"", re.IGNORECASE)
+
+
+class Catalog:
+    """Thread safe; one connection is shared behind a lock."""
+
+    def __init__(self, path=DEFAULT_CATALOG_PATH):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def yabe_pack_id(self, yabe_id):
+        rows = self._query("SELECT pack_id FROM yabe WHERE yabe_id = ?", (yabe_id,))
+        return rows[0]["pack_id"] if rows else None
+
+    def add_yabe(self, yabe_id, pack_id):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO yabe VALUES (?, ?, ?)",
+                (yabe_id, pack_id, time.time()),
+            )
+
+    def metadata(self, pack_id, is_emoji, max_age=None):
+        """Return the stored metadata, None if unknown or older than max_age seconds."""
+        rows = self._query(
+            "SELECT metadata, fetched_at FROM packs"
+            " WHERE pack_id = ? AND is_emoji = ? AND metadata IS NOT NULL",
+            (pack_id, int(is_emoji)),
+        )
+        if not rows:
+            return None
+        if max_age is not None and time.time() - rows[0]["fetched_at"] > max_age:
+            return None
+        return json.loads(rows[0]["metadata"])
+
+    def add_metadata(self, pack_id, is_emoji, metadata: dict, fetched_at=None):
+        info = extract_pack_info_from_metadata(metadata, pack_id, "en", is_emoji)
+        langs = set(metadata.get("title", {})) | set(metadata.get("author", {}))
+        names = [
+            (
+                pack_id,
+                int(is_emoji),
+                lang,
+                metadata.get("title", {}).get(lang),
+                metadata.get("author", {}).get(lang),
+            )
+            for lang in sorted(langs)
+        ]
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO packs (pack_id, is_emoji, sticker_type, sticker_ids,"
+                " metadata, fetched_at) VALUES (?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (pack_id, is_emoji) DO UPDATE SET"
+                " sticker_type = excluded.sticker_type,"
+                " sticker_ids = excluded.sticker_ids,"
+                " metadata = excluded.metadata, fetched_at = excluded.fetched_at",
+                (
+                    pack_id,
+                    int(is_emoji),
+                    info["sticker_type"],
+                    json.dumps(info["stickers"]),
+                    json.dumps(metadata),
+                    fetched_at or time.time(),
+                ),
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO names VALUES (?, ?, ?, ?, ?)", names
+            )
+
+    def add_store_page(self, pack_id, is_emoji, lang, title, author, author_id):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO packs (pack_id, is_emoji, author_id) VALUES (?, ?, ?)"
+                " ON CONFLICT (pack_id, is_emoji) DO UPDATE SET"
+                " author_id = coalesce(excluded.author_id, author_id)",
+                (pack_id, int(is_emoji), author_id),
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO names VALUES (?, ?, ?, ?, ?)",
+                (pack_id, int(is_emoji), lang, title, author),
+            )
+
+    def search(self, query, by="title", contains=False, lang=None, limit=SEARCH_LIMIT):
+        """
+        Find packs whose title (or author, by="author") starts with query, or
+        contains it if contains. Prefix searches use the index; both ignore
+        ASCII case. Returns one dict per matching pack and language.
+        """
+        if by not in ("title", "author"):
+            raise ValueError(f"Can not search by {by}")
+        escaped = re.sub(r"([\\%_])", r"\\\1", query)
+        pattern = f"%{escaped}%" if contains else f"{escaped}%"
+        sql = (
+            "SELECT n.pack_id, n.is_emoji, n.lang, n.title, n.author,"
+            " p.sticker_type, p.author_id, p.fetched_at"
+            " FROM names n LEFT JOIN packs p"
+            " ON p.pack_id = n.pack_id AND p.is_emoji = n.is_emoji"
+            f" WHERE n.{by} LIKE ? ESCAPE '\\'"
+        )
+        params = [pattern]
+        if lang:
+            sql += " AND n.lang = ?"
+            params.append(lang)
+        sql += f" ORDER BY n.{by} LIMIT ?"
+        params.append(limit)
+        return [dict(row) for row in self._query(sql, params)]
+
+    def packs(self, older_than=None):
+        """(pack_id, is_emoji) of packs with metadata, only stale ones if older_than."""
+        sql = "SELECT pack_id, is_emoji FROM packs WHERE metadata IS NOT NULL"
+        params = ()
+        if older_than is not None:
+            sql += " AND fetched_at < ?"
+            params = (time.time() - older_than,)
+        return [(r["pack_id"], bool(r["is_emoji"])) for r in self._query(sql, params)]
+
+    def import_file(self, path, lang="zh-Hant"):
+        """
+        Import a pack.zip, a metadata file (productInfo.meta, meta.json) or a
+        saved LINE store / yabe emoji page. Returns a description of what was
+        added; raises ValueError for files it can not make sense of.
+        """
+        if zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as archive:
+                names = archive.namelist()
+                meta_name = next(
+                    (n for n in ("productInfo.meta", "meta.json") if n in names), None
+                )
+                if meta_name is None:
+                    raise ValueError("No pack metadata in archive")
+                metadata = json.loads(archive.read(meta_name))
+            return self._import_metadata(metadata, os.path.getmtime(path))
+        with open(path, "rb") as f:
+            content = f.read()
+        if content.lstrip().startswith(b"{"):
+            return self._import_metadata(json.loads(content), os.path.getmtime(path))
+        return self._import_page(path, content, lang)
+
+    def _import_metadata(self, metadata, fetched_at):
+        if "packageId" not in metadata:
+            raise ValueError("Not pack metadata")
+        is_emoji = "sticonResourceType" in metadata or "orders" in metadata
+        pack_id = str(metadata["packageId"])
+        self.add_metadata(pack_id, is_emoji, metadata, fetched_at)
+        return f"metadata of {'emoji' if is_emoji else 'sticker'} pack {pack_id}"
+
+    def _import_page(self, path, content, lang):
+        import webreq
+
+        # saved pages are UTF-8, do not let the parser guess
+        text = content.decode("utf-8", errors="replace")
+        if "yabeline" in text and "line.me/S/emoji/?id=" in text:
+            match = _YABE_EMOJI_NUMBER_REGEX.search(text) or re.search(
+                r"(\d+)", os.path.basename(path)
+            )
+            if not match:
+                raise ValueError("Unable to locate yabe number")
+            pack_id = webreq.parse_yabe_emoji_page(text)
+            self.add_yabe(match.group(1), pack_id)
+            return f"yabe emoji {match.group(1)} -> {pack_id}"
+        match = _STORE_URL_REGEX.search(text)
+        if not match:
+            raise ValueError("Not a LINE store or yabe emoji page")
+        is_emoji = match.group(1) == "emojishop"
+        pack_id = match.group(2)
+        if lang_match := _HTML_LANG_REGEX.search(text):
+            lang = lang_match.group(1)
+        title, author, author_id = webreq.parse_line_store_page(
+            text, is_emoji, pack_id
+        )
+        self.add_store_page(pack_id, is_emoji, lang, title, author, author_id)
+        return f"store page of pack {pack_id} ({lang}): {title}"
+
+
+def refresh(catalog: Catalog, older_than=None, threads=DEFAULT_DOWNLOAD_THREADS):
+    """Fetch the metadata of catalogued packs again, return (updated, failed)."""
+    import webreq
+
+    packs = catalog.packs(older_than)
+    updated = failed = 0
+    with ThreadPoolExecutor(threads, thread_name_prefix="Refresh") as pool:
+        futures = {
+            pool.submit(webreq.get_metadata, pack_id, is_emoji): (pack_id, is_emoji)
+            for pack_id, is_emoji in packs
+        }
+        for future in as_completed(futures):
+            pack_id, is_emoji = futures[future]
+            try:
+                catalog.add_metadata(pack_id, is_emoji, future.result())
+                updated += 1
+            except Exception as e:
+                print(f"Failed to refresh pack {pack_id}: {e!r}")
+                failed += 1
+    return updated, failed
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Local catalog of sticker packs")
+    arg_parser.add_argument(
+        "--catalog", type=str, default=DEFAULT_CATALOG_PATH, help="Catalog file"
+    )
+    commands = arg_parser.add_subparsers(dest="command", required=True)
+
+    import_parser = commands.add_parser(
+        "import", help="Import pack.zip, metadata files and saved store/yabe pages"
+    )
+    import_parser.add_argument("paths", nargs="+", help="Files or glob patterns")
+    import_parser.add_argument(
+        "--lang",
+        type=str,
+        default="zh-Hant",
+        help="Language of saved store pages that do not declare one",
+    )
+
+    search_parser = commands.add_parser("search", help="Search by title or author")
+    search_parser.add_argument("query", type=str)
+    search_parser.add_argument(
+        "--author", action="store_true", help="Search authors instead of titles"
+    )
+    search_parser.add_argument(
+        "--contains", action="store_true", help="Match anywhere, not only the start"
+    )
+    search_parser.add_argument("--lang", type=str, help="Only this language")
+    search_parser.add_argument("--limit", type=int, default=SEARCH_LIMIT)
+
+    refresh_parser = commands.add_parser(
+        "refresh", help="Fetch the metadata of catalogued packs again"
+    )
+    refresh_parser.add_argument(
+        "--older-than",
+        type=float,
+        metavar="DAYS",
+        help="Only packs fetched more than this many days ago",
+    )
+    refresh_parser.add_argument("--proxy", type=str, help="proxy, http(s)://addr:port")
+    refresh_parser.add_argument("--cdn-base-url", type=str)
+    args = arg_parser.parse_args()
+
+    with Catalog(args.catalog) as catalog:
+        if args.command == "import":
+            imported = failed = 0
+            for pattern in args.paths:
+                for path in sorted(glob.glob(pattern)) or [pattern]:
+                    try:
+                        print(f"{path}: {catalog.import_file(path, args.lang)}")
+                        imported += 1
+                    except (OSError, ValueError, KeyError, AttributeError) as e:
+                        print(f"{path}: skipped, {e}")
+                        failed += 1
+            print(f"Imported {imported} file(s), skipped {failed}")
+        elif args.command == "search":
+            rows = catalog.search(
+                args.query,
+                by="author" if args.author else "title",
+                contains=args.contains,
+                lang=args.lang,
+                limit=args.limit,
+            )
+            for row in rows:
+                kind = "emoji" if row["is_emoji"] else "sticker"
+                print(
+                    f"{row['pack_id']:<26} {kind:<8} {row['lang']:<8}"
+                    f" {row['title']} / {row['author']}"
+                )
+            print(f"{len(rows)} result(s)")
+        elif args.command == "refresh":
+            import webreq
+
+            if args.proxy:
+                webreq.set_proxy({"https": args.proxy})
+            if args.cdn_base_url:
+                webreq.set_base_urls(cdn=args.cdn_base_url)
+            older_than = args.older_than * 24 * 3600 if args.older_than else None
+            updated, failed = refresh(catalog, older_than)
+            print(f"Refreshed {updated} pack(s), {failed} failed")
+
+
+if __name__ == "__main__":
+    main()
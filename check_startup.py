@@ -0,0 +1,85 @@
+"""
+Check that importing the CLI stays cheap: none of the heavy dependencies may be
+loaded at import time, and the import overhead must stay under a budget.
+
+    python check_startup.py --max-ms 100
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# only to be imported on the code paths that need them
+HEAVY_MODULES = [
+    "requests",
+    "bs4",
+    "html5lib",
+    "ffmpeg",
+    "tqdm",
+    "numpy",
+    "PIL",
+    "boto3",
+    "processing",
+]
+DEFAULT_RUNS = 10
+DEFAULT_MAX_IMPORT_MS = 150
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def heavy_modules_loaded(module="downloader"):
+    code = (
+        f"import sys; import {module}; "
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", code], cwd=_HERE, capture_output=True, text=True
+    )
+    if out.returncode:
+        raise RuntimeError(out.stderr)
+    return [m for m in out.stdout.strip().split(",") if m]
+
+
+def _median_run_seconds(code, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=_HERE, check=True)
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def import_overhead_ms(module="downloader", runs=DEFAULT_RUNS):
+    baseline = _median_run_seconds("pass", runs)
+    with_import = _median_run_seconds(f"import {module}", runs)
+    return (with_import - baseline) * 1000
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Check CLI startup cost")
+    arg_parser.add_argument("--runs", type=int, default=DEFAULT_RUNS)
+    arg_parser.add_argument(
+        "--max-ms",
+        type=float,
+        default=DEFAULT_MAX_IMPORT_MS,
+        help="Allowed import overhead of downloader.py over a bare interpreter",
+    )
+    args = arg_parser.parse_args()
+
+    failed = False
+    loaded = heavy_modules_loaded()
+    if loaded:
+        print("FAILED: heavy modules imported at startup:", ", ".join(loaded))
+        failed = True
+    overhead = import_overhead_ms(runs=args.runs)
+    print(f"Import overhead of downloader: {overhead:.1f} ms (budget {args.max_ms} ms)")
+    if overhead > args.max_ms:
+        print("FAILED: import overhead over budget")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
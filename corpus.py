@@ -0,0 +1,167 @@
+"""
+Deterministic synthetic sticker corpus (PNG/APNG, overlays and sound) used by
+the benchmarks and the mock CDN.
+"""
+import math
+import os
+import random
+
+import apng
+from utils import StickerType, sticker_type_properties
+
+
+class CorpusCase:
+    def __init__(
+        self,
+        name,
+        sticker_type: StickerType,
+        width,
+        height,
+        frames=1,
+        delay_ms=100,
+        alpha="binary",
+        hold=0,
+        sound_sec=0.0,
+        overlay=False,
+    ):
+        self.name = name
+        self.sticker_type = sticker_type
+        self.width = width
+        self.height = height
+        # number of distinct frames, each followed by `hold` identical frames
+        self.frames = frames
+        self.delay_ms = delay_ms
+        # "binary": opaque shape on transparent background
+        # "ramp": alpha gradient across the shape
+        self.alpha = alpha
+        self.hold = hold
+        self.sound_sec = sound_sec
+        self.overlay = overlay
+
+    @property
+    def has_animation(self):
+        return sticker_type_properties(self.sticker_type)[0]
+
+    @property
+    def is_emoji(self):
+        return sticker_type_properties(self.sticker_type)[4]
+
+
+# sizes follow what LINE serves for @2x stickers and emoji
+CORPUS = [
+    CorpusCase("static_370", StickerType.STATIC_STICKER, 370, 320),
+    CorpusCase("static_370_ramp", StickerType.STATIC_STICKER, 370, 320, alpha="ramp"),
+    CorpusCase(
+        "message_370", StickerType.MESSAGE_STICKER, 370, 320, overlay=True
+    ),
+    CorpusCase("emoji_static_180", StickerType.EMOJI, 180, 180),
+    CorpusCase(
+        "emoji_anim_180", StickerType.ANIMATED_EMOJI, 180, 180, frames=16, delay_ms=80
+    ),
+    CorpusCase(
+        "anim_320_20f", StickerType.ANIMATED_STICKER, 320, 270, frames=20, delay_ms=100
+    ),
+    CorpusCase(
+        "anim_320_60f_ramp",
+        StickerType.ANIMATED_STICKER,
+        320,
+        320,
+        frames=60,
+        delay_ms=50,
+        alpha="ramp",
+    ),
+    # 4.5 s with runs of identical frames, exceeds the WebM duration limit
+    CorpusCase(
+        "anim_320_holds",
+        StickerType.ANIMATED_STICKER,
+        320,
+        320,
+        frames=15,
+        delay_ms=100,
+        hold=2,
+    ),
+    CorpusCase(
+        "anim_sound_320",
+        StickerType.ANIMATED_AND_SOUND_STICKER,
+        320,
+        270,
+        frames=20,
+        delay_ms=100,
+        sound_sec=2.0,
+    ),
+]
+
+
+def _render_frame(case: CorpusCase, index, rng: random.Random):
+    w, h = case.width, case.height
+    color = bytes([rng.randrange(256), rng.randrange(256), rng.randrange(256)])
+    background = b"\x00\x00\x00\x00" * w
+    if case.alpha == "ramp":
+        shape_row = b"".join(color + bytes([(x * 255) // max(w - 1, 1)]) for x in range(w))
+    else:
+        shape_row = (color + b"\xff") * w
+    # a disc travelling from left to right
+    radius = min(w, h) // 3
+    steps = max(case.frames - 1, 1)
+    cx = radius + (w - 2 * radius) * index // steps
+    cy = h // 2
+    rows = []
+    for y in range(h):
+        dy = y - cy
+        if abs(dy) > radius:
+            rows.append(background)
+            continue
+        half = int(math.sqrt(radius * radius - dy * dy))
+        x0, x1 = max(cx - half, 0), min(cx + half, w)
+        rows.append(background[: x0 * 4] + shape_row[x0 * 4 : x1 * 4] + background[x1 * 4 :])
+    return b"".join(rows)
+
+
+def _render_overlay(case: CorpusCase):
+    # a white message box in the middle, like the default text overlay
+    w, h = case.width, case.height
+    box_w, box_h = w * 2 // 3, h // 4
+    x0 = (w - box_w) // 2
+    row = b"\x00\x00\x00\x00" * x0 + b"\xff\xff\xff\xe0" * box_w
+    row += b"\x00\x00\x00\x00" * (w - x0 - box_w)
+    empty = b"\x00\x00\x00\x00" * w
+    y0 = (h - box_h) // 2
+    return b"".join(row if y0 <= y < y0 + box_h else empty for y in range(h))
+
+
+def generate_case(case: CorpusCase, corpus_dir, seed=0):
+    """Write the image (and overlay/sound) of a case, return their paths."""
+    rng = random.Random(f"{seed}:{case.name}")
+    img_path = os.path.join(corpus_dir, f"{case.name}.png")
+    overlay_path = os.path.join(corpus_dir, f"{case.name}.overlay.png")
+    audio_path = os.path.join(corpus_dir, f"{case.name}.m4a")
+    if not os.path.isfile(img_path):
+        if case.has_animation:
+            frames, delays = [], []
+            for i in range(case.frames):
+                frame = _render_frame(case, i, rng)
+                frames.extend([frame] * (case.hold + 1))
+                delays.extend([case.delay_ms] * (case.hold + 1))
+            apng.write_apng(img_path, case.width, case.height, frames, delays)
+        else:
+            apng.write_png(
+                img_path, case.width, case.height, _render_frame(case, 0, rng)
+            )
+    if case.overlay and not os.path.isfile(overlay_path):
+        apng.write_png(overlay_path, case.width, case.height, _render_overlay(case))
+    if case.sound_sec and not os.path.isfile(audio_path):
+        import ffmpeg
+
+        ffmpeg.input(
+            f"sine=frequency=440:duration={case.sound_sec}", f="lavfi"
+        ).output(audio_path, acodec="aac").overwrite_output().run(quiet=True)
+    return (
+        img_path,
+        audio_path if case.sound_sec else "",
+        overlay_path if case.overlay else "",
+    )
+
+
+def generate_corpus(corpus_dir, cases=CORPUS, seed=0):
+    os.makedirs(corpus_dir, exist_ok=True)
+    return {case.name: generate_case(case, corpus_dir, seed) for case in cases}
@@ -1,62 +1,47 @@
 import argparse
+import contextlib
 import json
 import os
-import re
-import shutil
 import sys
-import tempfile
-import time
-import zipfile
-from queue import Queue
-
-from tqdm import tqdm
 
+import metrics
+import tracing
+import tuning
 import webreq
-from processing import (
-    ImageProcessorThread,
-    Operation,
-    OutputFormat,
-    ProcessTask,
-    ProcessorConfig,
-)
-from utils import (
-    MESSAGE_STICKER_OVERLAY_DEFAULT,
-    PackNotFoundException,
-    STICKER_SET_URL_REGEX,
-    SourceUrlType,
-    StickerType,
-    get_counter_value,
-    reset_counter,
-    sticker_type_properties,
-)
-from webreq import (
-    MultiThreadDownloader,
-    get_metadata,
-    get_real_pack_id_from_yabe_emoji,
-    get_sticker_archive,
+from catalog import DEFAULT_CATALOG_PATH, Catalog
+from pipeline import (
+    DEFAULT_DOWNLOAD_THREADS,
+    DEFAULT_PROCESS_THREADS,
+    DEFAULT_TASK_RETRIES,
+    DEFAULT_TASK_TIMEOUT,
+    PackOptions,
+    Pipeline,
+    PipelineError,
+    STICKER_FAILED,
 )
+from sinks import ARCHIVE_COMPRESSION_CHOICES, set_s3_endpoint
+from utils import ENCODER_PRESETS, StickerType
 
 err_print = print
-norm_print = print
-sticker_process_temp_root = ""
 
 
-def wait_for_queue_with_progress(quiet: bool, queue: Queue, total: int):
-    if not quiet:
-        reset_counter()
-        with tqdm(total=total) as progress_bar:
-            last = 0
-            while not (completed := get_counter_value()) == total:
-                progress_bar.update(completed - last)
-                progress_bar.refresh()
-                last = completed
-                time.sleep(0.5)
-            queue.join()
-            progress_bar.n = total
-            progress_bar.refresh()
-            progress_bar.clear()
-    else:
-        queue.join()
+class TqdmProgress:
+    # progress(stage, done, total) callback of Pipeline.run drawing tqdm bars
+    def __init__(self):
+        self._bars = {}
+
+    def __call__(self, stage, done, total):
+        from tqdm import tqdm
+
+        bar = self._bars.get(stage)
+        if bar is None:
+            bar = self._bars[stage] = tqdm(total=total)
+        bar.n = done
+        bar.refresh()
+        if done >= total:
+            bar.clear()
+            bar.close()
+            del self._bars[stage]
 
 
 def main():
@@ -100,6 +85,12 @@ def main():
         action="store_true",
         help="Redownload stickers even if they exist",
     )
+    arg_parser.add_argument(
+        "--update",
+        action="store_true",
+        help="Fetch and process only the stickers that changed since the pack was"
+        " downloaded",
+    )
     arg_parser.add_argument(
         "--no-subdir",
         action="store_true",
@@ -119,6 +110,25 @@ def main():
     arg_parser.add_argument(
         "-o", "--output-dir", type=str, help="Output directory for processed stickers"
     )
+    arg_parser.add_argument(
+        "--output-archive",
+        type=str,
+        metavar="ARCHIVE",
+        help="Stream stickers into a .zip/.tar(.gz) file instead of the output "
+        'directory, "-" writes a zip to stdout, s3://bucket/prefix uploads them',
+    )
+    arg_parser.add_argument(
+        "--s3-endpoint-url",
+        type=str,
+        help="S3-compatible service for s3:// output, e.g. MinIO or mock_s3.py",
+    )
+    arg_parser.add_argument(
+        "--archive-compression",
+        type=str,
+        default="auto",
+        choices=ARCHIVE_COMPRESSION_CHOICES,
+        help="Zip compression, auto stores webm/gif/mp4/webp and deflates png",
+    )
     # conversion options
 
     # webm won't have audio track
@@ -127,7 +137,7 @@ def main():
         type=str,
         help="Output format",
         default="none",
-        choices=["none", "png", "gif", "webm", "mp4"],
+        choices=["none", "png", "gif", "webm", "mp4", "webp"],
     )
 
     arg_parser.add_argument(
@@ -148,6 +158,38 @@ def main():
     arg_parser.add_argument(
         "--extra-params", type=str, help="Extra parameters for processing"
     )
+    # shorthand for the PRESET extra parameter, WEBM_PRESET etc. override it
+    arg_parser.add_argument(
+        "--preset",
+        type=str,
+        choices=ENCODER_PRESETS,
+        help="Encoder speed/size trade-off for webm, mp4, gif and webp output",
+    )
+    # shorthands for the WEBP_LOSSLESS and WEBP_QUALITY extra parameters
+    arg_parser.add_argument(
+        "--webp-lossless", action="store_true", help="Encode webp output losslessly"
+    )
+    arg_parser.add_argument(
+        "--webp-quality",
+        type=int,
+        metavar="Q",
+        help="Quality (0-100) of lossy webp output, or the compression effort of "
+        "lossless output, default 80",
+    )
+    arg_parser.add_argument(
+        "--optimize-png",
+        action="store_true",
+        help="Recompress png output losslessly, in the worker threads; animated"
+        " stickers are rewritten with only the changed part of each frame",
+    )
+    # shorthand for the PNG_QUALITY extra parameter
+    arg_parser.add_argument(
+        "--png-quality",
+        type=int,
+        metavar="MIN",
+        help="With --optimize-png, also quantize to 256 colors when the quality"
+        " score (0-100) stays at least MIN",
+    )
 
     # for message stickers only
     arg_parser.add_argument(
@@ -157,45 +199,110 @@ def main():
     )
 
     # not commonly used
+    arg_parser.add_argument(
+        "--reprocess",
+        action="store_true",
+        help="Process all stickers even if the output manifest says they are up to date",
+    )
+    arg_parser.add_argument(
+        "--task-timeout",
+        type=float,
+        default=DEFAULT_TASK_TIMEOUT,
+        metavar="SECONDS",
+        help="Kill a processing step (ffmpeg/magick) running longer than this, "
+        "0 for no limit",
+    )
+    arg_parser.add_argument(
+        "--task-retries",
+        type=int,
+        default=DEFAULT_TASK_RETRIES,
+        help="Retry a processing step that timed out this many times",
+    )
+    arg_parser.add_argument(
+        "--analyze",
+        nargs="?",
+        const="",
+        metavar="JSON_FILE",
+        help="Only report frames, durations and predicted WebM compliance of the "
+        "pack's stickers (and write them to JSON_FILE), do not convert anything",
+    )
+    arg_parser.add_argument(
+        "--enqueue",
+        type=str,
+        metavar="QUEUE_FILE",
+        help="Only add the pack with these options to a work queue, for workers "
+        "started with workqueue.py work",
+    )
+    arg_parser.add_argument(
+        "--catalog",
+        type=str,
+        default=DEFAULT_CATALOG_PATH,
+        help="Local pack catalog checked before fetching metadata or yabe pages",
+    )
+    arg_parser.add_argument(
+        "--no-catalog", action="store_true", help="Do not use the local pack catalog"
+    )
+    arg_parser.add_argument(
+        "--cdn-base-url",
+        type=str,
+        help="Use this host instead of the LINE CDN, e.g. a local mock_cdn.py server",
+    )
+    arg_parser.add_argument(
+        "--trace",
+        type=str,
+        metavar="TRACE_JSON",
+        help="Record per-stage timings and write them as a Chrome/Perfetto trace",
+    )
+    arg_parser.add_argument(
+        "--metrics-out",
+        type=str,
+        metavar="METRICS_FILE",
+        help="Write run metrics to this file, as JSON for *.json and in the "
+        "Prometheus text format otherwise",
+    )
     arg_parser.add_argument(
         "-t",
         "--threads",
-        type=int,
-        help="Thread number of processing threads",
-        default=8,
+        type=tuning.parse_threads,
+        help='Thread number of processing threads, or "auto" to pick processing '
+        "and download threads from the cores, memory and the pack",
+        default=DEFAULT_PROCESS_THREADS,
     )
 
     args = arg_parser.parse_args()
 
-    sticker_data_root_dir = os.path.join(os.getcwd(), "sticker_dl")
-    if not os.path.exists(sticker_data_root_dir):
-        os.mkdir(sticker_data_root_dir)
+    if args.trace:
+        tracing.enable()
+    try:
+        if args.output_archive == "-":
+            # stdout carries the archive, keep messages out of it
+            with contextlib.redirect_stdout(sys.stderr):
+                return run_cli(args)
+        return run_cli(args)
+    finally:
+        if args.trace:
+            tracing.export(args.trace)
 
-    # gather arguments
 
+def run_cli(args):
     # handle proxies
     proxies = {}
     if os.path.exists("./PROXY"):
-        with open("./PROXY",encoding='utf-8') as f:
+        with open("./PROXY", encoding="utf-8") as f:
             proxies["https"] = f.read().strip()
     if args.proxy:
         # proxy in args will override the PROXY file
         proxies["https"] = args.proxy
     webreq.set_proxy(proxies)
+    if args.cdn_base_url:
+        webreq.set_base_urls(cdn=args.cdn_base_url)
+    if args.s3_endpoint_url:
+        set_s3_endpoint(args.s3_endpoint_url)
 
-    thread_num = args.threads
-    lang = args.lang
-    pack_type = args.type
-    remove_alpha = args.remove_alpha
-    id_url = args.id_url.strip()
-    scale_to_512_square = args.scale
-    re_download = args.redownload
-    output_fmt = args.output_fmt
-    no_default_txt_overlay = args.no_default_txt_overlay
-    skip_confirmation = args.y
-    no_sub_dir = args.no_subdir
-    open_folder = args.show
     quiet = args.quiet
+    skip_confirmation = args.y or quiet
+    norm_print = (lambda *a, **kw: None) if quiet else print
+
     extra_params = {}
     if args.extra_params:
         for kv in args.extra_params.split(","):
@@ -205,421 +312,129 @@ def main():
                 err_print(f"Invalid extra parameter {kv}, ignored")
                 continue
             extra_params[k] = v
-    if not args.output_dir:
-        sticker_output_root_dir = os.path.join(os.getcwd(), "sticker_out")
-    else:
-        sticker_output_root_dir = args.output_dir
-    global norm_print
-    if quiet:
-        norm_print = lambda *args, **kwargs: None
-        skip_confirmation = True
-    if not os.path.exists(sticker_output_root_dir):
-        os.makedirs(sticker_output_root_dir)
-    # check if input is id or url
-    if "http" not in id_url:
-        pack_id = id_url
-        is_emoji = pack_type == "emoji"
-        if not is_emoji and len(pack_id) >= 24:
-            err_print(
-                "WARNING: You probably want to download an emoji pack, but the sticker type is not specified as emoji."
-            )
-    else:
-        # input is url
-        # extract pack id from url
-        for _type, (_regex, _emoji_flag) in STICKER_SET_URL_REGEX.items():
-            match = _regex.match(id_url)
-            if match:
-                norm_print(f"URL is matched as: {_type}")
-                pack_id = match.group(1)
-                is_emoji = _emoji_flag
-
-                if _type == SourceUrlType.YABE_EMOJI:
-                    # special processing to get real pack id
-                    pack_id = get_real_pack_id_from_yabe_emoji(pack_id)
-                break
-        else:
-            norm_print(
-                "URL is not matched as any known source! Please double check the url"
-            )
-            sys.exit(1)
-
-    # from here, pack_id should be ready
-
-    # Check if the sticker set archive exists
-    sticker_pack_dl_root = os.path.join(sticker_data_root_dir, pack_id)
-    pack_archive_path = os.path.join(sticker_pack_dl_root, "pack.zip")
-    pack_archive_exists = os.path.isfile(pack_archive_path)
-    download_pack = True
-    if pack_archive_exists and not re_download:
-        norm_print(f"Found local archive for pack {pack_id}!")
-        archive = zipfile.ZipFile(pack_archive_path, "r")
-        metadata = json.loads(archive.read("productInfo.meta"))
-        download_pack = False
-    else:
-        # get metadata from line store
-        try:
-            metadata = get_metadata(pack_id, is_emoji)
-        except PackNotFoundException:
-            err_print(
-                f'ERROR: Cannot find sticker set {pack_id} with type "{pack_type}"!'
-            )
-            sys.exit(1)
-    pack_info = extract_pack_info_from_metadata(metadata, pack_id, lang, is_emoji)
-
-    # from here, pack_info should be ready
-
-    title = pack_info["title"]
-    sticker_type = StickerType(pack_info["sticker_type"])
-    id_list = pack_info["stickers"]
-    sticker_count = len(id_list)
-    (
-        has_animation,
-        has_sound,
-        has_popup,
-        has_text_overlay,
-        is_emoji,
-    ) = sticker_type_properties(sticker_type)
+    if args.preset:
+        extra_params.setdefault("PRESET", args.preset)
+    if args.png_quality is not None:
+        extra_params.setdefault("PNG_QUALITY", str(args.png_quality))
+    if args.webp_lossless:
+        extra_params.setdefault("WEBP_LOSSLESS", "1")
+    if args.webp_quality is not None:
+        extra_params.setdefault("WEBP_QUALITY", str(args.webp_quality))
+
+    options = PackOptions(
+        pack_type=args.type,
+        lang=args.lang,
+        output_fmt=args.output_fmt,
+        scale=args.scale,
+        remove_alpha=args.remove_alpha,
+        extra_params=extra_params,
+        no_default_txt_overlay=args.no_default_txt_overlay,
+        no_sub_dir=args.no_subdir,
+        redownload=args.redownload,
+        reprocess=args.reprocess,
+        update=args.update,
+        optimize_png=args.optimize_png or args.png_quality is not None,
+        output_archive=args.output_archive,
+        archive_compression=args.archive_compression,
+        task_timeout=args.task_timeout or None,
+        task_retries=max(0, args.task_retries),
+    )
 
-    scale_px = 0
-    if scale_to_512_square and not has_animation:
-        scale_px = 512
-    elif output_fmt == "webm":
-        if is_emoji:
-            scale_px = 100
+    if args.enqueue:
+        import workqueue
+
+        with workqueue.WorkQueue(args.enqueue) as queue:
+            added = queue.enqueue(args.id_url.strip(), workqueue.job_options(options))
+        norm_print("Queued" if added else "Already queued or running", args.id_url)
+        return 0
+
+    def confirm(plan):
+        norm_print("-----------------Sticker pack info:-----------------")
+        norm_print("Title:", plan.title)
+        norm_print("Pack ID:", plan.pack_id)
+        norm_print("Sticker Type:", plan.sticker_type.name)
+        norm_print("Total number of stickers:", len(plan.sticker_ids))
+        if args.output_fmt == "none":
+            norm_print("Output format: RAW")
         else:
-            scale_px = 512
-    norm_print("-----------------Sticker pack info:-----------------")
-    norm_print("Title:", title)
-    norm_print("Pack ID:", pack_id)
-    norm_print("Sticker Type:", sticker_type.name)
-    norm_print("Total number of stickers:", sticker_count)
-    processing_needed = output_fmt != "none"
-    if not processing_needed:
-        norm_print("Output format: RAW")
-    else:
-        norm_print("Output format:", output_fmt)
-        if scale_px:
-            norm_print("Scale:", f"{scale_px}*{scale_px}px")
-        if sticker_type == StickerType.MESSAGE_STICKER:
-            norm_print("Default text overlay:", not no_default_txt_overlay)
-            norm_print("Output directory:", sticker_output_root_dir)
-
-    norm_print("----------------------------------------------------")
-
-    if not skip_confirmation:
-        confirm = input("Do you wish to continue? Y/n: ")
-        if confirm.lower() == "n":
+            norm_print("Output format:", args.output_fmt)
+            if plan.scale_px:
+                norm_print("Scale:", f"{plan.scale_px}*{plan.scale_px}px")
+            if plan.sticker_type == StickerType.MESSAGE_STICKER:
+                norm_print("Default text overlay:", not args.no_default_txt_overlay)
+                norm_print("Output directory:", plan.output_dir)
+        norm_print("----------------------------------------------------")
+        if skip_confirmation:
+            return True
+        answer = input("Do you wish to continue? Y/n: ")
+        if answer.lower() == "n":
             norm_print("Aborting...")
-            sys.exit(0)
-        elif confirm and confirm.lower() != "y":
+            return False
+        elif answer and answer.lower() != "y":
             norm_print("Invalid input. Aborting...")
-            sys.exit(1)
-
-    # create folders
-    if not os.path.isdir(sticker_pack_dl_root):
-        os.mkdir(sticker_pack_dl_root)
-
-    if download_pack:
-        # download sticker pack
-        norm_print("Downloading sticker pack archive... ", end="")
-        archive_content = get_sticker_archive(pack_id, sticker_type)
-        norm_print("Complete!")
-
-        # save archive and unzip to temp folder
-        with open(pack_archive_path, "wb") as f:
-            f.write(archive_content)
-
-    global sticker_process_temp_root
-    sticker_process_temp_root = tempfile.mkdtemp()
-    # starting from here, use return to exit with cleaning up the temp folder
-
-    sticker_temp_raw_path = os.path.join(sticker_process_temp_root, "raw")
-    sticker_temp_extracted_zip_path = os.path.join(
-        sticker_process_temp_root, "unarchive"
-    )
-
-    if not os.path.isdir(sticker_temp_raw_path):
-        os.mkdir(sticker_temp_raw_path)
-    if not os.path.isdir(sticker_temp_extracted_zip_path):
-        os.mkdir(sticker_temp_extracted_zip_path)
-
-    norm_print("Extracting archive... ", end="")
-    with zipfile.ZipFile(pack_archive_path, "r") as zip_ref:
-        zip_ref.extractall(sticker_temp_extracted_zip_path)
-    norm_print("Complete!")
-
-    rearrange_pack_content(
-        sticker_temp_extracted_zip_path, sticker_temp_raw_path, is_emoji
-    )
-
-    # for message sticker, download default overlay message in advance
-    if sticker_type == StickerType.MESSAGE_STICKER:
-        default_overlay_dl_path = os.path.join(sticker_pack_dl_root, "default_overlay")
-        if not os.path.isdir(default_overlay_dl_path):
-            os.mkdir(default_overlay_dl_path)
-        norm_print("Downloading default overlay message for message sticker... ")
-        download_queue = Queue()
-        downloader = [MultiThreadDownloader(download_queue) for _ in range(4)]
-
-        for sticker_id in id_list:
-            filename = os.path.join(default_overlay_dl_path, f"{sticker_id}.png")
-            url = MESSAGE_STICKER_OVERLAY_DEFAULT.format(
-                sticker_id=sticker_id, pack_id=pack_id
-            )
-            download_queue.put((sticker_id, url, filename))
-        for d in downloader:
-            d.start()
-        wait_for_queue_with_progress(quiet, download_queue, sticker_count)
-
-        norm_print("Message sticker default overlay download done!")
-
-        # copy default overlay to raw folder
-        shutil.copytree(
-            default_overlay_dl_path,
-            os.path.join(sticker_temp_raw_path, "default_overlay"),
-            dirs_exist_ok=True,
-        )
-
-    # determine process option
-    # for line, all stickers are png/apng
-    if output_fmt == "png":
-        output_format = OutputFormat.APNG
-    elif output_fmt == "gif":
-        output_format = OutputFormat.GIF
-    elif output_fmt == "webm":
-        output_format = OutputFormat.WEBM
-    elif output_fmt == "video":
-        output_format = OutputFormat.MP4
-    elif output_fmt == "none":
-        output_format = OutputFormat.RAW
-
-    else:
-        # that should not happen since we have checked the input in argparse
-        err_print(f"FAILED: Invalid output format {output_fmt}!")
-        return
-
-    sanitized_title = "_".join(re.sub(r'[/:*?"<>|]', "", title).split())
-    if no_sub_dir:
-        sticker_output_path = os.path.join(
-            sticker_output_root_dir, f"{sanitized_title}({pack_id})"
-        )
-    else:
-        sticker_output_path = os.path.join(
-            sticker_output_root_dir,
-            f"{sanitized_title}({pack_id})",
-            f"{output_format.value}",
-        )
-
-    if output_format == OutputFormat.RAW:
-        norm_print("Copying raw sticker files to output folder... ", end="")
-        shutil.copytree(
-            sticker_temp_raw_path,
-            sticker_output_path,
-            dirs_exist_ok=True,
-        )
-        if open_folder:
-            os.startfile(sticker_output_path)
-        return
-
-    # check dependency for processing
-    if not shutil.which("magick"):
-        err_print(
-            "Error: ImageMagick is missing. Please install missing dependencies are re-run the program"
-        )
-        return
-
-    process_queue = Queue()
-
-    if scale_px:
-        sticker_output_path += f"_scale_{scale_px}"
-    if not os.path.isdir(sticker_output_path):
-        os.makedirs(sticker_output_path)
-
-    if not has_animation and output_format not in [OutputFormat.APNG, OutputFormat.GIF]:
-        err_print(
-            "ERROR: Sticker pack does not have animation, only PNG and GIF output are supported!"
-        )
-        return
-
-    for sticker_id in id_list:
-        sub_folder = "static"
-        if is_emoji:
-            sub_folder = "emoji"
-        else:
-            if has_animation:
-                sub_folder = "animation"
-            if has_popup:
-                sub_folder = "popup"
-
-        in_pic = os.path.join(sticker_temp_raw_path, sub_folder, f"{sticker_id}.png")
-        in_audio = os.path.join(sticker_temp_raw_path, "sound", f"{sticker_id}.m4a")
-        in_overlay = os.path.join(
-            sticker_temp_raw_path, "default_overlay", f"{sticker_id}.png"
-        )
-
-        result_output = os.path.join(
-            sticker_output_path, f"{sticker_id}.{output_format.value}"
-        )
-
-        operations = []
-
-        # order of operation: overlay, scale, other conversions (gif, webm, video)
-        if has_text_overlay and not no_default_txt_overlay:
-            operations.append(Operation.OVERLAY)
-        if scale_px:
-            operations.append(Operation.SCALE)
-        if remove_alpha:
-            operations.append(Operation.REMOVE_ALPHA)
-
-        if output_format == OutputFormat.GIF:
-            operations.append(Operation.TO_GIF)
-        elif output_format == OutputFormat.WEBM:
-            operations.append(Operation.TO_WEBM)
-        elif output_format == OutputFormat.MP4:
-            operations.append(Operation.TO_MP4)
-
-        process_queue.put_nowait(
-            ProcessTask(
-                sticker_id,
-                in_pic,
-                in_audio,
-                in_overlay,
-                scale_px,
-                operations,
-                result_output,
+            raise PipelineError("Invalid input")
+        return True
+
+    catalog = None if args.no_catalog else Catalog(args.catalog)
+    with catalog or contextlib.nullcontext(), Pipeline(
+        output_dir=args.output_dir,
+        threads=args.threads,
+        download_threads=(
+            tuning.AUTO if args.threads == tuning.AUTO else DEFAULT_DOWNLOAD_THREADS
+        ),
+        log=norm_print,
+        catalog=catalog,
+    ) as pipeline:
+        if args.analyze is not None:
+            return analyze_pack(pipeline, args, options)
+        try:
+            result = pipeline.run(
+                args.id_url,
+                options,
+                confirm=confirm,
+                progress=None if quiet else TqdmProgress(),
             )
-        )
-    config = ProcessorConfig(
-        sticker_process_temp_root, sticker_type, output_format, extra_params
-    )
-    processor = [ImageProcessorThread(process_queue, config) for _ in range(thread_num)]
-    for p in processor:
-        p.start()
-    print("Processing stickers...")
-    wait_for_queue_with_progress(quiet, process_queue, sticker_count)
-
-    # TODO icon for all sticker packs
-
+        except PipelineError as e:
+            err_print(e)
+            return 1
+        except KeyboardInterrupt:
+            # running conversions were killed and the temp dir removed
+            err_print("Interrupted")
+            return 130
+    if result.aborted:
+        return 0
+    if result.failed_count:
+        err_print(f"{result.failed_count} sticker(s) failed to process:")
+        for s in result.stickers:
+            if s.status == STICKER_FAILED:
+                err_print(f"  {s.sticker_id}: {s.error!r}")
+    if result.png_bytes_saved:
+        norm_print(f"PNG optimization saved {result.png_bytes_saved:,} bytes")
+    norm_print("-----------------Run metrics:-----------------")
+    for line in metrics.summary_lines():
+        norm_print(line)
+    if args.metrics_out:
+        metrics.export(args.metrics_out)
     norm_print("Process done! Cleaning up...")
-
-    # os.startfile(sticker_process_temp_root)
-    if open_folder:
-        os.startfile(sticker_output_path)
-
-
-def rearrange_pack_content(sticker_extracted_zip_path, sticker_raw_path, is_emoji):
-    # copy useful files to raw folder and rename
-    if is_emoji:
-        # emoji
-        emoji_path = os.path.join(sticker_raw_path, "emoji")
-        if not os.path.isdir(emoji_path):
-            os.mkdir(emoji_path)
-        for fn in os.listdir(sticker_extracted_zip_path):
-            if match := re.match(r"(\d+)(_animation)?\.png", fn):
-                shutil.copy(
-                    os.path.join(sticker_extracted_zip_path, fn),
-                    os.path.join(emoji_path, match.group(1) + ".png"),
-                )
-        # metadata
-        shutil.copy(
-            os.path.join(sticker_extracted_zip_path, "meta.json"),
-            os.path.join(sticker_raw_path, "meta.json"),
-        )
-    else:
-        # the static stickers exist in all packs
-        static_path = os.path.join(sticker_raw_path, "static")
-        if not os.path.isdir(static_path):
-            os.mkdir(static_path)
-        for fn in os.listdir(sticker_extracted_zip_path):
-            if match := re.match(r"(\d+)@2x\.png", fn):
-                shutil.copy(
-                    os.path.join(sticker_extracted_zip_path, fn),
-                    os.path.join(static_path, match.group(1) + ".png"),
-                )
-        # animations
-        if os.path.isdir(os.path.join(sticker_extracted_zip_path, "animation@2x")):
-            animation_path = os.path.join(sticker_raw_path, "animation")
-            if not os.path.isdir(animation_path):
-                os.mkdir(animation_path)
-            for fn in os.listdir(
-                os.path.join(sticker_extracted_zip_path, "animation@2x")
-            ):
-                if match := re.match(r"(\d+)@2x\.png", fn):
-                    shutil.copy(
-                        os.path.join(
-                            sticker_extracted_zip_path,
-                            "animation@2x",
-                            fn,
-                        ),
-                        os.path.join(animation_path, match.group(1) + ".png"),
-                    )
-        # sound
-        if os.path.isdir(os.path.join(sticker_extracted_zip_path, "sound")):
-            sound_path = os.path.join(sticker_raw_path, "sound")
-            if not os.path.isdir(sound_path):
-                os.mkdir(sound_path)
-            for fn in os.listdir(os.path.join(sticker_extracted_zip_path, "sound")):
-                shutil.copy(
-                    os.path.join(sticker_extracted_zip_path, "sound", fn),
-                    os.path.join(sound_path, fn),
-                )
-        # popup
-        if os.path.isdir(os.path.join(sticker_extracted_zip_path, "popup")):
-            popup_path = os.path.join(sticker_raw_path, "popup")
-            if not os.path.isdir(popup_path):
-                os.mkdir(popup_path)
-            for fn in os.listdir(os.path.join(sticker_extracted_zip_path, "popup")):
-                shutil.copy(
-                    os.path.join(sticker_extracted_zip_path, "popup", fn),
-                    os.path.join(popup_path, fn),
-                )
-        # icon
-        shutil.copy(
-            os.path.join(sticker_extracted_zip_path, "tab_on@2x.png"),
-            os.path.join(sticker_raw_path, "icon.png"),
-        )
-        # metadata
-        shutil.copy(
-            os.path.join(sticker_extracted_zip_path, "productInfo.meta"),
-            os.path.join(sticker_raw_path, "productInfo.meta"),
-        )
-
-
-def extract_pack_info_from_metadata(metadata, pack_id, lang, is_emoji):
-    if metadata["title"].get(lang):
-        title = metadata["title"][lang]
-    else:
-        title = metadata["title"]["en"]
-    if metadata["author"].get(lang):
-        author_name = metadata["author"][lang]
-    else:
-        author_name = metadata["author"]["en"]
-    if is_emoji:
-        if metadata.get("sticonResourceType") == "ANIMATION":
-            sticker_type = StickerType.ANIMATED_EMOJI
-        else:
-            sticker_type = StickerType.EMOJI
-        id_list = metadata["orders"]
-    else:
-        if "stickerResourceType" not in metadata:
-            sticker_type = StickerType.STATIC_STICKER
-        else:
-            sticker_type = StickerType(metadata["stickerResourceType"])
-        id_list = [i["id"] for i in metadata["stickers"]]
-    pack_info = {
-        "title": title,
-        "author_name": author_name,
-        "pack_id": pack_id,
-        "sticker_type": sticker_type.value,
-        "count": len(id_list),
-        "stickers": id_list,
-    }
-    return pack_info
+    if args.show:
+        os.startfile(result.output_dir)
+    return 0
+
+
+def analyze_pack(pipeline: Pipeline, args, options: PackOptions):
+    try:
+        analysis = pipeline.analyze(args.id_url, options)
+    except PipelineError as e:
+        err_print(e)
+        return 1
+    print(f"{analysis.title} ({analysis.pack_id}, {analysis.sticker_type})")
+    for line in analysis.table_lines():
+        print(line)
+    if args.analyze:
+        with open(args.analyze, "w", encoding="utf-8") as f:
+            json.dump(analysis.to_dict(), f, indent=2, ensure_ascii=False)
+    return 0
 
 
 if __name__ == "__main__":
-    main()
-    # do cleanup
-    # remove temp dir
-    if sticker_process_temp_root:
-        shutil.rmtree(sticker_process_temp_root)
+    sys.exit(main())
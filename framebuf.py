@@ -0,0 +1,274 @@
+"""
+Decoded frames held in memory as one NumPy array.
+
+A FrameBuffer is the (frames, height, width, channels) uint8 array of a PNG or
+APNG, every frame fully composed (dispose/blend already applied), plus the
+frame delays. Overlay, alpha flattening and scaling work on the whole array at
+once, and encoders read the raw pixels from it instead of frame files:
+
+    buffer = FrameBuffer.from_file("123.png")
+    buffer = buffer.scale(512).flatten()
+    buffer.write("123_scaled.png")
+    chunks = buffer.raw_video(fps=30)  # for ffmpeg -f rawvideo -pix_fmt rgba
+
+The frames can live in multiprocessing.shared_memory, so worker processes
+attach to them by name instead of receiving a pickled copy:
+
+    shared = buffer.share()
+    # in the worker
+    frames = FrameBuffer.attach(*shared.shared_spec())
+
+Needs numpy and Pillow; processing.py falls back to magick/ffmpeg without them.
+"""
+import math
+
+import numpy as np
+from PIL import Image
+
+# fully composed frames are written back as full-canvas APNG frames
+PNG_COMPRESS_LEVEL = 6
+WEBP_QUALITY = 80
+WHITE = (255, 255, 255)
+
+
+class FrameBuffer:
+    def __init__(self, frames, delays, plays=0, shm=None):
+        # uint8 (n, h, w, 4) RGBA or (n, h, w, 3) RGB
+        self.frames = frames
+        # seconds each frame is shown, 0 for a still image
+        self.delays = list(delays)
+        self.plays = plays
+        self._shm = shm
+
+    @property
+    def count(self):
+        return self.frames.shape[0]
+
+    @property
+    def height(self):
+        return self.frames.shape[1]
+
+    @property
+    def width(self):
+        return self.frames.shape[2]
+
+    @property
+    def has_alpha(self):
+        return self.frames.shape[3] == 4
+
+    @property
+    def pix_fmt(self):
+        # ffmpeg rawvideo pixel format of the frames
+        return "rgba" if self.has_alpha else "rgb24"
+
+    @property
+    def duration(self):
+        return sum(self.delays)
+
+    @classmethod
+    def from_file(cls, path):
+        with Image.open(path) as im:
+            count = getattr(im, "n_frames", 1)
+            frames = np.empty((count, im.height, im.width, 4), dtype=np.uint8)
+            delays = []
+            for i in range(count):
+                im.seek(i)
+                # Pillow composes every APNG frame onto the full canvas
+                frames[i] = np.asarray(im.convert("RGBA"))
+                delays.append(round(im.info.get("duration", 0) / 1000, 3))
+            plays = im.info.get("loop", 0)
+        if count == 1:
+            delays = [0]
+        return cls(frames, delays, plays)
+
+    def _image(self, i):
+        return Image.fromarray(self.frames[i], "RGBA" if self.has_alpha else "RGB")
+
+    def write(self, path, compress_level=PNG_COMPRESS_LEVEL):
+        """Write a PNG, or an APNG if there is more than one frame."""
+        first = self._image(0)
+        if self.count == 1:
+            first.save(path, format="PNG", compress_level=compress_level)
+            return
+        first.save(
+            path,
+            format="PNG",
+            save_all=True,
+            append_images=[self._image(i) for i in range(1, self.count)],
+            duration=[max(1, round(d * 1000)) for d in self.delays],
+            loop=self.plays,
+            disposal=0,
+            blend=0,
+            compress_level=compress_level,
+        )
+
+    def write_webp(self, path, lossless=False, quality=WEBP_QUALITY, **options):
+        """
+        Write a WebP, animated if there is more than one frame, keeping alpha
+        and the frame delays. quality is 0-100; for lossless output it is the
+        compression effort instead. options go to Pillow's WebP encoder, e.g.
+        method (0-6) and minimize_size.
+        """
+        first = self._image(0)
+        options.update(format="WEBP", lossless=lossless, quality=quality)
+        if self.count == 1:
+            first.save(path, **options)
+            return
+        first.save(
+            path,
+            save_all=True,
+            append_images=[self._image(i) for i in range(1, self.count)],
+            duration=[max(1, round(d * 1000)) for d in self.delays],
+            loop=self.plays,
+            **options,
+        )
+
+    def collapse_duplicates(self):
+        """Merge runs of identical frames into one frame with the summed delay."""
+        if self.count < 2:
+            return self
+        flat = self.frames.reshape(self.count, -1)
+        changed = np.any(flat[1:] != flat[:-1], axis=1)
+        keep = np.concatenate(([True], changed))
+        if keep.all():
+            return self
+        delays = []
+        for d, new in zip(self.delays, keep):
+            if new:
+                delays.append(d)
+            else:
+                delays[-1] = round(delays[-1] + d, 3)
+        return FrameBuffer(self.frames[keep], delays, self.plays)
+
+    def overlay_center(self, overlay: "FrameBuffer"):
+        """
+        Composite overlay centered over every frame (like magick's "-gravity
+        center -composite"); the canvas keeps this buffer's size. A one-frame
+        overlay is applied to all frames, otherwise frames are paired up.
+        """
+        base = _rgba_float(self.frames)
+        top = _rgba_float(overlay.frames)
+        if top.shape[0] not in (1, base.shape[0]):
+            raise ValueError(
+                f"Can not overlay {top.shape[0]} frames on {base.shape[0]} frames"
+            )
+        # placement of the overlay on the canvas, clipped to both
+        h, w = top.shape[1:3]
+        y = (self.height - h) // 2
+        x = (self.width - w) // 2
+        y0, x0 = max(y, 0), max(x, 0)
+        y1, x1 = min(y + h, self.height), min(x + w, self.width)
+        if y0 >= y1 or x0 >= x1:
+            return self
+        top = top[:, y0 - y : y1 - y, x0 - x : x1 - x]
+        region = base[:, y0:y1, x0:x1]
+
+        # Porter-Duff "over" on straight (not premultiplied) alpha
+        top_alpha = top[..., 3:]
+        under_alpha = region[..., 3:] * (1 - top_alpha)
+        alpha = top_alpha + under_alpha
+        color = top[..., :3] * top_alpha + region[..., :3] * under_alpha
+        np.divide(color, alpha, out=color, where=alpha > 0)
+        base[:, y0:y1, x0:x1] = np.concatenate((color, alpha), axis=3)
+        return FrameBuffer(_to_uint8(base), self.delays, self.plays)
+
+    def flatten(self, background=WHITE):
+        """Blend the frames onto an opaque background, returning RGB frames."""
+        if not self.has_alpha:
+            return self
+        alpha = self.frames[..., 3:].astype(np.float32) / 255
+        color = self.frames[..., :3].astype(np.float32)
+        flat = color * alpha + np.asarray(background, np.float32) * (1 - alpha)
+        return FrameBuffer(_to_uint8(flat, scale=1), self.delays, self.plays)
+
+    def scaled_size(self, size):
+        # the longer side becomes size, like ffmpeg's scale and magick -resize
+        if self.width >= self.height:
+            return size, max(1, round(self.height * size / self.width))
+        return max(1, round(self.width * size / self.height)), size
+
+    def scale(self, size):
+        width, height = self.scaled_size(size)
+        if (width, height) == (self.width, self.height):
+            return self
+        scaled = np.empty(
+            (self.count, height, width, self.frames.shape[3]), dtype=np.uint8
+        )
+        for i in range(self.count):
+            image = self._image(i)
+            if self.has_alpha:
+                # resample premultiplied, so transparent pixels do not bleed
+                # their (meaningless) color into the edges
+                image = image.convert("RGBa")
+            image = image.resize((width, height), Image.LANCZOS)
+            if self.has_alpha:
+                image = image.convert("RGBA")
+            scaled[i] = np.asarray(image)
+        return FrameBuffer(scaled, self.delays, self.plays)
+
+    def raw_video(self, fps, delays=None):
+        """
+        The frames as raw video at a constant frame rate (at every 1/fps step
+        the frame shown at that time), for an encoder reading rawvideo input.
+        delays overrides self.delays (same count). Yields one byte memoryview
+        per step, views of the frames without copying them, so held frames
+        cost no memory however long they are shown.
+        """
+        delays = self.delays if delays is None else delays
+        ends = np.cumsum(delays)
+        total = float(ends[-1]) if len(ends) else 0.0
+        steps = max(1, math.ceil(round(total * fps, 6)))
+        index = np.searchsorted(ends, np.arange(steps) / fps, side="right")
+        index = np.minimum(index, self.count - 1)
+        for i in index:
+            yield memoryview(np.ascontiguousarray(self.frames[i])).cast("B")
+
+    def share(self):
+        """Return a copy of this buffer backed by multiprocessing.shared_memory."""
+        from multiprocessing import shared_memory
+
+        shm = shared_memory.SharedMemory(create=True, size=max(1, self.frames.nbytes))
+        frames = np.ndarray(self.frames.shape, dtype=np.uint8, buffer=shm.buf)
+        frames[:] = self.frames
+        return FrameBuffer(frames, self.delays, self.plays, shm=shm)
+
+    def shared_spec(self):
+        """Picklable arguments of attach() for another process."""
+        if self._shm is None:
+            raise ValueError("Buffer is not in shared memory, call share() first")
+        return self._shm.name, self.frames.shape, self.delays, self.plays
+
+    @classmethod
+    def attach(cls, name, shape, delays, plays=0):
+        """Map the frames another process share()d, without copying them."""
+        from multiprocessing import shared_memory
+
+        shm = shared_memory.SharedMemory(name=name)
+        frames = np.ndarray(tuple(shape), dtype=np.uint8, buffer=shm.buf)
+        return cls(frames, delays, plays, shm=shm)
+
+    def close(self, unlink=False):
+        """
+        Release the shared memory of this buffer; the process that called
+        share() also unlinks it once every user is done.
+        """
+        if self._shm is None:
+            return
+        self.frames = None
+        self._shm.close()
+        if unlink:
+            self._shm.unlink()
+        self._shm = None
+
+
+def _rgba_float(frames):
+    # 0..1 RGBA, opaque if the frames have no alpha channel
+    values = frames.astype(np.float32) / 255
+    if values.shape[3] == 3:
+        opaque = np.ones(values.shape[:3] + (1,), np.float32)
+        values = np.concatenate((values, opaque), axis=3)
+    return values
+
+
+def _to_uint8(values, scale=255):
+    return np.clip(np.rint(values * scale), 0, 255).astype(np.uint8)
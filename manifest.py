@@ -0,0 +1,130 @@
+"""
+Per-pack output manifest, used to skip stickers whose output is already up to date.
+
+The manifest lives next to the processed stickers and maps every sticker id to
+the hash of its inputs, the operation chain applied, the output size and the
+status of the last attempt. Records are written out atomically every
+MANIFEST_FLUSH_EVERY tasks and when the run ends (or is interrupted), so the
+file is never half written and a killed run loses at most the last few.
+"""
+import hashlib
+import json
+import os
+import tempfile
+from threading import Lock
+
+from utils import Operation
+
+MANIFEST_FILENAME = ".manifest.json"
+MANIFEST_VERSION = 1
+# records kept in memory before the file is rewritten; rewriting it per task
+# made a pack of n stickers write O(n^2) bytes
+MANIFEST_FLUSH_EVERY = 32
+
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_files(paths):
+    # missing files (e.g. no sound for this sticker) are part of the fingerprint too
+    h = hashlib.sha1()
+    for path in paths:
+        h.update(os.path.basename(path).encode())
+        if not os.path.isfile(path):
+            h.update(b"\0missing")
+            continue
+        with open(path, "rb") as f:
+            while chunk := f.read(_HASH_CHUNK_SIZE):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def describe_chain(operations, scale_px, output_format, extra_params=None):
+    ops = ">".join(
+        f"{op.value}({scale_px})" if op == Operation.SCALE else op.value
+        for op in operations
+    )
+    params = ",".join(f"{k}={v}" for k, v in sorted((extra_params or {}).items()))
+    return f"{ops}|{output_format.value}|{params}"
+
+
+class PackManifest:
+    def __init__(self, output_dir, flush_every=MANIFEST_FLUSH_EVERY):
+        self.path = os.path.join(output_dir, MANIFEST_FILENAME)
+        self.flush_every = flush_every
+        self._lock = Lock()
+        # changes since the file was last written
+        self._unsaved = 0
+        self.stickers = {}
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            # a broken manifest only means everything gets processed again
+            return
+        if data.get("version") == MANIFEST_VERSION:
+            self.stickers = data.get("stickers", {})
+
+    def save(self):
+        with self._lock:
+            self._save_locked()
+
+    def flush(self):
+        # write out the records made since the last save, if any
+        with self._lock:
+            if self._unsaved:
+                self._save_locked()
+
+    def _save_locked(self):
+        data = {"version": MANIFEST_VERSION, "stickers": self.stickers}
+        directory = os.path.dirname(self.path)
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=MANIFEST_FILENAME, suffix=".tmp", dir=directory
+        )
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=1)
+            os.replace(tmp_path, self.path)
+            self._unsaved = 0
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def is_up_to_date(self, sticker_id, input_hash, chain, output_path):
+        entry = self.stickers.get(str(sticker_id))
+        if not entry or entry.get("status") != STATUS_DONE:
+            return False
+        if entry.get("input_hash") != input_hash or entry.get("chain") != chain:
+            return False
+        try:
+            return os.path.getsize(output_path) == entry.get("output_size")
+        except OSError:
+            return False
+
+    def record(self, sticker_id, input_hash, chain, output_path, error=None):
+        entry = {"input_hash": input_hash, "chain": chain}
+        if error is None and os.path.isfile(output_path):
+            entry["status"] = STATUS_DONE
+            entry["output_size"] = os.path.getsize(output_path)
+        else:
+            entry["status"] = STATUS_FAILED
+            entry["error"] = repr(error) if error is not None else "no output"
+        with self._lock:
+            self.stickers[str(sticker_id)] = entry
+            self._unsaved += 1
+            if self._unsaved >= self.flush_every:
+                self._save_locked()
+
+    def forget(self, sticker_id):
+        # the sticker is no longer part of the pack
+        with self._lock:
+            if self.stickers.pop(str(sticker_id), None) is not None:
+                self._unsaved += 1
@@ -0,0 +1,173 @@
+"""
+Process-wide counters and latency histograms.
+
+The network and processing layers report into one registry; the CLI prints a
+summary at the end of a run and can export the numbers as JSON or in the
+Prometheus text format:
+
+    metrics.inc("http_requests_total", kind="archive")
+    metrics.observe("operation_seconds", 0.42, op="to_webm")
+    metrics.export("run.prom")
+
+Metrics are identified by name and labels. Histograms keep their samples, which
+is fine for the number of events a run produces.
+"""
+import json
+import math
+import threading
+import time
+
+PROMETHEUS_PREFIX = "sticker_"
+SUMMARY_QUANTILES = (0.5, 0.95)
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def percentile(sorted_samples, q):
+    # nearest-rank percentile of an already sorted list
+    if not sorted_samples:
+        return 0.0
+    rank = max(1, math.ceil(q * len(sorted_samples)))
+    return sorted_samples[rank - 1]
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self.started = time.time()
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._histograms.setdefault(key, []).append(value)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self.started = time.time()
+
+    def snapshot(self):
+        """Return the current values as a JSON-serialisable dict."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: sorted(v) for k, v in self._histograms.items()}
+        return {
+            "started": self.started,
+            "elapsed": time.time() - self.started,
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(counters.items())
+            ],
+            "histograms": [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": len(samples),
+                    "sum": sum(samples),
+                    "p50": percentile(samples, 0.5),
+                    "p95": percentile(samples, 0.95),
+                    "max": samples[-1],
+                }
+                for (name, labels), samples in sorted(histograms.items())
+            ],
+        }
+
+    def to_prometheus(self):
+        # histograms are exported as Prometheus summaries
+        snapshot = self.snapshot()
+        lines = []
+        typed = set()
+        for c in snapshot["counters"]:
+            name = PROMETHEUS_PREFIX + c["name"]
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{_prometheus_labels(c['labels'])} {c['value']}")
+        for h in snapshot["histograms"]:
+            name = PROMETHEUS_PREFIX + h["name"]
+            if name not in typed:
+                lines.append(f"# TYPE {name} summary")
+                typed.add(name)
+            for q in SUMMARY_QUANTILES:
+                labels = dict(h["labels"], quantile=str(q))
+                value = h["p50"] if q == 0.5 else h["p95"]
+                lines.append(f"{name}{_prometheus_labels(labels)} {value}")
+            labels = _prometheus_labels(h["labels"])
+            lines.append(f"{name}_sum{labels} {h['sum']}")
+            lines.append(f"{name}_count{labels} {h['count']}")
+        return "\n".join(lines) + "\n"
+
+    def summary_lines(self):
+        snapshot = self.snapshot()
+        lines = []
+        for c in snapshot["counters"]:
+            lines.append(f"{_display_name(c):<60} {c['value']:>12,}")
+        for h in snapshot["histograms"]:
+            lines.append(
+                f"{_display_name(h):<60} {h['count']:>5}x"
+                f"  p50 {h['p50'] * 1000:9.1f} ms  p95 {h['p95'] * 1000:9.1f} ms"
+            )
+        return lines
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels.items()
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def _display_name(metric):
+    if not metric["labels"]:
+        return metric["name"]
+    labels = ",".join(f"{k}={v}" for k, v in metric["labels"].items())
+    return f"{metric['name']}{{{labels}}}"
+
+
+_registry = Registry()
+
+
+def inc(name, value=1, **labels):
+    _registry.inc(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    _registry.observe(name, value, **labels)
+
+
+def reset():
+    _registry.reset()
+
+
+def snapshot():
+    return _registry.snapshot()
+
+
+def to_prometheus():
+    return _registry.to_prometheus()
+
+
+def summary_lines():
+    return _registry.summary_lines()
+
+
+def export(path):
+    """Write the metrics to path, as JSON for *.json and Prometheus text otherwise."""
+    with open(path, "w", encoding="utf-8") as f:
+        if path.endswith(".json"):
+            json.dump(snapshot(), f, indent=2)
+        else:
+            f.write(to_prometheus())
@@ -0,0 +1,487 @@
+"""
+Local stand-in for the LINE CDN.
+
+Synthetic packs are laid out on disk under the same paths as the URL templates
+in utils, and served over HTTP with optional latency, bandwidth limit and error
+rate. Point the downloader at it with --cdn-base-url (or the LINE_CDN_BASE_URL
+environment variable) to run the whole pipeline offline:
+
+    python mock_cdn.py serve --root mock_root --packs 3 --type ANIMATION
+    python mock_cdn.py bench --packs 5 --type ANIMATION --output-fmt webm
+"""
+import argparse
+import io
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from corpus import CorpusCase, generate_case
+from utils import (
+    EMOJI_SET_META_URL,
+    LINE_CDN_BASE_URL,
+    LINE_CDN_BASE_URL_ENV,
+    MESSAGE_STICKER_OVERLAY_DEFAULT,
+    STICKER_SET_META_URL,
+    STICKER_SOUND_URL,
+    STICKER_URL_TEMPLATES,
+    STICKER_ZIP_TEMPLATES,
+    StickerType,
+    sticker_type_properties,
+)
+
+DEFAULT_STICKER_COUNT = 8
+# first pack id handed out by the bench, sticker ids are derived from it
+FIRST_MOCK_PACK_ID = 9000001
+_CHUNK_SIZE = 16 * 1024
+
+
+def _cdn_path(root, url):
+    # map a CDN url built from a template in utils to a file under root
+    if not url.startswith(LINE_CDN_BASE_URL):
+        raise ValueError(f"Not a CDN url: {url}")
+    path = urllib.parse.urlsplit(url).path.lstrip("/")
+    return os.path.join(root, *path.split("/"))
+
+
+def _write(path, content: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+def _publish(root, url, src_path):
+    dst_path = _cdn_path(root, url)
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    shutil.copyfile(src_path, dst_path)
+
+
+def mock_pack_id(index, is_emoji):
+    if is_emoji:
+        # emoji pack ids are 24 hex digits
+        return f"{FIRST_MOCK_PACK_ID + index:024x}"
+    return str(FIRST_MOCK_PACK_ID + index)
+
+
+def _sticker_case(sticker_type: StickerType, sticker_id, index):
+    has_animation, has_sound, _, has_text_overlay, is_emoji = sticker_type_properties(
+        sticker_type
+    )
+    if is_emoji:
+        width, height = 180, 180
+    elif has_animation:
+        width, height = 320, 270
+    else:
+        width, height = 370, 320
+    return CorpusCase(
+        str(sticker_id),
+        sticker_type,
+        width,
+        height,
+        frames=8 + index % 8 if has_animation else 1,
+        delay_ms=100,
+        alpha="ramp" if index % 2 else "binary",
+        hold=index % 3,
+        sound_sec=1.5 if has_sound else 0.0,
+        overlay=has_text_overlay,
+    )
+
+
+def build_pack(root, pack_id, sticker_type: StickerType, count, seed=0):
+    """
+    Write metadata, pack archive, default overlays and per-sticker files of a
+    synthetic pack under root. Return the metadata.
+    """
+    has_animation, has_sound, has_popup, has_text_overlay, is_emoji = (
+        sticker_type_properties(sticker_type)
+    )
+    title = {"en": f"Mock pack {pack_id}"}
+    author = {"en": "mock_cdn"}
+    if is_emoji:
+        sticker_ids = [f"{i + 1:03d}" for i in range(count)]
+    else:
+        base = int(pack_id) * 100
+        sticker_ids = [base + i for i in range(count)]
+
+    if is_emoji:
+        metadata = {
+            "packageId": pack_id,
+            "title": title,
+            "author": author,
+            "orders": sticker_ids,
+            "sticonResourceType": "ANIMATION" if has_animation else "STATIC",
+        }
+        meta_url = EMOJI_SET_META_URL.format(pack_id=pack_id)
+    else:
+        metadata = {
+            "packageId": int(pack_id),
+            "onSale": True,
+            "title": title,
+            "author": author,
+            "stickers": [{"id": i} for i in sticker_ids],
+            "hasAnimation": has_animation,
+            "hasSound": has_sound,
+        }
+        if sticker_type != StickerType.STATIC_STICKER:
+            metadata["stickerResourceType"] = sticker_type.value
+        meta_url = STICKER_SET_META_URL.format(pack_id=pack_id)
+    metadata_bytes = json.dumps(metadata).encode()
+    _write(_cdn_path(root, meta_url), metadata_bytes)
+
+    scratch = tempfile.mkdtemp(prefix="mock_pack_")
+    try:
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, "w", zipfile.ZIP_STORED) as z:
+            for index, sticker_id in enumerate(sticker_ids):
+                case = _sticker_case(sticker_type, sticker_id, index)
+                img, audio, overlay = generate_case(case, scratch, seed)
+                if is_emoji:
+                    suffix = "_animation" if has_animation else ""
+                    z.write(img, f"{sticker_id}{suffix}.png")
+                else:
+                    z.write(img, f"{sticker_id}@2x.png")
+                    if has_popup:
+                        z.write(img, f"popup/{sticker_id}.png")
+                    elif has_animation:
+                        z.write(img, f"animation@2x/{sticker_id}@2x.png")
+                    if audio:
+                        z.write(audio, f"sound/{sticker_id}.m4a")
+                if overlay:
+                    _publish(
+                        root,
+                        MESSAGE_STICKER_OVERLAY_DEFAULT.format(
+                            pack_id=pack_id, sticker_id=sticker_id
+                        ),
+                        overlay,
+                    )
+                if sticker_type in STICKER_URL_TEMPLATES:
+                    _publish(
+                        root,
+                        STICKER_URL_TEMPLATES[sticker_type].format(
+                            pack_id=pack_id, sticker_id=sticker_id
+                        ),
+                        img,
+                    )
+                    if has_animation and not is_emoji:
+                        _publish(
+                            root,
+                            STICKER_URL_TEMPLATES[StickerType.STATIC_STICKER].format(
+                                sticker_id=sticker_id
+                            ),
+                            img,
+                        )
+                    if audio:
+                        _publish(
+                            root, STICKER_SOUND_URL.format(sticker_id=sticker_id), audio
+                        )
+                if index == 0 and not is_emoji:
+                    z.write(img, "tab_on@2x.png")
+            z.writestr("meta.json" if is_emoji else "productInfo.meta", metadata_bytes)
+        _write(
+            _cdn_path(
+                root, STICKER_ZIP_TEMPLATES[sticker_type].format(pack_id=pack_id)
+            ),
+            archive.getvalue(),
+        )
+    finally:
+        shutil.rmtree(scratch)
+    return metadata
+
+
+class _MockCDNHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def _serve(self, send_body):
+        server: MockCDNServer = self.server
+        server.record("requests")
+        server.record_request(self.command, self.path)
+        if server.latency:
+            time.sleep(server.latency)
+        if server.should_fail():
+            server.record("errors")
+            self.send_error(503, "Injected error")
+            return
+        path = urllib.parse.urlsplit(self.path).path.lstrip("/")
+        fs_path = os.path.realpath(os.path.join(server.root, *path.split("/")))
+        if not fs_path.startswith(server.root + os.sep) or not os.path.isfile(
+            fs_path
+        ):
+            self.send_error(404)
+            return
+        stat = os.stat(fs_path)
+        self.send_response(200)
+        self.send_header("Content-Length", str(stat.st_size))
+        self.send_header(
+            "Content-Type",
+            "application/zip"
+            if fs_path.endswith(".zip")
+            else "application/octet-stream",
+        )
+        self.send_header("ETag", f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"')
+        self.end_headers()
+        if not send_body:
+            return
+        with open(fs_path, "rb") as f:
+            while chunk := f.read(_CHUNK_SIZE):
+                self.wfile.write(chunk)
+                server.record("bytes_sent", len(chunk))
+                if server.bandwidth:
+                    time.sleep(len(chunk) / server.bandwidth)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockCDNServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        root,
+        host="127.0.0.1",
+        port=0,
+        latency=0.0,
+        bandwidth=0,
+        error_rate=0.0,
+        seed=0,
+    ):
+        super().__init__((host, port), _MockCDNHandler)
+        self.root = os.path.realpath(root)
+        # seconds added before every response
+        self.latency = latency
+        # bytes per second per connection, 0 for unlimited
+        self.bandwidth = bandwidth
+        # share of requests answered with 503
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "errors": 0, "bytes_sent": 0}
+        # (method, path) of every request, in order
+        self.requests = []
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def should_fail(self):
+        if not self.error_rate:
+            return False
+        with self._lock:
+            return self._rng.random() < self.error_rate
+
+    def record(self, key, value=1):
+        with self._lock:
+            self.stats[key] += value
+
+    def record_request(self, method, path):
+        with self._lock:
+            self.requests.append((method, path))
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.serve_forever, name="MockCDNServer", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def _wait_first_output(proc, out_dir, start):
+    first_output = None
+    while proc.poll() is None:
+        if first_output is None and _has_output(out_dir):
+            first_output = time.perf_counter() - start
+        time.sleep(0.01)
+    if first_output is None and _has_output(out_dir):
+        first_output = time.perf_counter() - start
+    return first_output
+
+
+def _has_output(out_dir):
+    for _, _, files in os.walk(out_dir):
+        if files:
+            return True
+    return False
+
+
+def run_e2e_benchmark(
+    base_url, pack_ids, pack_type, output_fmt, work_dir, extra_args=()
+):
+    """Run downloader.py once per pack against base_url, return per-pack timings."""
+    downloader_path = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "downloader.py"
+    )
+    env = dict(os.environ)
+    env[LINE_CDN_BASE_URL_ENV] = base_url
+    runs = []
+    for pack_id in pack_ids:
+        # start from a cold download cache every time
+        shutil.rmtree(os.path.join(work_dir, "sticker_dl"), ignore_errors=True)
+        out_dir = os.path.join(work_dir, "out", pack_id)
+        os.makedirs(out_dir, exist_ok=True)
+        start = time.perf_counter()
+        proc = subprocess.Popen(
+            [
+                sys.executable,
+                downloader_path,
+                pack_id,
+                "--type",
+                pack_type,
+                "-y",
+                "-q",
+                "--output-fmt",
+                output_fmt,
+                "-o",
+                out_dir,
+                *extra_args,
+            ],
+            cwd=work_dir,
+            env=env,
+        )
+        first_output = _wait_first_output(proc, out_dir, start)
+        runs.append(
+            {
+                "pack_id": pack_id,
+                "seconds": time.perf_counter() - start,
+                "time_to_first_output": first_output,
+                "returncode": proc.returncode,
+            }
+        )
+    return runs
+
+
+def summarize_runs(runs):
+    seconds = [r["seconds"] for r in runs]
+    first = [r["time_to_first_output"] for r in runs if r["time_to_first_output"]]
+    total = sum(seconds)
+    return {
+        "packs": len(runs),
+        "failed": sum(1 for r in runs if r["returncode"]),
+        "total_seconds": total,
+        "packs_per_minute": len(runs) / total * 60 if total else 0,
+        "latency_p50": statistics.median(seconds) if seconds else 0,
+        "latency_max": max(seconds, default=0),
+        "time_to_first_output_p50": statistics.median(first) if first else None,
+    }
+
+
+def _parse_bytes(value: str):
+    units = {"k": 1024, "m": 1024 * 1024, "g": 1024 * 1024 * 1024}
+    value = value.strip().lower()
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def _build_packs(root, sticker_type, packs, stickers):
+    is_emoji = sticker_type_properties(sticker_type)[4]
+    pack_ids = []
+    for i in range(packs):
+        pack_id = mock_pack_id(i, is_emoji)
+        build_pack(root, pack_id, sticker_type, stickers, seed=i)
+        pack_ids.append(pack_id)
+    return pack_ids
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Local mock of the LINE CDN")
+    sub = arg_parser.add_subparsers(dest="command", required=True)
+    for name in ("serve", "bench"):
+        p = sub.add_parser(name)
+        p.add_argument("--root", type=str, help="Directory holding the mock CDN files")
+        p.add_argument("--packs", type=int, default=1, help="Synthetic packs to build")
+        p.add_argument(
+            "--type",
+            type=str,
+            default=StickerType.ANIMATED_STICKER.value,
+            choices=[t.value for t in StickerType],
+            help="Sticker type of the synthetic packs",
+        )
+        p.add_argument(
+            "--stickers",
+            type=int,
+            default=DEFAULT_STICKER_COUNT,
+            help="Stickers per synthetic pack",
+        )
+        p.add_argument(
+            "--latency", type=float, default=0.0, help="Seconds per response"
+        )
+        p.add_argument(
+            "--bandwidth", type=str, default="0", help="Bytes/s per connection, e.g. 2M"
+        )
+        p.add_argument(
+            "--error-rate",
+            type=float,
+            default=0.0,
+            help="Share of requests failing with 503",
+        )
+        p.add_argument("--seed", type=int, default=0)
+    sub.choices["serve"].add_argument("--port", type=int, default=8765)
+    bench = sub.choices["bench"]
+    bench.add_argument("--output-fmt", type=str, default="none")
+    bench.add_argument("--out", type=str, help="Write the summary to this JSON file")
+    args = arg_parser.parse_args()
+
+    sticker_type = StickerType(args.type)
+    root = args.root or tempfile.mkdtemp(prefix="mock_cdn_")
+    pack_ids = _build_packs(root, sticker_type, args.packs, args.stickers)
+    server = MockCDNServer(
+        root,
+        port=getattr(args, "port", 0),
+        latency=args.latency,
+        bandwidth=_parse_bytes(args.bandwidth),
+        error_rate=args.error_rate,
+        seed=args.seed,
+    ).start()
+    pack_type = "emoji" if sticker_type_properties(sticker_type)[4] else "sticker"
+    try:
+        if args.command == "serve":
+            print("Serving", root, "at", server.base_url)
+            print("Packs:", ", ".join(pack_ids))
+            print(
+                f"Try: python downloader.py {pack_ids[0]} --type {pack_type}"
+                f" --cdn-base-url {server.base_url}"
+            )
+            while True:
+                time.sleep(3600)
+        work_dir = tempfile.mkdtemp(prefix="mock_cdn_bench_")
+        try:
+            runs = run_e2e_benchmark(
+                server.base_url, pack_ids, pack_type, args.output_fmt, work_dir
+            )
+        finally:
+            shutil.rmtree(work_dir)
+        summary = summarize_runs(runs)
+        summary["server"] = dict(server.stats)
+        print(json.dumps(summary, indent=2))
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                json.dump({"summary": summary, "runs": runs}, f, indent=2)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        if not args.root:
+            shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,406 @@
+"""
+Local stand-in for an S3-compatible bucket, for testing s3:// output offline.
+
+Objects are kept in memory. The server speaks the subset of the S3 REST API
+(path-style addressing) that sinks.S3Sink and a quick check need: buckets,
+PUT/HEAD/GET/DELETE of objects with x-amz-meta-* metadata, multipart uploads
+and ListObjectsV2. Signatures are not checked. Like mock_cdn.py it can inject
+latency and errors to exercise the client's retries:
+
+    python mock_s3.py --port 9000 --bucket stickers
+    python downloader.py 11537 --output-fmt webm \\
+        --output-archive s3://stickers/packs --s3-endpoint-url http://127.0.0.1:9000
+
+AWS credentials are still required by boto3, any values do.
+"""
+import argparse
+import hashlib
+import random
+import re
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+DEFAULT_PORT = 9000
+_S3_XMLNS = "http://s3.amazonaws.com/doc/2006-03-01/"
+_PART_NUMBER_REGEX = re.compile(r"<PartNumber>(\d+)</PartNumber>")
+
+
+class S3Object:
+    def __init__(self, data: bytes, etag, metadata, content_type):
+        self.data = data
+        # MD5 hex, or MD5 of the part MD5s plus "-<parts>" for multipart uploads
+        self.etag = etag
+        self.metadata = metadata
+        self.content_type = content_type
+        self.modified = time.time()
+
+
+def _xml(body):
+    return f'<?xml version="1.0" encoding="UTF-8"?>\n{body}'.encode()
+
+
+def _metadata(headers):
+    # x-amz-meta-<name> headers, as boto3's Metadata
+    return {
+        name[len("x-amz-meta-") :].lower(): value
+        for name, value in headers.items()
+        if name.lower().startswith("x-amz-meta-")
+    }
+
+
+def _decode_aws_chunked(body: bytes):
+    # <hex size>[;chunk-signature=...]\r\n<data>\r\n ... 0\r\n<trailers>\r\n
+    data, pos = [], 0
+    while True:
+        end = body.index(b"\r\n", pos)
+        size = int(body[pos:end].split(b";")[0], 16)
+        if size == 0:
+            return b"".join(data)
+        data.append(body[end + 2 : end + 2 + size])
+        pos = end + 2 + size + 2
+
+
+class _MockS3Handler(BaseHTTPRequestHandler):
+    # keep-alive and Expect: 100-continue, as botocore uses them
+    protocol_version = "HTTP/1.1"
+
+    def _parse(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query, keep_blank_values=True)
+        bucket, _, key = urllib.parse.unquote(url.path).lstrip("/").partition("/")
+        return bucket, key, query
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    # trailers up to the empty line
+                    while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = b"".join(chunks)
+        else:
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if "aws-chunked" in self.headers.get("Content-Encoding", ""):
+            body = _decode_aws_chunked(body)
+        return body
+
+    def _send(self, status, body=b"", headers=None, send_body=True):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if send_body and body:
+            self.wfile.write(body)
+
+    def _error(self, status, code, send_body=True):
+        body = _xml(f"<Error><Code>{code}</Code><Message>{code}</Message></Error>")
+        self._send(status, body, {"Content-Type": "application/xml"}, send_body)
+
+    def _begin(self, method):
+        # shared by all methods: stats, latency and injected errors; returns
+        # the request body, or None if an error was sent
+        server: MockS3Server = self.server
+        server.record("requests")
+        server.record(method)
+        body = self._read_body() if method in ("PUT", "POST") else b""
+        if server.latency:
+            time.sleep(server.latency)
+        if server.should_fail():
+            server.record("errors")
+            self._error(503, "SlowDown", send_body=method != "HEAD")
+            return None
+        return body
+
+    def do_PUT(self):
+        server: MockS3Server = self.server
+        body = self._begin("PUT")
+        if body is None:
+            return
+        bucket, key, query = self._parse()
+        if not key:
+            server.create_bucket(bucket)
+            self._send(200)
+            return
+        if bucket not in server.buckets:
+            self._error(404, "NoSuchBucket")
+            return
+        etag = hashlib.md5(body).hexdigest()
+        if "uploadId" in query:
+            upload = server.uploads.get(query["uploadId"][0])
+            if upload is None:
+                self._error(404, "NoSuchUpload")
+                return
+            upload["parts"][int(query["partNumber"][0])] = body
+        else:
+            content_type = self.headers.get("Content-Type", "binary/octet-stream")
+            obj = S3Object(body, etag, _metadata(self.headers), content_type)
+            server.put(bucket, key, obj)
+            server.record("bytes_received", len(body))
+        self._send(200, headers={"ETag": f'"{etag}"'})
+
+    def do_POST(self):
+        server: MockS3Server = self.server
+        body = self._begin("POST")
+        if body is None:
+            return
+        bucket, key, query = self._parse()
+        if bucket not in server.buckets:
+            self._error(404, "NoSuchBucket")
+            return
+        if "uploads" in query:
+            upload_id = uuid.uuid4().hex
+            server.uploads[upload_id] = {
+                "bucket": bucket,
+                "key": key,
+                "parts": {},
+                "metadata": _metadata(self.headers),
+                "content_type": self.headers.get(
+                    "Content-Type", "binary/octet-stream"
+                ),
+            }
+            self._send(
+                200,
+                _xml(
+                    f'<InitiateMultipartUploadResult xmlns="{_S3_XMLNS}">'
+                    f"<Bucket>{escape(bucket)}</Bucket><Key>{escape(key)}</Key>"
+                    f"<UploadId>{upload_id}</UploadId>"
+                    "</InitiateMultipartUploadResult>"
+                ),
+                {"Content-Type": "application/xml"},
+            )
+        elif "uploadId" in query:
+            upload = server.uploads.pop(query["uploadId"][0], None)
+            if upload is None:
+                self._error(404, "NoSuchUpload")
+                return
+            numbers = [int(n) for n in _PART_NUMBER_REGEX.findall(body.decode())]
+            try:
+                parts = [upload["parts"][n] for n in numbers]
+            except KeyError:
+                self._error(400, "InvalidPart")
+                return
+            digests = b"".join(hashlib.md5(p).digest() for p in parts)
+            etag = f"{hashlib.md5(digests).hexdigest()}-{len(parts)}"
+            data = b"".join(parts)
+            server.put(
+                bucket,
+                key,
+                S3Object(data, etag, upload["metadata"], upload["content_type"]),
+            )
+            server.record("bytes_received", len(data))
+            server.record("multipart_uploads")
+            self._send(
+                200,
+                _xml(
+                    f'<CompleteMultipartUploadResult xmlns="{_S3_XMLNS}">'
+                    f"<Bucket>{escape(bucket)}</Bucket><Key>{escape(key)}</Key>"
+                    f"<ETag>&quot;{etag}&quot;</ETag>"
+                    "</CompleteMultipartUploadResult>"
+                ),
+                {"Content-Type": "application/xml"},
+            )
+        else:
+            self._error(400, "InvalidRequest")
+
+    def do_HEAD(self):
+        self._get(send_body=False)
+
+    def do_GET(self):
+        self._get(send_body=True)
+
+    def _get(self, send_body):
+        server: MockS3Server = self.server
+        if self._begin("HEAD" if not send_body else "GET") is None:
+            return
+        bucket, key, query = self._parse()
+        if bucket not in server.buckets:
+            self._error(404, "NoSuchBucket", send_body)
+            return
+        if not key:
+            if send_body:
+                self._list(bucket, query)
+            else:
+                self._send(200)
+            return
+        obj = server.get(bucket, key)
+        if obj is None:
+            self._error(404, "NoSuchKey", send_body)
+            return
+        headers = {
+            "ETag": f'"{obj.etag}"',
+            "Content-Type": obj.content_type,
+            "Last-Modified": time.strftime(
+                "%a, %d %b %Y %H:%M:%S GMT", time.gmtime(obj.modified)
+            ),
+        }
+        for name, value in obj.metadata.items():
+            headers[f"x-amz-meta-{name}"] = value
+        if send_body:
+            self._send(200, obj.data, headers)
+            return
+        # HEAD: the length of the object, without a body
+        self.send_response(200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(obj.data)))
+        self.end_headers()
+
+    def _list(self, bucket, query):
+        # ListObjectsV2 without pagination
+        server: MockS3Server = self.server
+        prefix = query.get("prefix", [""])[0]
+        contents = "".join(
+            f"<Contents><Key>{escape(key)}</Key><Size>{len(obj.data)}</Size>"
+            f"<ETag>&quot;{obj.etag}&quot;</ETag></Contents>"
+            for key, obj in server.list(bucket, prefix)
+        )
+        self._send(
+            200,
+            _xml(
+                f'<ListBucketResult xmlns="{_S3_XMLNS}">'
+                f"<Name>{escape(bucket)}</Name><Prefix>{escape(prefix)}</Prefix>"
+                f"<IsTruncated>false</IsTruncated>{contents}</ListBucketResult>"
+            ),
+            {"Content-Type": "application/xml"},
+        )
+
+    def do_DELETE(self):
+        server: MockS3Server = self.server
+        if self._begin("DELETE") is None:
+            return
+        bucket, key, query = self._parse()
+        if "uploadId" in query:
+            server.uploads.pop(query["uploadId"][0], None)
+        else:
+            server.delete(bucket, key)
+        self._send(204)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockS3Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self, host="127.0.0.1", port=0, latency=0.0, error_rate=0.0, seed=0
+    ):
+        super().__init__((host, port), _MockS3Handler)
+        # seconds added before every response
+        self.latency = latency
+        # share of requests answered with 503 SlowDown
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.buckets = {}
+        # upload id -> bucket, key, parts received and object attributes
+        self.uploads = {}
+        self.stats = {
+            "requests": 0,
+            "errors": 0,
+            "bytes_received": 0,
+            "multipart_uploads": 0,
+            "PUT": 0,
+            "POST": 0,
+            "HEAD": 0,
+            "GET": 0,
+            "DELETE": 0,
+        }
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def should_fail(self):
+        if not self.error_rate:
+            return False
+        with self._lock:
+            return self._rng.random() < self.error_rate
+
+    def record(self, key, value=1):
+        with self._lock:
+            self.stats[key] += value
+
+    def create_bucket(self, bucket):
+        with self._lock:
+            self.buckets.setdefault(bucket, {})
+
+    def put(self, bucket, key, obj: S3Object):
+        with self._lock:
+            self.buckets[bucket][key] = obj
+
+    def get(self, bucket, key):
+        with self._lock:
+            return self.buckets.get(bucket, {}).get(key)
+
+    def delete(self, bucket, key):
+        with self._lock:
+            self.buckets.get(bucket, {}).pop(key, None)
+
+    def list(self, bucket, prefix=""):
+        with self._lock:
+            objects = self.buckets.get(bucket, {})
+            return sorted((k, o) for k, o in objects.items() if k.startswith(prefix))
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.serve_forever, name="MockS3Server", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Local mock of an S3 bucket")
+    arg_parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    arg_parser.add_argument(
+        "--bucket", type=str, action="append", help="Bucket to create, repeatable"
+    )
+    arg_parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds per response"
+    )
+    arg_parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="Share of requests failing with 503",
+    )
+    arg_parser.add_argument("--seed", type=int, default=0)
+    args = arg_parser.parse_args()
+
+    server = MockS3Server(
+        port=args.port,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+    for bucket in args.bucket or ["stickers"]:
+        server.create_bucket(bucket)
+    print("Serving buckets", ", ".join(server.buckets), "at", server.base_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(server.stats)
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1031 @@
+"""
+Embeddable download/convert pipeline.
+
+A Pipeline owns the worker pools and caches and can be reused for any number
+of packs, from the CLI or from a long-running process:
+
+    with Pipeline(threads=8) as pipeline:
+        result = pipeline.run("11537", PackOptions(output_fmt="webm"))
+        print(result.output_dir, result.done_count, result.failed_count)
+"""
+import json
+import os
+import queue
+import re
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
+from threading import Event, Lock, Semaphore
+
+import metrics
+import tracing
+import tuning
+import webreq
+from manifest import PackManifest, describe_chain, hash_files
+from sinks import open_sink
+from utils import (
+    MESSAGE_STICKER_OVERLAY_DEFAULT,
+    Operation,
+    OutputFormat,
+    PackNotFoundException,
+    STICKER_SET_URL_REGEX,
+    SourceUrlType,
+    StickerType,
+    sticker_type_properties,
+)
+
+DEFAULT_PROCESS_THREADS = 8
+DEFAULT_DOWNLOAD_THREADS = 4
+# emoji are processed in batches of up to this many per ffmpeg/magick spawn
+EMOJI_BATCH_SIZE = 16
+# seconds one processing operation may run, and retries after it timed out;
+# same as processing.DEFAULT_OPERATION_*, which is not imported for raw runs
+DEFAULT_TASK_TIMEOUT = 300
+DEFAULT_TASK_RETRIES = 1
+# seconds resolved metadata and yabe ids are reused from memory; after that
+# the catalog (refreshed after catalog.CATALOG_MAX_AGE) or the network is asked.
+# Packs whose archive is downloaded always get their metadata from the network
+CACHE_TTL = 3600
+
+OUTPUT_FORMATS = {
+    "png": OutputFormat.APNG,
+    "gif": OutputFormat.GIF,
+    "webm": OutputFormat.WEBM,
+    "mp4": OutputFormat.MP4,
+    "webp": OutputFormat.WEBP,
+    # older name of "mp4"
+    "video": OutputFormat.MP4,
+    "none": OutputFormat.RAW,
+}
+
+STICKER_DONE = "done"
+STICKER_FAILED = "failed"
+STICKER_SKIPPED = "skipped"
+
+
+class PipelineError(Exception):
+    pass
+
+
+@contextmanager
+def _download_errors():
+    # failed requests and broken archives surface as PipelineError
+    try:
+        yield
+    except zipfile.BadZipFile as e:
+        raise PipelineError(f"ERROR: Sticker pack archive is corrupt: {e}") from e
+    except Exception as e:
+        # requests is only imported once something was downloaded
+        requests = sys.modules.get("requests")
+        if requests is None or not isinstance(e, requests.RequestException):
+            raise
+        raise PipelineError(f"ERROR: Download failed: {e}") from e
+
+
+class PackOptions:
+    def __init__(
+        self,
+        pack_type="sticker",
+        lang="zh-Hant",
+        output_fmt="none",
+        scale=False,
+        remove_alpha=False,
+        extra_params: dict | None = None,
+        no_default_txt_overlay=False,
+        no_sub_dir=False,
+        redownload=False,
+        reprocess=False,
+        update=False,
+        optimize_png=False,
+        output_dir=None,
+        output_archive=None,
+        archive_compression="auto",
+        task_timeout=DEFAULT_TASK_TIMEOUT,
+        task_retries=DEFAULT_TASK_RETRIES,
+    ):
+        # "sticker" or "emoji", only used when a bare pack id is given
+        self.pack_type = pack_type
+        self.lang = lang
+        # one of OUTPUT_FORMATS
+        self.output_fmt = output_fmt
+        # scale static stickers to 512*512
+        self.scale = scale
+        self.remove_alpha = remove_alpha
+        self.extra_params = extra_params or {}
+        self.no_default_txt_overlay = no_default_txt_overlay
+        self.no_sub_dir = no_sub_dir
+        self.redownload = redownload
+        self.reprocess = reprocess
+        # compare fresh metadata with the local archive and fetch only the
+        # stickers that changed, see update.py
+        self.update = update
+        # recompress static PNG output losslessly, and quantize it if the
+        # PNG_QUALITY extra param allows, see pngopt.py; animated PNG output
+        # is rewritten with frame differences, see apngopt.py
+        self.optimize_png = optimize_png
+        # overrides the output root of the Pipeline
+        self.output_dir = output_dir
+        # stream results into this zip/tar file ("-" for stdout) or upload them
+        # to an s3://bucket/prefix instead of writing the output directory, see
+        # sinks.open_sink
+        self.output_archive = output_archive
+        # one of sinks.ARCHIVE_COMPRESSION_CHOICES
+        self.archive_compression = archive_compression
+        # a processing operation running longer is killed and retried up to
+        # task_retries times; the sticker fails once retries are used up
+        self.task_timeout = task_timeout
+        self.task_retries = task_retries
+
+
+class PackPlan:
+    """Everything known about a pack before any sticker is downloaded or processed."""
+
+    def __init__(self, pack_id, is_emoji, metadata, pack_info, local_archive):
+        self.pack_id = pack_id
+        self.metadata = metadata
+        self.title = pack_info["title"]
+        self.author = pack_info["author_name"]
+        self.sticker_type = StickerType(pack_info["sticker_type"])
+        self.sticker_ids = pack_info["stickers"]
+        (
+            self.has_animation,
+            self.has_sound,
+            self.has_popup,
+            self.has_text_overlay,
+            self.is_emoji,
+        ) = sticker_type_properties(self.sticker_type)
+        # archive is already in the download directory
+        self.local_archive = local_archive
+        self.output_format = OutputFormat.RAW
+        self.scale_px = 0
+        self.download_dir = ""
+        self.output_root = ""
+        self.output_dir = ""
+        # update.PackUpdate of an --update run that patched the local archive
+        self.update = None
+
+    @property
+    def archive_path(self):
+        return os.path.join(self.download_dir, "pack.zip")
+
+
+class StickerResult:
+    def __init__(self, sticker_id, status, output_path=None, error=None):
+        self.sticker_id = sticker_id
+        # STICKER_DONE, STICKER_FAILED or STICKER_SKIPPED (already up to date)
+        self.status = status
+        self.output_path = output_path
+        self.error = error
+
+
+class PackResult:
+    def __init__(self, plan: PackPlan, aborted=False):
+        self.plan = plan
+        self.pack_id = plan.pack_id
+        self.title = plan.title
+        self.output_dir = plan.output_dir
+        # the confirm callback declined to continue
+        self.aborted = aborted
+        self.stickers: list[StickerResult] = []
+        self.elapsed = 0.0
+        # output bytes saved by --optimize-png
+        self.png_bytes_saved = 0
+
+    def _count(self, status):
+        return sum(1 for s in self.stickers if s.status == status)
+
+    @property
+    def done_count(self):
+        return self._count(STICKER_DONE)
+
+    @property
+    def failed_count(self):
+        return self._count(STICKER_FAILED)
+
+    @property
+    def skipped_count(self):
+        return self._count(STICKER_SKIPPED)
+
+    def to_dict(self):
+        return {
+            "pack_id": self.pack_id,
+            "title": self.title,
+            "sticker_type": self.plan.sticker_type.value,
+            "output_format": self.plan.output_format.value,
+            "output_dir": self.output_dir,
+            "aborted": self.aborted,
+            "elapsed": self.elapsed,
+            "png_bytes_saved": self.png_bytes_saved,
+            "update": self.plan.update.to_dict() if self.plan.update else None,
+            "stickers": [
+                {
+                    "sticker_id": s.sticker_id,
+                    "status": s.status,
+                    "output_path": s.output_path,
+                    "error": repr(s.error) if s.error is not None else None,
+                }
+                for s in self.stickers
+            ],
+        }
+
+
+class Pipeline:
+    def __init__(
+        self,
+        data_dir=None,
+        output_dir=None,
+        threads=DEFAULT_PROCESS_THREADS,
+        download_threads=DEFAULT_DOWNLOAD_THREADS,
+        proxy=None,
+        temp_root=None,
+        log=None,
+        catalog=None,
+        cache_ttl=CACHE_TTL,
+    ):
+        self.data_dir = data_dir or os.path.join(os.getcwd(), "sticker_dl")
+        self.output_dir = output_dir or os.path.join(os.getcwd(), "sticker_out")
+        self.temp_root = temp_root
+        self.log = log or (lambda *args, **kwargs: None)
+        # catalog.Catalog checked before resolving packs over the network
+        self.catalog = catalog
+        if proxy:
+            webreq.set_proxy({"https": proxy})
+        # tuning.AUTO picks the concurrency per pack, the pools are then sized
+        # for the maximum and runs are throttled below that
+        self.threads = threads
+        self.download_threads = download_threads
+        self._process_pool = ThreadPoolExecutor(
+            tuning.MAX_PROCESS_THREADS if threads == tuning.AUTO else threads,
+            thread_name_prefix="ImageProcessor",
+        )
+        self._download_pool = ThreadPoolExecutor(
+            (
+                tuning.MAX_DOWNLOAD_THREADS
+                if download_threads == tuning.AUTO
+                else download_threads
+            ),
+            thread_name_prefix="Download",
+        )
+        self._cache_lock = Lock()
+        # runs of the same pack share download and output directories
+        self._pack_locks = {}
+        # key -> (expiry time.monotonic(), value)
+        self.cache_ttl = cache_ttl
+        self._metadata_cache = {}
+        self._yabe_id_cache = {}
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def close(self):
+        # safe to call more than once; running calls finish their current stickers
+        if self._closed:
+            return
+        self._closed = True
+        self._process_pool.shutdown(wait=True, cancel_futures=True)
+        self._download_pool.shutdown(wait=True, cancel_futures=True)
+
+    def resolve_pack_id(self, id_url, pack_type="sticker"):
+        """Return (pack_id, is_emoji) for a pack id or a store URL."""
+        id_url = id_url.strip()
+        if "http" not in id_url:
+            is_emoji = pack_type == "emoji"
+            if not is_emoji and len(id_url) >= 24:
+                self.log(
+                    "WARNING: You probably want to download an emoji pack, but the sticker type is not specified as emoji."
+                )
+            return id_url, is_emoji
+        for _type, (_regex, _emoji_flag) in STICKER_SET_URL_REGEX.items():
+            match = _regex.match(id_url)
+            if match:
+                self.log(f"URL is matched as: {_type}")
+                pack_id = match.group(1)
+                if _type == SourceUrlType.YABE_EMOJI:
+                    # special processing to get real pack id
+                    pack_id = self._get_real_pack_id_from_yabe_emoji(pack_id)
+                return pack_id, _emoji_flag
+        raise PipelineError(
+            "URL is not matched as any known source! Please double check the url"
+        )
+
+    def _get_real_pack_id_from_yabe_emoji(self, yabe_id):
+        with self._cache_lock:
+            found, pack_id = self._cached(self._yabe_id_cache, yabe_id)
+        if found:
+            metrics.inc("cache_total", cache="yabe_id", result="hit")
+            return pack_id
+        pack_id = self.catalog.yabe_pack_id(yabe_id) if self.catalog else None
+        if pack_id is not None:
+            metrics.inc("cache_total", cache="yabe_id", result="catalog")
+        else:
+            metrics.inc("cache_total", cache="yabe_id", result="miss")
+            pack_id = webreq.get_real_pack_id_from_yabe_emoji(yabe_id)
+            if self.catalog:
+                self.catalog.add_yabe(yabe_id, pack_id)
+        with self._cache_lock:
+            self._yabe_id_cache[yabe_id] = (time.monotonic() + self.cache_ttl, pack_id)
+        return pack_id
+
+    @staticmethod
+    def _cached(cache, key):
+        # (found, value); call with _cache_lock held, drops an expired entry
+        entry = cache.get(key)
+        if entry is None:
+            return False, None
+        if time.monotonic() >= entry[0]:
+            del cache[key]
+            return False, None
+        return True, entry[1]
+
+    def _pack_lock(self, pack_id):
+        with self._cache_lock:
+            return self._pack_locks.setdefault(pack_id, Lock())
+
+    def get_metadata(self, pack_id, is_emoji, refresh=False):
+        key = (pack_id, is_emoji)
+        found = False
+        if not refresh:
+            with self._cache_lock:
+                found, metadata = self._cached(self._metadata_cache, key)
+        if found:
+            metrics.inc("cache_total", cache="metadata", result="hit")
+            return metadata
+        metadata = None
+        if self.catalog and not refresh:
+            from catalog import CATALOG_MAX_AGE
+
+            metadata = self.catalog.metadata(pack_id, is_emoji, CATALOG_MAX_AGE)
+        if metadata is not None:
+            metrics.inc("cache_total", cache="metadata", result="catalog")
+        else:
+            metrics.inc("cache_total", cache="metadata", result="miss")
+            with tracing.span("get_metadata", pack_id=pack_id):
+                metadata = webreq.get_metadata(pack_id, is_emoji)
+            if self.catalog:
+                self.catalog.add_metadata(pack_id, is_emoji, metadata)
+        with self._cache_lock:
+            self._metadata_cache[key] = (time.monotonic() + self.cache_ttl, metadata)
+        return metadata
+
+    def plan(self, id_url, options: PackOptions) -> PackPlan:
+        pack_id, is_emoji = self.resolve_pack_id(id_url, options.pack_type)
+        download_dir = os.path.join(self.data_dir, pack_id)
+        archive_path = os.path.join(download_dir, "pack.zip")
+        local_archive = os.path.isfile(archive_path) and not options.redownload
+        metrics.inc(
+            "cache_total", cache="archive", result="hit" if local_archive else "miss"
+        )
+        metadata = None
+        if local_archive and not options.update:
+            try:
+                with zipfile.ZipFile(archive_path, "r") as archive:
+                    metadata = json.loads(
+                        archive.read("meta.json" if is_emoji else "productInfo.meta")
+                    )
+                self.log(f"Found local archive for pack {pack_id}!")
+            except zipfile.BadZipFile:
+                self.log(f"WARNING: Local archive of pack {pack_id} is corrupt")
+                os.remove(archive_path)
+                local_archive = False
+        if metadata is None:
+            # the archive is about to be downloaded (or updated): plan it from
+            # fresh metadata, so that the sticker ids and types match it
+            try:
+                metadata = self.get_metadata(pack_id, is_emoji, refresh=True)
+            except PackNotFoundException:
+                raise PipelineError(
+                    f'ERROR: Cannot find sticker set {pack_id} with type "{options.pack_type}"!'
+                )
+        pack_info = extract_pack_info_from_metadata(
+            metadata, pack_id, options.lang, is_emoji
+        )
+        plan = PackPlan(pack_id, is_emoji, metadata, pack_info, local_archive)
+        plan.download_dir = download_dir
+
+        if options.output_fmt not in OUTPUT_FORMATS:
+            raise PipelineError(f"FAILED: Invalid output format {options.output_fmt}!")
+        plan.output_format = OUTPUT_FORMATS[options.output_fmt]
+        if options.scale and not plan.has_animation:
+            plan.scale_px = 512
+        elif options.output_fmt == "webm":
+            plan.scale_px = 100 if plan.is_emoji else 512
+
+        plan.output_root = options.output_dir or self.output_dir
+        sanitized_title = "_".join(re.sub(r'[/:*?"<>|]', "", plan.title).split())
+        plan.output_dir = os.path.join(
+            plan.output_root, f"{sanitized_title}({pack_id})"
+        )
+        if not options.no_sub_dir:
+            plan.output_dir = os.path.join(
+                plan.output_dir, f"{plan.output_format.value}"
+            )
+        if plan.output_format != OutputFormat.RAW:
+            if plan.scale_px:
+                plan.output_dir += f"_scale_{plan.scale_px}"
+            if not plan.has_animation and plan.output_format not in [
+                OutputFormat.APNG,
+                OutputFormat.GIF,
+                OutputFormat.WEBP,
+            ]:
+                raise PipelineError(
+                    "ERROR: Sticker pack does not have animation, only PNG, GIF and WebP output are supported!"
+                )
+        return plan
+
+    def run(self, id_url, options: PackOptions = None, confirm=None, progress=None):
+        """
+        Download and convert one pack, return a PackResult.
+
+        confirm(plan) is called once the pack is known and may return False to
+        abort before anything is downloaded. progress(stage, done, total) is
+        called from the calling thread as stickers complete.
+        """
+        if self._closed:
+            raise PipelineError("Pipeline is closed")
+        options = options or PackOptions()
+        start = time.perf_counter()
+        with _download_errors():
+            plan = self.plan(id_url, options)
+        if confirm and not confirm(plan):
+            return PackResult(plan, aborted=True)
+        with self._pack_lock(plan.pack_id), _download_errors():
+            if options.update and plan.local_archive:
+                self._update_archive(plan)
+            temp_dir = tempfile.mkdtemp(prefix="sticker_", dir=self.temp_root)
+            try:
+                with open_sink(
+                    plan.output_root,
+                    options.output_archive,
+                    options.archive_compression,
+                ) as sink:
+                    result = self._run_plan(plan, options, temp_dir, sink, progress)
+            finally:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+        result.elapsed = time.perf_counter() - start
+        return result
+
+    def analyze(self, id_url, options: PackOptions = None):
+        """
+        Download the pack archive if needed and return its analyze.PackAnalysis,
+        without processing anything.
+        """
+        from analyze import analyze_archive
+
+        options = options or PackOptions()
+        with _download_errors():
+            plan = self.plan(id_url, options)
+        with self._pack_lock(plan.pack_id), _download_errors():
+            self._download_archive(plan)
+            with tracing.span("analyze", pack_id=plan.pack_id):
+                return analyze_archive(plan.archive_path, lang=options.lang)
+
+    def _update_archive(self, plan: PackPlan):
+        # patch the local archive, or fall back to downloading all of it
+        from update import UpdateUnavailable, update_archive
+
+        self.log("Checking for updated stickers...")
+        try:
+            with tracing.span("update_archive", pack_id=plan.pack_id):
+                plan.update = update_archive(
+                    plan.archive_path,
+                    plan.metadata,
+                    plan.pack_id,
+                    plan.is_emoji,
+                    self._download_pool,
+                )
+        except UpdateUnavailable as e:
+            self.log(f"Can not update sticker by sticker ({e}), downloading the pack")
+            plan.local_archive = False
+            return
+        self.log(f"Update: {plan.update}")
+
+    def _download_archive(self, plan: PackPlan):
+        os.makedirs(plan.download_dir, exist_ok=True)
+        if plan.local_archive:
+            return
+        self.log("Downloading sticker pack archive... ", end="")
+        with tracing.span("get_sticker_archive", pack_id=plan.pack_id) as s:
+            archive_content = webreq.get_sticker_archive(
+                plan.pack_id, plan.sticker_type
+            )
+            if s:
+                s.set(bytes_read=len(archive_content))
+        self.log("Complete!")
+        webreq.write_atomic(plan.archive_path, archive_content)
+
+    def _extract_members(self, plan: PackPlan, raw_dir):
+        """
+        Extract the archive member by member straight into the raw layout,
+        yielding every written path so that its tasks can start right away.
+        """
+        self.log("Extracting archive...")
+        try:
+            zip_ref = zipfile.ZipFile(plan.archive_path, "r")
+        except zipfile.BadZipFile:
+            # download it again next time instead of failing on it forever
+            os.remove(plan.archive_path)
+            raise
+        with zip_ref:
+            members = raw_member_paths(zip_ref.namelist(), plan.is_emoji)
+            for name, rel_path in members.items():
+                dest = os.path.join(raw_dir, rel_path)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                with tracing.span("extract", cat="extract", member=name) as s:
+                    with zip_ref.open(name) as src, open(dest, "wb") as f:
+                        shutil.copyfileobj(src, f)
+                    if s:
+                        s.set(bytes_written=tracing.file_size(dest))
+                yield dest
+
+    def _start_overlay_downloads(
+        self, plan: PackPlan, events, slots=None, overwrite=False
+    ):
+        """
+        Download the default overlays of message stickers in the background.
+        Every finished download puts (path, exception or None) on events.
+        slots limits how many downloads run at once; overwrite fetches
+        overlays already downloaded again.
+        """
+        overlay_dir = os.path.join(plan.download_dir, "default_overlay")
+        os.makedirs(overlay_dir, exist_ok=True)
+        self.log("Downloading default overlay message for message sticker... ")
+        for sticker_id in plan.sticker_ids:
+            path = os.path.join(overlay_dir, f"{sticker_id}.png")
+            future = self._download_pool.submit(
+                _limited,
+                slots,
+                self._download_overlay,
+                MESSAGE_STICKER_OVERLAY_DEFAULT.format(
+                    sticker_id=sticker_id, pack_id=plan.pack_id
+                ),
+                path,
+                overwrite,
+            )
+            future.add_done_callback(
+                lambda f, path=path: events.put((path, f.exception()))
+            )
+        return overlay_dir
+
+    @staticmethod
+    def _download_overlay(url, path, overwrite=False):
+        with tracing.span("download_default_overlay", cat="download") as s:
+            webreq.download_file(url, path, overwrite=overwrite)
+            if s:
+                s.set(bytes_written=tracing.file_size(path))
+
+    def _choose_workers(self, plan: PackPlan, downloads):
+        """Return (process limiter, download slots), both None unless auto tuned."""
+        if tuning.AUTO not in (self.threads, self.download_threads):
+            return None, None
+        choice = tuning.choose_workers(
+            plan.output_format.value, plan.is_emoji, len(plan.sticker_ids), downloads
+        )
+        self.log(f"Auto tuning: {choice}")
+        limiter = slots = None
+        if self.threads == tuning.AUTO:
+            limiter = tuning.AdaptiveLimiter(
+                choice.process_threads, tuning.MAX_PROCESS_THREADS, log=self.log
+            )
+        if self.download_threads == tuning.AUTO:
+            slots = Semaphore(choice.download_threads)
+        return limiter, slots
+
+    @staticmethod
+    def _wait(futures, stage, progress, total=None):
+        # a future returning a list (a batch) counts for each of its items
+        total = len(futures) if total is None else total
+        if progress:
+            progress(stage, 0, total)
+        done = 0
+        for future in as_completed(futures):
+            items = future.result()
+            done += len(items) if isinstance(items, list) else 1
+            if progress:
+                progress(stage, done, total)
+
+    @staticmethod
+    def plan_operations(plan: PackPlan, options: PackOptions):
+        """Return the operations every sticker of the pack goes through."""
+        operations = []
+        # order of operation: overlay, scale, other conversions (gif, webm, video,
+        # webp, png optimization)
+        if plan.has_text_overlay and not options.no_default_txt_overlay:
+            operations.append(Operation.OVERLAY)
+        if plan.scale_px:
+            operations.append(Operation.SCALE)
+        if options.remove_alpha:
+            operations.append(Operation.REMOVE_ALPHA)
+
+        if plan.output_format == OutputFormat.GIF:
+            operations.append(Operation.TO_GIF)
+        elif plan.output_format == OutputFormat.WEBM:
+            operations.append(Operation.TO_WEBM)
+        elif plan.output_format == OutputFormat.MP4:
+            operations.append(Operation.TO_MP4)
+        elif plan.output_format == OutputFormat.WEBP:
+            operations.append(Operation.TO_WEBP)
+        elif plan.output_format == OutputFormat.APNG and options.optimize_png:
+            if plan.has_animation:
+                operations.append(Operation.OPTIMIZE_APNG)
+            else:
+                operations.append(Operation.OPTIMIZE_PNG)
+        return operations
+
+    def build_tasks(
+        self, plan: PackPlan, options: PackOptions, raw_dir, overlay_dir=None
+    ):
+        """Return the ProcessTask of every sticker of the pack."""
+        from processing import ProcessTask
+
+        overlay_dir = overlay_dir or os.path.join(raw_dir, "default_overlay")
+        operations = self.plan_operations(plan, options)
+        tasks = []
+        for sticker_id in plan.sticker_ids:
+            sub_folder = "static"
+            if plan.is_emoji:
+                sub_folder = "emoji"
+            else:
+                if plan.has_animation:
+                    sub_folder = "animation"
+                if plan.has_popup:
+                    sub_folder = "popup"
+
+            in_pic = os.path.join(raw_dir, sub_folder, f"{sticker_id}.png")
+            in_audio = os.path.join(raw_dir, "sound", f"{sticker_id}.m4a")
+            in_overlay = os.path.join(overlay_dir, f"{sticker_id}.png")
+            result_output = os.path.join(
+                plan.output_dir, f"{sticker_id}.{plan.output_format.value}"
+            )
+
+            tasks.append(
+                ProcessTask(
+                    sticker_id,
+                    in_pic,
+                    in_audio,
+                    in_overlay,
+                    plan.scale_px,
+                    list(operations),
+                    result_output,
+                )
+            )
+        return tasks
+
+    @staticmethod
+    def _task_input_paths(task):
+        paths = [task.in_img]
+        if Operation.OVERLAY in task.operations:
+            paths.append(task.in_overlay)
+        if Operation.TO_MP4 in task.operations:
+            paths.append(task.in_audio)
+        return paths
+
+    def _run_plan(
+        self, plan: PackPlan, options: PackOptions, temp_dir, sink, progress
+    ):
+        """
+        Stages overlap: default overlays download while the archive is being
+        downloaded and extracted, and every sticker is submitted for processing
+        as soon as all of its inputs exist.
+        """
+        result = PackResult(plan)
+        raw_dir = os.path.join(temp_dir, "raw")
+        os.makedirs(raw_dir, exist_ok=True)
+        is_raw = plan.output_format == OutputFormat.RAW
+
+        if not is_raw:
+            # the processing engine (and ffmpeg bindings) are only loaded when needed
+            from processing import (
+                ImageProcessor,
+                ProcessorConfig,
+                find_magick,
+                kill_children,
+                needs_magick,
+            )
+
+            # check dependency for processing; Pillow-only chains (webp, png
+            # optimization, frame buffers) run without it
+            operations = self.plan_operations(plan, options)
+            if not find_magick() and needs_magick(
+                operations, plan.has_animation, options.extra_params
+            ):
+                raise PipelineError(
+                    "Error: ImageMagick is missing. Please install missing dependencies are re-run the program"
+                )
+
+        is_message = plan.sticker_type == StickerType.MESSAGE_STICKER
+        limiter, download_slots = self._choose_workers(
+            plan, len(plan.sticker_ids) if is_message else 0
+        )
+        process_threads = limiter.limit if limiter else self.threads
+
+        # for message sticker, download default overlay message in the background
+        overlay_events = queue.Queue()
+        overlay_dir = None
+        overlay_total = 0
+        if is_message:
+            # overlays change with pack revisions too; unchanged ones hash the
+            # same and their stickers are not processed again
+            overlay_dir = self._start_overlay_downloads(
+                plan,
+                overlay_events,
+                download_slots,
+                overwrite=options.redownload or options.update,
+            )
+            overlay_total = len(plan.sticker_ids)
+            if progress:
+                progress("overlay", 0, overlay_total)
+
+        # archives are written from scratch, there is nothing to resume
+        manifest = None
+        if sink.writes_files and not is_raw:
+            os.makedirs(plan.output_dir, exist_ok=True)
+            manifest = PackManifest(plan.output_dir)
+            if plan.update:
+                for sticker_id in plan.update.removed:
+                    manifest.forget(sticker_id)
+                    path = os.path.join(
+                        plan.output_dir, f"{sticker_id}.{plan.output_format.value}"
+                    )
+                    if os.path.isfile(path):
+                        os.remove(path)
+        # sticker id -> (input hash, chain) of the scheduled tasks
+        task_fingerprints = {}
+        scheduled = []
+        futures = []
+        skipped = 0
+
+        def on_task_done(task):
+            if manifest is None:
+                return
+            input_hash, chain = task_fingerprints[task.sticker_id]
+            manifest.record(
+                task.sticker_id, input_hash, chain, task.result_path, task.error
+            )
+
+        # small emoji are batched, but never so much that threads sit idle
+        batch_size = 1
+        if plan.is_emoji:
+            batch_size = max(
+                1, min(EMOJI_BATCH_SIZE, len(plan.sticker_ids) // process_threads)
+            )
+        batch = []
+        inputs = _TaskInputs()
+        cancel = Event()
+        if not is_raw:
+            config = ProcessorConfig(
+                temp_dir,
+                plan.sticker_type,
+                plan.output_format,
+                options.extra_params,
+                on_task_done=on_task_done,
+                sink=sink,
+                timeout=options.task_timeout,
+                retries=options.task_retries,
+                cancel=cancel,
+            )
+            for task in self.build_tasks(plan, options, raw_dir, overlay_dir):
+                waiting_for = self._task_input_paths(task)
+                if not plan.has_sound and task.in_audio in waiting_for:
+                    # there is no sound to wait for
+                    waiting_for.remove(task.in_audio)
+                inputs.add(task, waiting_for)
+
+        def schedule(task):
+            nonlocal skipped
+            if manifest is not None:
+                input_hash = hash_files(self._task_input_paths(task))
+                chain = describe_chain(
+                    task.operations,
+                    plan.scale_px,
+                    plan.output_format,
+                    options.extra_params,
+                )
+                if not options.reprocess and manifest.is_up_to_date(
+                    task.sticker_id, input_hash, chain, task.result_path
+                ):
+                    result.stickers.append(
+                        StickerResult(
+                            task.sticker_id, STICKER_SKIPPED, task.result_path
+                        )
+                    )
+                    skipped += 1
+                    metrics.inc(
+                        "stickers_total",
+                        format=plan.output_format.value,
+                        status="skipped",
+                    )
+                    return
+                task_fingerprints[task.sticker_id] = (input_hash, chain)
+            scheduled.append(task)
+            if batch_size == 1:
+                futures.append(
+                    self._process_pool.submit(
+                        _limited, limiter, ImageProcessor(config).run_task, task
+                    )
+                )
+                return
+            batch.append(task)
+            if len(batch) >= batch_size:
+                submit_batch()
+
+        def submit_batch():
+            if batch:
+                futures.append(
+                    self._process_pool.submit(
+                        _limited, limiter, ImageProcessor(config).run_batch, list(batch)
+                    )
+                )
+                batch.clear()
+
+        overlays_done = 0
+
+        def drain_overlays(block):
+            nonlocal overlays_done
+            while overlays_done < overlay_total:
+                try:
+                    path, error = overlay_events.get(block=block)
+                except queue.Empty:
+                    return
+                overlays_done += 1
+                if progress:
+                    progress("overlay", overlays_done, overlay_total)
+                if error is not None:
+                    # the sticker fails on its own once everything else is in
+                    self.log(f"Failed to download default overlay {path}: {error!r}")
+                    continue
+                for task in inputs.ready(path):
+                    schedule(task)
+
+        try:
+            self._download_archive(plan)
+            with tracing.span(
+                "process_stickers", count=len(plan.sticker_ids), threads=process_threads
+            ):
+                for path in self._extract_members(plan, raw_dir):
+                    for task in inputs.ready(path):
+                        schedule(task)
+                    drain_overlays(block=False)
+                drain_overlays(block=True)
+                if overlay_total:
+                    self.log("Message sticker default overlay download done!")
+                # inputs that never showed up make these tasks fail and get reported
+                for task in inputs.remaining():
+                    schedule(task)
+                submit_batch()
+                if not is_raw:
+                    self.log("Processing stickers...")
+                    self._wait(futures, "process", progress, len(scheduled))
+        except BaseException:
+            # stop running tasks (killing their ffmpeg/magick children) and do
+            # not pull the temporary directory out from under them
+            cancel.set()
+            for future in futures:
+                future.cancel()
+            if not is_raw:
+                killed = kill_children(cancel)
+                if killed:
+                    self.log(f"Cancelled, killed {killed} child process(es)")
+            wait(futures)
+            raise
+        finally:
+            # records of finished stickers are batched, keep them either way
+            if manifest is not None:
+                manifest.flush()
+
+        if is_raw:
+            self.log("Copying raw sticker files to output folder... ", end="")
+            sink.add_tree(raw_dir, plan.output_dir)
+            if overlay_dir:
+                sink.add_tree(
+                    overlay_dir, os.path.join(plan.output_dir, "default_overlay")
+                )
+            self.log("Complete!")
+            return result
+
+        if skipped:
+            self.log(f"{skipped} sticker(s) are up to date, skipped")
+        for task in scheduled:
+            result.png_bytes_saved += task.bytes_saved
+            result.stickers.append(
+                StickerResult(
+                    task.sticker_id,
+                    STICKER_FAILED if task.error else STICKER_DONE,
+                    task.result_path,
+                    task.error,
+                )
+            )
+        # TODO icon for all sticker packs
+        return result
+
+
+def _limited(limiter, fn, *args):
+    # run fn while holding a slot of limiter (a Semaphore or AdaptiveLimiter)
+    if limiter is None:
+        return fn(*args)
+    with limiter:
+        return fn(*args)
+
+
+class _TaskInputs:
+    """Tracks the inputs each task is still waiting for."""
+
+    def __init__(self):
+        self._missing = {}
+        self._waiting_on = {}
+
+    def add(self, task, paths):
+        self._missing[task] = set(paths)
+        for path in paths:
+            self._waiting_on.setdefault(path, []).append(task)
+
+    def ready(self, path):
+        """Mark path as available, return the tasks that have all their inputs now."""
+        runnable = []
+        for task in self._waiting_on.pop(path, []):
+            missing = self._missing[task]
+            missing.discard(path)
+            if not missing:
+                del self._missing[task]
+                runnable.append(task)
+        return runnable
+
+    def remaining(self):
+        """Return (and forget) the tasks still missing some input."""
+        tasks = list(self._missing)
+        self._missing.clear()
+        self._waiting_on.clear()
+        return tasks
+
+
+def raw_member_paths(names, is_emoji):
+    """
+    Map the archive members worth keeping to their path in the raw layout:
+    static/, animation/, popup/ and sound/ for stickers, emoji/ for emoji, plus
+    icon and metadata.
+    """
+    members = {}
+    if is_emoji:
+        # animated emoji packs may carry static versions, the animation wins
+        animated = {}
+        for name in names:
+            if match := re.fullmatch(r"(\d+)(_animation)?\.png", name):
+                if match.group(2) or match.group(1) not in animated:
+                    animated[match.group(1)] = name
+        for emoji_id, name in animated.items():
+            members[name] = f"emoji/{emoji_id}.png"
+        if "meta.json" in names:
+            members["meta.json"] = "meta.json"
+        return members
+    for name in names:
+        if match := re.fullmatch(r"(\d+)@2x\.png", name):
+            members[name] = f"static/{match.group(1)}.png"
+        elif match := re.fullmatch(r"animation@2x/(\d+)@2x\.png", name):
+            members[name] = f"animation/{match.group(1)}.png"
+        elif match := re.fullmatch(r"(sound|popup)/([^/]+)", name):
+            members[name] = f"{match.group(1)}/{match.group(2)}"
+        elif name == "tab_on@2x.png":
+            members[name] = "icon.png"
+        elif name == "productInfo.meta":
+            members[name] = "productInfo.meta"
+    return members
+
+
+def extract_pack_info_from_metadata(metadata, pack_id, lang, is_emoji):
+    if metadata["title"].get(lang):
+        title = metadata["title"][lang]
+    else:
+        title = metadata["title"]["en"]
+    if metadata["author"].get(lang):
+        author_name = metadata["author"][lang]
+    else:
+        author_name = metadata["author"]["en"]
+    if is_emoji:
+        if metadata.get("sticonResourceType") == "ANIMATION":
+            sticker_type = StickerType.ANIMATED_EMOJI
+        else:
+            sticker_type = StickerType.EMOJI
+        id_list = metadata["orders"]
+    else:
+        if "stickerResourceType" not in metadata:
+            sticker_type = StickerType.STATIC_STICKER
+        else:
+            sticker_type = StickerType(metadata["stickerResourceType"])
+        id_list = [i["id"] for i in metadata["stickers"]]
+    pack_info = {
+        "title": title,
+        "author_name": author_name,
+        "pack_id": pack_id,
+        "sticker_type": sticker_type.value,
+        "count": len(id_list),
+        "stickers": id_list,
+    }
+    return pack_info
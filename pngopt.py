@@ -0,0 +1,153 @@
+"""
+In-process size optimization of static PNG output (--optimize-png).
+
+Lossless: the image is stored in the smallest color type that represents it
+exactly (RGB when the alpha channel is unused, grayscale, or a palette with
+per-entry alpha when it has at most 256 colors) and deflated at level 9 with
+each of ZLIB_STRATEGIES, keeping the smallest encoding. Pillow picks the
+scanline filters: adaptive for truecolor and grayscale, none for palettes.
+Every candidate has 8 bits per sample, so 16-bit images are kept as they are.
+
+Lossy, only with a quality threshold: the image is also quantized to a
+256-color palette, alpha included, and the result is kept if it is smaller and
+its quality score is at least the threshold. The score maps the PSNR against
+the original from QUALITY_MIN_PSNR dB (0) to QUALITY_MAX_PSNR dB (100).
+"""
+import io
+import math
+import os
+
+import numpy as np
+from PIL import Image, ImageChops, ImageStat, features
+
+from apng import png_bit_depth
+
+# zlib strategies: default, Z_FILTERED, Z_RLE
+ZLIB_STRATEGIES = (-1, 1, 3)
+PALETTE_COLORS = 256
+QUALITY_MIN_PSNR = 20.0
+QUALITY_MAX_PSNR = 50.0
+
+
+class PNGOptimizeResult:
+    def __init__(self, size_before, size_after, mode, quantized=False, quality=100):
+        self.size_before = size_before
+        self.size_after = size_after
+        # Pillow mode of the written image
+        self.mode = mode
+        self.quantized = quantized
+        # quality score of the quantized image, 100 for a lossless result
+        self.quality = quality
+
+    @property
+    def saved(self):
+        return self.size_before - self.size_after
+
+    def to_dict(self):
+        return {
+            "size_before": self.size_before,
+            "size_after": self.size_after,
+            "mode": self.mode,
+            "quantized": self.quantized,
+            "quality": self.quality,
+        }
+
+
+def smallest_encoding(image: Image.Image):
+    """Return the smallest PNG bytes of image over ZLIB_STRATEGIES."""
+    best = None
+    for strategy in ZLIB_STRATEGIES:
+        buf = io.BytesIO()
+        image.save(buf, format="PNG", compress_level=9, compress_type=strategy)
+        if best is None or buf.tell() < len(best):
+            best = buf.getvalue()
+    return best
+
+
+def exact_reductions(image: Image.Image):
+    """Return the lossless candidates for image, an RGBA image."""
+    pixels = np.asarray(image)
+    opaque = bool((pixels[..., 3] == 255).all())
+    gray = bool(
+        (pixels[..., 0] == pixels[..., 1]).all()
+        and (pixels[..., 1] == pixels[..., 2]).all()
+    )
+    if gray:
+        candidates = [image.convert("L" if opaque else "LA")]
+    else:
+        candidates = [image.convert("RGB") if opaque else image]
+    palette = _exact_palette(pixels)
+    if palette is not None:
+        candidates.append(palette)
+    return candidates
+
+
+def _exact_palette(pixels):
+    # a palette image with the same pixels, or None with more than 256 colors
+    packed = pixels.reshape(-1, 4).view(np.uint32).ravel()
+    colors, index = np.unique(packed, return_inverse=True)
+    if len(colors) > PALETTE_COLORS:
+        return None
+    image = Image.fromarray(index.astype(np.uint8).reshape(pixels.shape[:2]), "P")
+    image.putpalette(colors.view(np.uint8).tobytes(), rawmode="RGBA")
+    return image
+
+
+def quantize(image: Image.Image):
+    """image reduced to a palette of PALETTE_COLORS colors, alpha included."""
+    # median cut can not handle alpha; libimagequant is best when Pillow has it
+    method = Image.Quantize.FASTOCTREE
+    if features.check("libimagequant"):
+        method = Image.Quantize.LIBIMAGEQUANT
+    return image.quantize(PALETTE_COLORS, method=method, dither=Image.Dither.NONE)
+
+
+def quality_score(original: Image.Image, candidate: Image.Image):
+    """0-100 score of candidate against original, an RGBA image."""
+    # premultiplied, the color of (nearly) transparent pixels hardly matters
+    diff = ImageChops.difference(
+        original.convert("RGBa"), candidate.convert("RGBA").convert("RGBa")
+    )
+    pixels = original.width * original.height
+    mse = sum(ImageStat.Stat(diff).sum2) / (pixels * 4)
+    if mse == 0:
+        return 100
+    psnr = 10 * math.log10(255**2 / mse)
+    score = (psnr - QUALITY_MIN_PSNR) / (QUALITY_MAX_PSNR - QUALITY_MIN_PSNR) * 100
+    return max(0, min(100, round(score)))
+
+
+def optimize_png(in_file, out_file, min_quality=None):
+    """
+    Write the smallest version of the PNG in_file to out_file, lossless unless
+    min_quality (0-100) allows a quantized palette. The original bytes are
+    kept if nothing is smaller. Returns a PNGOptimizeResult.
+    """
+    size_before = os.path.getsize(in_file)
+    with open(in_file, "rb") as f:
+        best = f.read()
+    with Image.open(in_file) as im:
+        result = PNGOptimizeResult(size_before, size_before, im.mode)
+        image = im.convert("RGBA")
+    if png_bit_depth(in_file) > 8:
+        # Pillow decoded it to 8 bits already, nothing below is lossless
+        with open(out_file, "wb") as f:
+            f.write(best)
+        return result
+
+    for candidate in exact_reductions(image):
+        data = smallest_encoding(candidate)
+        if len(data) < len(best):
+            best, result.mode = data, candidate.mode
+    if min_quality is not None:
+        quantized = quantize(image)
+        score = quality_score(image, quantized)
+        if score >= min_quality:
+            data = smallest_encoding(quantized)
+            if len(data) < len(best):
+                best = data
+                result.mode, result.quantized, result.quality = "P", True, score
+    with open(out_file, "wb") as f:
+        f.write(best)
+    result.size_after = len(best)
+    return result
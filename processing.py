@@ -1,42 +1,338 @@
 from __future__ import annotations
 
 import datetime
+import json
 import os.path
 import queue
 import shutil
+import signal
 import subprocess
+import time
 import traceback
-from enum import Enum
-from threading import Lock, Thread
+from contextlib import contextmanager
+from functools import lru_cache
+from threading import Lock, Thread, local
 
 import ffmpeg
 
-from utils import StickerType, increase_counter, sticker_type_properties
+import apng
+import metrics
+import tracing
+from utils import (
+    DEFAULT_ENCODER_PRESET,
+    ENCODER_PRESETS,
+    PRESET_BALANCED,
+    PRESET_FAST,
+    PRESET_SMALLEST,
+    WEBM_DURATION_SEC_MAX,
+    WEBM_SIZE_KB_MAX,
+    Operation,
+    OutputFormat,
+    StickerType,
+    increase_counter,
+    sticker_type_properties,
+)
+
+try:
+    import framebuf
+except ImportError:
+    # without numpy/Pillow every operation spawns magick or ffmpeg
+    framebuf = None
 
 DEFAULT_GIF_ALPHA_THRESHOLD = 1
-WEBM_SIZE_KB_MAX = 256
-WEBM_DURATION_SEC_MAX = 3
+# seconds one operation (all of its ffmpeg/magick spawns) may take before its
+# child process is killed, and how often a timed out operation is retried
+DEFAULT_OPERATION_TIMEOUT = 300
+DEFAULT_OPERATION_RETRIES = 1
+# seconds before the first retry, doubled for every further one
+RETRY_BACKOFF = 1.0
+
+# encoder presets, picked with the PRESET extra param or per format with
+# WEBM_PRESET/MP4_PRESET/GIF_PRESET/WEBP_PRESET; run benchmark.py --presets for numbers
+# libvpx-vp9 output options
+VP9_PRESETS = {
+    PRESET_FAST: {
+        "deadline": "realtime",
+        "cpu-used": 8,
+        "row-mt": 1,
+        "tile-columns": 2,
+    },
+    PRESET_BALANCED: {
+        "deadline": "good",
+        "cpu-used": 2,
+        "row-mt": 1,
+        "tile-columns": 1,
+    },
+    PRESET_SMALLEST: {
+        "deadline": "good",
+        "cpu-used": 0,
+        "row-mt": 1,
+        "tile-columns": 0,
+    },
+}
+# libx264 output options
+X264_PRESETS = {
+    PRESET_FAST: {"preset": "veryfast", "tune": "animation"},
+    PRESET_BALANCED: {"preset": "medium", "tune": "animation"},
+    PRESET_SMALLEST: {"preset": "veryslow", "tune": "animation"},
+}
+# (palettegen, paletteuse) filter options
+GIF_PRESETS = {
+    PRESET_FAST: ({}, {"dither": "none"}),
+    PRESET_BALANCED: ({}, {"dither": "sierra2_4a"}),
+    # bayer dithering and per-rectangle updates compress much better in gif's LZW
+    PRESET_SMALLEST: (
+        {"stats_mode": "diff"},
+        {"dither": "bayer", "bayer_scale": 3, "diff_mode": "rectangle"},
+    ),
+}
+# Pillow WebP encoder options; method is libwebp's effort (0-6). Lossy method 6
+# is ~25x slower than 5 on animations for a 1-2% smaller file
+WEBP_PRESETS = {
+    PRESET_FAST: {"method": 0},
+    PRESET_BALANCED: {"method": 4},
+    PRESET_SMALLEST: {"method": 5},
+}
+DEFAULT_WEBP_QUALITY = 80
+
+# MPEG-4 objectTypeIndication values of AAC (MPEG-4 audio, MPEG-2 AAC profiles)
+AAC_OBJECT_TYPES = {0x40, 0x66, 0x67, 0x68}
+
+# operations ImageProcessor.run_batch runs with one spawn for the whole batch
+BATCH_OPERATIONS = {Operation.SCALE}
+# operations done on in-memory frame buffers (framebuf.py) when available; their
+# results are only written to disk for an operation or sink that needs a file
+BUFFER_OPERATIONS = {
+    Operation.SCALE,
+    Operation.OVERLAY,
+    Operation.REMOVE_ALPHA,
+    Operation.TO_WEBM,
+    Operation.TO_WEBP,
+}
+# operations that spawn magick unless they run on a frame buffer; SCALE and
+# REMOVE_ALPHA only for still images, animations go through ffmpeg
+MAGICK_OPERATIONS = {Operation.OVERLAY, Operation.TO_GIF, Operation.TO_WEBM}
+STILL_MAGICK_OPERATIONS = {Operation.SCALE, Operation.REMOVE_ALPHA}
+# frame rate of WebM output, see to_webm
+WEBM_FPS = 30
 
-_MAGICK_BIN = shutil.which("magick")
 _print_lock = Lock()
 
+# running child processes -> cancel event of the run that started them
+_children = {}
+_children_lock = Lock()
+# per thread (deadline, cancel event) for the children it spawns
+_limits = local()
+
+
+class OperationTimeout(Exception):
+    pass
+
+
+class Cancelled(Exception):
+    pass
+
+
+@lru_cache(maxsize=None)
+def find_magick():
+    # looked up on first use instead of at import time
+    return shutil.which("magick")
+
+
+def frame_buffers_enabled(extra_params=None):
+    # FRAMEBUF=0 sends every operation through magick/ffmpeg again
+    return framebuf is not None and (extra_params or {}).get("FRAMEBUF") != "0"
+
+
+def needs_magick(operations, has_animation, extra_params=None):
+    """Whether running operations on a sticker spawns magick (find_magick)."""
+    magick = set(MAGICK_OPERATIONS)
+    if not has_animation:
+        magick |= STILL_MAGICK_OPERATIONS
+    if frame_buffers_enabled(extra_params):
+        magick -= BUFFER_OPERATIONS
+    return any(op in magick for op in operations)
+
+
+def _count_spawn(program, start):
+    metrics.inc("subprocess_spawns_total", program=program)
+    metrics.observe("subprocess_seconds", time.perf_counter() - start, program=program)
+
+
+@contextmanager
+def subprocess_limits(timeout=None, cancel=None):
+    """
+    Apply a deadline (seconds from now) and a cancel event (threading.Event)
+    to every child this thread spawns inside the block. Nested blocks keep the
+    earlier deadline and the outer cancel event unless they pass their own.
+    """
+    outer_deadline, outer_cancel = getattr(_limits, "value", (None, None))
+    deadline = outer_deadline
+    if timeout:
+        deadline = time.monotonic() + timeout
+        if outer_deadline is not None:
+            deadline = min(deadline, outer_deadline)
+    _limits.value = (deadline, cancel or outer_cancel)
+    try:
+        yield
+    finally:
+        _limits.value = (outer_deadline, outer_cancel)
+
 
-class OutputFormat(Enum):
-    # this will also be the file extension
-    GIF = "gif"
-    WEBM = "webm"
-    MP4 = "mp4"
-    APNG = "png"
-    RAW = "raw"
+def _spawn(args, capture, input=None):
+    """
+    Run a child process within the limits of the calling thread, return
+    (returncode, stdout, stderr). stdout/stderr are only captured if capture;
+    input (bytes-like, or an iterable of them streamed from a thread) is
+    written to its stdin.
+    """
+    deadline, cancel = getattr(_limits, "value", (None, None))
+    program = os.path.basename(args[0] or "")
+    if cancel is not None and cancel.is_set():
+        raise Cancelled(program)
+    timeout = None
+    if deadline is not None:
+        timeout = max(0.0, deadline - time.monotonic())
+    pipe = subprocess.PIPE if capture else None
+    # own process group, so that killing it also gets the child's children
+    p = subprocess.Popen(
+        args,
+        stdin=None if input is None else subprocess.PIPE,
+        stdout=pipe,
+        stderr=pipe,
+        start_new_session=os.name == "posix",
+    )
+    feeder = None
+    if input is not None and not isinstance(input, (bytes, bytearray, memoryview)):
+        # communicate() must not touch stdin, the thread writes and closes it
+        feeder = Thread(target=_feed, args=(p.stdin, input), daemon=True)
+        p.stdin, input = None, None
+        feeder.start()
+    with _children_lock:
+        _children[p] = cancel
+    try:
+        if cancel is not None and cancel.is_set():
+            # cancelled while starting, kill_children may have missed it
+            _kill(p)
+        out, err = p.communicate(input, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        _kill(p)
+        p.communicate()
+        metrics.inc("subprocess_timeouts_total", program=program)
+        raise OperationTimeout(f"{program} did not finish in {timeout:.0f}s") from None
+    finally:
+        with _children_lock:
+            _children.pop(p, None)
+        if feeder is not None:
+            # the child is gone, so a blocked write fails and the thread ends
+            feeder.join()
+    if cancel is not None and cancel.is_set():
+        raise Cancelled(program)
+    return p.returncode, out, err
+
+
+def _feed(stdin, chunks):
+    # write chunks to a child's stdin; it may exit (or be killed) before the end
+    try:
+        for chunk in chunks:
+            stdin.write(chunk)
+    except OSError:
+        pass
+    finally:
+        try:
+            stdin.close()
+        except OSError:
+            pass
+
+
+def _kill(p):
+    try:
+        if os.name == "posix":
+            os.killpg(p.pid, signal.SIGKILL)
+        else:
+            p.kill()
+    except OSError:
+        # already gone
+        pass
+
+
+def kill_children(cancel=None):
+    """Kill the running children started under cancel, or all of them if None."""
+    with _children_lock:
+        victims = [p for p, c in _children.items() if cancel is None or c is cancel]
+    for p in victims:
+        _kill(p)
+    return len(victims)
 
 
-class Operation(Enum):
-    SCALE = "scale"
-    OVERLAY = "overlay"
-    REMOVE_ALPHA = "remove_alpha"
-    TO_GIF = "to_gif"
-    TO_WEBM = "to_webm"
-    TO_MP4 = "to_mp4"
+def _call(args):
+    # every magick spawn goes through here so it shows up in traces and metrics
+    program = os.path.basename(args[0] or "")
+    start = time.perf_counter()
+    try:
+        with tracing.span(program, cat="subprocess", argv=args[1:]):
+            return _spawn(args, capture=False)[0]
+    finally:
+        _count_spawn(program, start)
+
+
+def _run_ffmpeg(stream, quiet=False, input=None):
+    # like stream.run(), but within the limits of subprocess_limits()
+    start = time.perf_counter()
+    try:
+        with tracing.span("ffmpeg", cat="subprocess") as s:
+            args = stream.compile()
+            if s:
+                s.set(argv=args[1:])
+            returncode, out, err = _spawn(args, capture=quiet, input=input)
+    finally:
+        _count_spawn("ffmpeg", start)
+    if returncode:
+        raise ffmpeg.Error("ffmpeg", out, err)
+    return out, err
+
+
+def _read_descriptor(data, pos):
+    # MPEG-4 descriptor header: tag, then a length of 7 bits per byte
+    tag = data[pos]
+    pos += 1
+    length = 0
+    for _ in range(4):
+        b = data[pos]
+        pos += 1
+        length = (length << 7) | (b & 0x7F)
+        if not b & 0x80:
+            break
+    return tag, length, pos
+
+
+def m4a_is_aac(path):
+    """
+    Whether an .m4a/.mp4 file holds AAC audio, read from the esds box of its
+    mp4a sample entry, so that it can be copied into an MP4 as is. Sound
+    stickers are small enough to be read whole. False when unsure.
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        pos = data.index(b"esds", data.index(b"mp4a")) + 8  # type, version/flags
+        tag, _, pos = _read_descriptor(data, pos)
+        if tag != 0x03:  # ES_Descriptor
+            return False
+        flags = data[pos + 2]
+        pos += 3  # ES_ID, flags
+        if flags & 0x80:  # streamDependenceFlag
+            pos += 2
+        if flags & 0x40:  # URL_Flag
+            pos += 1 + data[pos]
+        if flags & 0x20:  # OCRstreamFlag
+            pos += 2
+        tag, _, pos = _read_descriptor(data, pos)
+        if tag != 0x04:  # DecoderConfigDescriptor
+            return False
+        return data[pos] in AAC_OBJECT_TYPES
+    except (OSError, ValueError, IndexError):
+        return False
 
 
 class ProcessTask:
@@ -57,6 +353,10 @@ class ProcessTask:
         self.scale_px = scale_px
         self.operations = operations
         self.result_path = result_output_path
+        # exception of the last attempt, None if it succeeded
+        self.error = None
+        # bytes the OPTIMIZE_PNG operation saved
+        self.bytes_saved = 0
 
 
 class ProcessorConfig:
@@ -66,21 +366,44 @@ class ProcessorConfig:
         sticker_type: StickerType,
         output_format: OutputFormat,
         extra_params: dict | None = None,
+        on_task_done=None,
+        sink=None,
+        timeout=DEFAULT_OPERATION_TIMEOUT,
+        retries=DEFAULT_OPERATION_RETRIES,
+        cancel=None,
     ):
         self.temp_dir = temp_dir
         self.sticker_type = sticker_type
         self.output_format = output_format
         self.extra_params = extra_params
+        # seconds per operation (None: no limit) and retries after a timeout
+        self.timeout = timeout
+        self.retries = retries
+        # threading.Event; once set, no new child is started and running
+        # tasks fail with Cancelled (see kill_children)
+        self.cancel = cancel
+        # called with the ProcessTask after every task, check task.error for failures
+        self.on_task_done = on_task_done
+        # sinks.OutputSink receiving the results, copied to result_path if None
+        self.sink = sink
 
 
-class ImageProcessorThread(Thread):
-    def __init__(self, task_queue, config: ProcessorConfig):
-        Thread.__init__(self, name="ImageProcessorThread")
-        self.queue = task_queue
+class ImageProcessor:
+    """
+    Runs the operations of ProcessTasks. Not thread safe: use one instance per
+    worker thread (instances are cheap to create).
+    """
+
+    def __init__(self, config: ProcessorConfig):
         self.temp_dir = config.temp_dir
         self.sticker_type = config.sticker_type
         self.output_format = config.output_format
-        self.extra_params = config.extra_params
+        self.extra_params = config.extra_params or {}
+        self.on_task_done = config.on_task_done
+        self.sink = config.sink
+        self.timeout = config.timeout
+        self.retries = config.retries
+        self.cancel = config.cancel
         self._current_sticker_id = None
         (
             self._sticker_has_animation,
@@ -90,62 +413,356 @@ class ImageProcessorThread(Thread):
             self._sticker_is_emoji,
         ) = sticker_type_properties(self.sticker_type)
 
-    def run(self):
-        while not self.queue.empty():
+        # APNG path -> frame delays found by a batched identify
+        self._known_delays = {}
+        self.use_frame_buffers = frame_buffers_enabled(self.extra_params)
+        # interim path -> FrameBuffer not (yet) written to that path
+        self._buffers = {}
+
+    def run_task(self, task: ProcessTask):
+        # process a task, reporting errors instead of raising them
+        try:
+            self.process_task(task)
+        except Exception as e:
+            self._report_error(task, e)
+        finally:
+            self._finish(task)
+        return task
+
+    def _finish(self, task: ProcessTask):
+        # buffers a failed task left behind
+        prefix = os.path.join(self.temp_dir, f"{task.sticker_id}_")
+        for path in [p for p in self._buffers if p.startswith(prefix)]:
+            del self._buffers[path]
+        metrics.inc(
+            "stickers_total",
+            format=self.output_format.value,
+            status="failed" if task.error else "done",
+        )
+        if self.on_task_done:
+            self.on_task_done(task)
+
+    def _report_error(self, task: ProcessTask, e):
+        task.error = e
+        if isinstance(e, Cancelled):
+            return
+        with _print_lock:
+            print("Error occurred while processing", e, task.sticker_id)
+            if isinstance(e, ffmpeg.Error):
+                print("------stdout------")
+                print(e.stdout.decode() if e.stdout else "")
+                print("------end------")
+                print("------stderr------")
+                print(e.stderr.decode() if e.stderr else "")
+                print("------end------")
+            traceback.print_exc()
+
+    def run_batch(self, tasks: list[ProcessTask]):
+        """
+        Run tasks with the same operations together, for packs of many small
+        images (emoji) where process startup dominates. Operations in
+        BATCH_OPERATIONS are applied to the whole batch with one ffmpeg/magick
+        spawn; items the batch call did not produce are redone one by one, so
+        a bad input only fails its own task. Errors are reported per task.
+        """
+        alive = list(tasks)
+        curr = {task.sticker_id: task.in_img for task in tasks}
+        with tracing.span("batch", cat="sticker", count=len(tasks)):
+            if self._sticker_has_animation:
+                survivors = []
+                for task in alive:
+                    self._current_sticker_id = str(task.sticker_id)
+                    try:
+                        curr[task.sticker_id] = self.collapse_duplicate_frames(
+                            task.in_img
+                        )
+                    except Exception as e:
+                        self._report_error(task, e)
+                        self._finish(task)
+                        continue
+                    survivors.append(task)
+                alive = survivors
+            for i, op in enumerate(tasks[0].operations):
+                outs = {
+                    task.sticker_id: self._interim_path(task.sticker_id, i)
+                    for task in alive
+                }
+                batched = (
+                    op in BATCH_OPERATIONS
+                    and len(alive) > 1
+                    and not self._in_buffer(op)
+                )
+                if batched:
+                    try:
+                        self._apply_batch_operation(op, alive, curr, outs)
+                    except (Cancelled, OperationTimeout) as e:
+                        # no time left to redo the items one by one
+                        for task in alive:
+                            self._report_error(task, e)
+                            self._finish(task)
+                        alive = []
+                        break
+                elif (
+                    op == Operation.TO_WEBM
+                    and len(alive) > 1
+                    and not self._in_buffer(op)
+                ):
+                    self.prefetch_animation_delays([curr[t.sticker_id] for t in alive])
+                survivors = []
+                for task in alive:
+                    sticker_id = task.sticker_id
+                    if batched and os.path.isfile(outs[sticker_id]):
+                        survivors.append(task)
+                        continue
+                    self._current_sticker_id = str(sticker_id)
+                    try:
+                        self._run_operation(
+                            op, task, curr[sticker_id], outs[sticker_id]
+                        )
+                    except Exception as e:
+                        self._report_error(task, e)
+                        self._finish(task)
+                        continue
+                    survivors.append(task)
+                for task in survivors:
+                    curr[task.sticker_id] = outs[task.sticker_id]
+                alive = survivors
+            for task in alive:
+                try:
+                    self._store_result(task, curr[task.sticker_id])
+                except Exception as e:
+                    self._report_error(task, e)
+                self._finish(task)
+        return tasks
+
+    def _apply_batch_operation(self, op: Operation, tasks, curr, outs):
+        pairs = [(curr[t.sticker_id], outs[t.sticker_id]) for t in tasks]
+        start = time.perf_counter()
+        # the batch gets the time its items would get one by one
+        timeout = self.timeout * len(pairs) if self.timeout else None
+        try:
+            with tracing.span(
+                f"batch_{op.value}", cat="operation", count=len(pairs)
+            ), subprocess_limits(timeout, self.cancel):
+                if op == Operation.SCALE:
+                    self.scale_images(pairs, tasks[0].scale_px)
+            metrics.observe(
+                "batch_operation_seconds", time.perf_counter() - start, op=op.value
+            )
+        except OperationTimeout:
+            # the batch had the time of all its items
+            metrics.inc("operation_errors_total", op=op.value)
+            raise
+        except Cancelled:
+            raise
+        except Exception as e:
+            # whatever is missing is redone one by one
+            with _print_lock:
+                print(f"Batched {op.value} failed, processing one by one:", e)
+
+    def collapse_duplicate_frames(self, in_file):
+        """
+        Return an APNG with runs of identical frames merged into single longer
+        frames, or in_file if there is nothing to merge. Every encoder after
+        this gets fewer frames to decode and encode for the same animation.
+        """
+        out_file = os.path.join(
+            self.temp_dir, f"{self._current_sticker_id}_collapsed.tmp"
+        )
+        with tracing.span(
+            "collapse_frames", cat="operation", sticker_id=self._current_sticker_id
+        ) as s:
             try:
-                task: ProcessTask = self.queue.get_nowait()
-            except queue.Empty:
-                continue
-            self._current_sticker_id = str(task.sticker_id)
+                before, after = apng.collapse_duplicate_frames(in_file, out_file)
+            except apng.PNGFormatError:
+                # leave anything unusual to ffmpeg/magick
+                return in_file
+            if s:
+                s.set(frames_before=before, frames_after=after)
+        return out_file if after < before else in_file
+
+    def _interim_path(self, sticker_id, i):
+        return os.path.join(self.temp_dir, f"{sticker_id}_interim_{i}.tmp")
+
+    def _in_buffer(self, op: Operation):
+        return self.use_frame_buffers and op in BUFFER_OPERATIONS
+
+    def _load_buffer(self, path):
+        # the result of the previous operation, still in memory if it was one
+        # of BUFFER_OPERATIONS
+        buffer = self._buffers.get(path)
+        if buffer is None:
+            with tracing.span("decode_frames", cat="operation"):
+                buffer = framebuf.FrameBuffer.from_file(path)
+        return buffer
+
+    def _keep_buffer(self, buffer, path):
+        self._buffers[path] = buffer
+
+    def _write_buffer(self, path):
+        # write path if it only exists in memory so far
+        buffer = self._buffers.pop(path, None)
+        if buffer is not None:
+            with tracing.span("encode_frames", cat="operation", frames=buffer.count):
+                buffer.write(path)
+
+    def _store_result(self, task: ProcessTask, path):
+        self._write_buffer(path)
+        metrics.inc(
+            "output_bytes_total", os.path.getsize(path), format=self.output_format.value
+        )
+        if self.sink:
+            self.sink.add_file(path, task.result_path)
+        else:
+            shutil.copy(path, task.result_path)
+
+    def process_task(self, task: ProcessTask):
+        self._current_sticker_id = str(task.sticker_id)
+        with tracing.span(
+            "sticker", cat="sticker", sticker_id=self._current_sticker_id
+        ) as sticker_span:
+            curr_in = task.in_img
+            if self._sticker_has_animation and task.operations:
+                curr_in = self.collapse_duplicate_frames(curr_in)
+            for i, op in enumerate(task.operations):
+                curr_out = self._interim_path(self._current_sticker_id, i)
+                self._run_operation(op, task, curr_in, curr_out)
+                curr_in = curr_out
+            self._store_result(task, curr_in)
+            if sticker_span:
+                sticker_span.set(bytes_written=tracing.file_size(curr_in))
+
+    def _run_operation(self, op: Operation, task: ProcessTask, curr_in, curr_out):
+        # apply_operation, traced, timed, and retried with backoff if it times out
+        if not self._in_buffer(op):
+            self._write_buffer(curr_in)
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
             try:
-                curr_in = task.in_img
-                for i, op in enumerate(task.operations):
-                    curr_out = os.path.join(
-                        self.temp_dir, f"{self._current_sticker_id}_interim_{i}.tmp"
-                    )
-                    if op == Operation.SCALE:
-                        self.scale_image(curr_in, curr_out, task.scale_px)
-                    elif op == Operation.OVERLAY:
-                        self.overlay_sticker_message(curr_in, task.in_overlay, curr_out)
-                    elif op == Operation.REMOVE_ALPHA:
-                        self.remove_alpha(curr_in, curr_out)
-                    elif op == Operation.TO_GIF:
-                        alpha_threshold = DEFAULT_GIF_ALPHA_THRESHOLD
-                        if self.extra_params.get("GAT"):
-                            try:
-                                alpha_threshold = int(self.extra_params["GAT"])
-                            except ValueError:
-                                pass
-
-                        self.to_gif(curr_in, curr_out, alpha_threshold)
-                    elif op == Operation.TO_WEBM:
-                        frame_dir = self.make_frame_temp_dir()
-                        self.split_apng_frames(curr_in, frame_dir)
-                        durations = self.get_animation_delays(curr_in)
-                        webm_uncapped = os.path.join(
-                            self.temp_dir, f"{self._current_sticker_id}.raw.webm"
-                        )
-                        self.to_webm(durations, frame_dir, webm_uncapped)
-                        self.cap_webm_duration_and_size(
-                            durations, webm_uncapped, frame_dir, curr_out
+                with tracing.span(
+                    op.value, cat="operation", sticker_id=self._current_sticker_id
+                ) as op_span, subprocess_limits(self.timeout, self.cancel):
+                    self.apply_operation(op, task, curr_in, curr_out)
+                    if op_span:
+                        op_span.set(
+                            bytes_read=tracing.file_size(curr_in),
+                            bytes_written=tracing.file_size(curr_out),
                         )
-                    elif op == Operation.TO_MP4:
-                        self.to_video(curr_in, task.in_audio, curr_out)
-                    curr_in = curr_out
-                shutil.copy(curr_in, task.result_path)
-            except ffmpeg.Error as e:
+            except OperationTimeout as e:
+                metrics.inc("operation_errors_total", op=op.value)
+                if attempt == self.retries:
+                    raise
+                delay = RETRY_BACKOFF * 2**attempt
                 with _print_lock:
-                    print("Error occurred while processing", e, task.sticker_id)
-                    print("------stdout------")
-                    print(e.stdout.decode())
-                    print("------end------")
-                    print("------stderr------")
-                    print(e.stderr.decode())
-                    print("------end------")
-                    traceback.print_exc()
-            finally:
-                self.queue.task_done()
-                increase_counter()
+                    print(
+                        f"{op.value} of {self._current_sticker_id} timed out ({e}),"
+                        f" retrying in {delay:.0f}s"
+                    )
+                metrics.inc("operation_retries_total", op=op.value)
+                if self.cancel is None:
+                    time.sleep(delay)
+                elif self.cancel.wait(delay):
+                    raise Cancelled(op.value)
+            except Exception:
+                metrics.inc("operation_errors_total", op=op.value)
+                raise
+            else:
+                metrics.observe(
+                    "operation_seconds", time.perf_counter() - start, op=op.value
+                )
+                # the input is not needed any more once its result exists
+                self._buffers.pop(curr_in, None)
+                return
+
+    def apply_operation(self, op: Operation, task: ProcessTask, curr_in, curr_out):
+        if self._in_buffer(op):
+            self.apply_buffer_operation(op, task, curr_in, curr_out)
+        elif op == Operation.SCALE:
+            self.scale_image(curr_in, curr_out, task.scale_px)
+        elif op == Operation.OVERLAY:
+            self.overlay_sticker_message(curr_in, task.in_overlay, curr_out)
+        elif op == Operation.REMOVE_ALPHA:
+            self.remove_alpha(curr_in, curr_out)
+        elif op == Operation.TO_GIF:
+            alpha_threshold = DEFAULT_GIF_ALPHA_THRESHOLD
+            if self.extra_params.get("GAT"):
+                try:
+                    alpha_threshold = int(self.extra_params["GAT"])
+                except ValueError:
+                    pass
+
+            self.to_gif(curr_in, curr_out, alpha_threshold)
+        elif op == Operation.TO_WEBM:
+            frame_dir = self.make_frame_temp_dir()
+            self.split_apng_frames(curr_in, frame_dir)
+            frames = self.collapse_frame_files(
+                frame_dir, self.get_animation_delays(curr_in)
+            )
+            names = [name for name, _ in frames]
+
+            def encode(delays, out_file):
+                self.to_webm(list(zip(names, delays)), frame_dir, out_file)
+
+            self._webm_with_limits([d for _, d in frames], encode, curr_out)
+        elif op == Operation.TO_MP4:
+            self.to_video(curr_in, task.in_audio, curr_out)
+        elif op == Operation.TO_WEBP:
+            if framebuf is None:
+                raise RuntimeError("webp output needs numpy and Pillow")
+            buffer = framebuf.FrameBuffer.from_file(curr_in)
+            self.buffer_to_webp(buffer.collapse_duplicates(), curr_out)
+        elif op == Operation.OPTIMIZE_PNG:
+            min_quality = None
+            if self.extra_params.get("PNG_QUALITY"):
+                try:
+                    min_quality = int(self.extra_params["PNG_QUALITY"])
+                except ValueError:
+                    pass
+            task.bytes_saved = self.optimize_png(curr_in, curr_out, min_quality)
+        elif op == Operation.OPTIMIZE_APNG:
+            if framebuf is None:
+                raise RuntimeError("APNG optimization needs numpy and Pillow")
+            verify = str(self.extra_params.get("APNG_VERIFY", ""))
+            task.bytes_saved = self.optimize_apng(
+                curr_in, curr_out, verify.lower() not in ("", "0", "false")
+            )
+
+    def apply_buffer_operation(
+        self, op: Operation, task: ProcessTask, curr_in, curr_out
+    ):
+        # apply_operation on decoded frames, without frame files or magick
+        metrics.inc("framebuf_operations_total", op=op.value)
+        buffer = self._load_buffer(curr_in)
+        if op == Operation.SCALE:
+            self._keep_buffer(buffer.scale(task.scale_px), curr_out)
+        elif op == Operation.OVERLAY:
+            overlay = framebuf.FrameBuffer.from_file(task.in_overlay)
+            self._keep_buffer(buffer.overlay_center(overlay), curr_out)
+        elif op == Operation.REMOVE_ALPHA:
+            self._keep_buffer(buffer.flatten(), curr_out)
+        elif op == Operation.TO_WEBM:
+            buffer = buffer.collapse_duplicates()
+
+            def encode(delays, out_file):
+                self.buffer_to_webm(buffer, delays, out_file)
+
+            self._webm_with_limits(buffer.delays, encode, curr_out)
+        elif op == Operation.TO_WEBP:
+            self.buffer_to_webp(buffer.collapse_duplicates(), curr_out)
+
+    def _webm_with_limits(self, delays, encode, out_file):
+        # encode(delays, path) once, then again faster if it is too long
+        webm_uncapped = os.path.join(
+            self.temp_dir, f"{self._current_sticker_id}.raw.webm"
+        )
+        encode(delays, webm_uncapped)
+        self.cap_webm_duration_and_size(delays, encode, webm_uncapped, out_file)
+
+    def encoder_preset(self, output_format: OutputFormat):
+        for key in (f"{output_format.name}_PRESET", "PRESET"):
+            if self.extra_params.get(key) in ENCODER_PRESETS:
+                return self.extra_params[key]
+        return DEFAULT_ENCODER_PRESET
 
     def make_frame_temp_dir(self):
         frame_working_dir_path = os.path.join(
@@ -157,9 +774,9 @@ class ImageProcessorThread(Thread):
 
     def overlay_sticker_message(self, in_img, in_overlay, out_file):
         # overlay in_overlay on in_img
-        subprocess.call(
+        _call(
             [
-                _MAGICK_BIN,
+                find_magick(),
                 in_img,
                 in_overlay,
                 "-gravity",
@@ -169,15 +786,25 @@ class ImageProcessorThread(Thread):
             ]
         )
 
+    @staticmethod
+    def _scaled_apng_output(in_file, out_file, size):
+        return (
+            ffmpeg.input(in_file, f="apng")
+            .filter(
+                "scale",
+                w=f"if(gt(iw,ih),{size},-1)",
+                h=f"if(gt(iw,ih),-1,{size})",
+            )
+            .output(out_file, pix_fmt="rgba", f="apng")
+        )
+
     def scale_image(self, in_file, out_file, size):
         if self._sticker_has_animation:
-            ffmpeg.input(in_file, f="apng").filter(
-                "scale", w=f"if(gt(iw,ih),{size},-1)", h=f"if(gt(iw,ih),-1,{size})"
-            ).output(out_file, pix_fmt="rgba", f="apng").run(quiet=True)
+            _run_ffmpeg(self._scaled_apng_output(in_file, out_file, size), quiet=True)
         else:
-            subprocess.call(
+            _call(
                 [
-                    _MAGICK_BIN,
+                    find_magick(),
                     "PNG:" + in_file,
                     "-resize",
                     f"{size}x{size}",
@@ -185,6 +812,22 @@ class ImageProcessorThread(Thread):
                 ]
             )
 
+    def scale_images(self, pairs, size):
+        # scale_image for a list of (in_file, out_file) with a single spawn
+        if self._sticker_has_animation:
+            _run_ffmpeg(
+                ffmpeg.merge_outputs(
+                    *[self._scaled_apng_output(i, o, size) for i, o in pairs]
+                ).overwrite_output(),
+                quiet=True,
+            )
+        else:
+            args = [find_magick()]
+            for in_file, out_file in pairs:
+                args += ["PNG:" + in_file, "-resize", f"{size}x{size}"]
+                args += ["-write", "PNG:" + out_file, "+delete"]
+            _call(args + ["null:"])
+
     def _make_frame_temp_dir(self):
         frame_tmp_path = os.path.join(self.temp_dir, self._current_sticker_id)
         try:
@@ -194,31 +837,56 @@ class ImageProcessorThread(Thread):
         return frame_tmp_path
 
     def apng_convert_to_rgba(self, in_file, out_file):
-        ffmpeg.input(in_file, f="apng").overwrite_output(
-            out_file, pix_fmt="rgba", f="apng"
-        ).run(quiet=True)
+        _run_ffmpeg(
+            ffmpeg.input(in_file, f="apng").overwrite_output(
+                out_file, pix_fmt="rgba", f="apng"
+            ),
+            quiet=True,
+        )
 
     def split_apng_frames(self, in_file, frame_dir):
         # split frames using imagemagick
-        subprocess.call(
+        _call(
             [
-                _MAGICK_BIN,
+                find_magick(),
                 "APNG:" + in_file,
                 "-coalesce",
                 os.path.join(frame_dir, "frame-%02d.png"),
             ]
         )
 
-    def _make_frame_file(self, durations, frame_working_dir_path):
+    @staticmethod
+    def collapse_frame_files(frame_dir, durations):
+        """
+        Return [(frame file name, duration)] for the split frames, with
+        identical consecutive frames listed once for their summed duration.
+        """
+        frames = []
+        last_digest = None
+        for i, d in enumerate(durations):
+            name = f"frame-{i:02d}.png"
+            try:
+                digest = apng.image_digest(os.path.join(frame_dir, name))
+            except (OSError, apng.PNGFormatError):
+                digest = None
+            if frames and digest is not None and digest == last_digest:
+                frames[-1] = (frames[-1][0], round(frames[-1][1] + d, 3))
+            else:
+                frames.append((name, d))
+            last_digest = digest
+        return frames
+
+    def _make_frame_file(self, frames, frame_working_dir_path):
+        # frames: [(frame file name, duration)]
         with open(os.path.join(frame_working_dir_path, "frames.txt"), "w") as f:
-            for i, d in enumerate(durations):
-                f.write(f"file 'frame-{i:02d}.png'\n")
+            for name, d in frames:
+                f.write(f"file '{name}'\n")
                 f.write(f"duration {d}\n")
             # last frame need to be put twice, see: https://trac.ffmpeg.org/wiki/Slideshow
-            # f.write(f"file 'frame-{len(durations) - 1}.png'\n")
+            # f.write(f"file '{frames[-1][0]}'\n")
         return os.path.join(frame_working_dir_path, "frames.txt")
 
-    def to_webm(self, durations, frame_dir, out_file):
+    def to_webm(self, frames, frame_dir, out_file):
         # framerate is needed here since telegram ios client will use framerate as play speed
         # in fact, framerate in webm should be informative only
         # ffmpeg will use 25 by default, here according to telegram we use 30
@@ -228,27 +896,102 @@ class ImageProcessorThread(Thread):
         # so shouldn't set it too small - which will cause too much error
         # https://bugs.telegram.org/c/14778
 
-        frame_file_path = self._make_frame_file(durations, frame_dir)
+        frame_file_path = self._make_frame_file(frames, frame_dir)
 
-        ffmpeg.input(frame_file_path, format="concat").output(
-            out_file, r=30, fps_mode="cfr", f="webm"
-        ).overwrite_output().run(quiet=False)
+        _run_ffmpeg(
+            ffmpeg.input(frame_file_path, format="concat")
+            .output(
+                out_file,
+                r=WEBM_FPS,
+                fps_mode="cfr",
+                f="webm",
+                vcodec="libvpx-vp9",
+                **VP9_PRESETS[self.encoder_preset(OutputFormat.WEBM)],
+            )
+            .overwrite_output(),
+            quiet=True,
+        )
 
-    def get_animation_delays(self, in_apng):
-        p = subprocess.Popen(
-            [_MAGICK_BIN, "identify", "-format", r"%T,", "APNG:" + in_apng],
-            stdin=None,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            shell=False,
+    def buffer_to_webm(self, buffer, delays, out_file):
+        # to_webm fed with raw frames on stdin; the constant frame rate is
+        # produced here by repeating frames instead of by ffmpeg
+        _run_ffmpeg(
+            ffmpeg.input(
+                "pipe:",
+                f="rawvideo",
+                pix_fmt=buffer.pix_fmt,
+                s=f"{buffer.width}x{buffer.height}",
+                r=WEBM_FPS,
+            )
+            .output(
+                out_file,
+                r=WEBM_FPS,
+                f="webm",
+                vcodec="libvpx-vp9",
+                **VP9_PRESETS[self.encoder_preset(OutputFormat.WEBM)],
+            )
+            .overwrite_output(),
+            quiet=True,
+            input=buffer.raw_video(WEBM_FPS, delays),
         )
-        out, err = p.communicate()
+
+    def prefetch_animation_delays(self, apng_files):
+        # one identify for many files, get_animation_delays picks the results up
+        start = time.perf_counter()
+        try:
+            with tracing.span(
+                "identify", cat="subprocess", count=len(apng_files)
+            ), subprocess_limits(self.timeout, self.cancel):
+                _, out, err = _spawn(
+                    [find_magick(), "identify", "-format", r"%i|%T\n"]
+                    + ["APNG:" + f for f in apng_files],
+                    capture=True,
+                )
+        except (OperationTimeout, Cancelled):
+            # get_animation_delays asks again for each file
+            return
+        finally:
+            _count_spawn("identify", start)
+        delays = {}
+        for line in out.decode().splitlines():
+            file, _, delay = line.rpartition("|")
+            file = file.removeprefix("APNG:")
+            try:
+                delays.setdefault(file, []).append(round(int(delay) / 100, 3))
+            except ValueError:
+                continue
+        self._known_delays.update((f, delays[f]) for f in apng_files if f in delays)
+
+    def get_animation_delays(self, in_apng):
+        if in_apng in self._known_delays:
+            return self._known_delays.pop(in_apng)
+        start = time.perf_counter()
+        try:
+            with tracing.span("identify", cat="subprocess"):
+                _, out, err = _spawn(
+                    [find_magick(), "identify", "-format", r"%T,", "APNG:" + in_apng],
+                    capture=True,
+                )
+        finally:
+            _count_spawn("identify", start)
         frame_data_str_output = out.decode().strip()[:-1]
         delays = [round(int(i) / 100, 3) for i in frame_data_str_output.split(",")]
         return delays
 
     def probe_duration(self, file):
-        duration_str = ffmpeg.probe(file)["streams"][0]["tags"]["DURATION"]
+        start = time.perf_counter()
+        try:
+            with tracing.span("ffprobe", cat="subprocess"):
+                # ffmpeg.probe() without its unbounded wait
+                returncode, out, err = _spawn(
+                    ["ffprobe", "-show_format", "-show_streams", "-of", "json", file],
+                    capture=True,
+                )
+        finally:
+            _count_spawn("ffprobe", start)
+        if returncode:
+            raise ffmpeg.Error("ffprobe", out, err)
+        duration_str = json.loads(out)["streams"][0]["tags"]["DURATION"]
 
         hms, us = duration_str.split(".")
         us = us[:6]
@@ -259,24 +1002,29 @@ class ImageProcessorThread(Thread):
         ).total_seconds()
         return duration_seconds
 
-    def cap_webm_duration_and_size(self, durations, in_webm, frame_dir, out_file):
+    def cap_webm_duration_and_size(self, delays, encode, in_webm, out_file):
+        """
+        delays are the frame durations in_webm was encoded with; encode(delays,
+        path) encodes the same frames again with other durations.
+        """
         # TODO even after optimization, webm file size may still exceed the limit. Lossy compression may be needed
-        print("Cap webm duration and size")
         # probe duration, ensure it's max 3 seconds
         duration_seconds = self.probe_duration(in_webm)
 
         if duration_seconds > WEBM_DURATION_SEC_MAX:
+            metrics.inc("webm_over_duration_total")
             factor = duration_seconds / WEBM_DURATION_SEC_MAX
             while True:
                 # loop to reduce frame duration until it's less than WEBM_DURATION_SEC_MAX seconds
-                new_delays = [int(d / factor * 1000) / 1000 for d in durations]
-                print("New delays: ", new_delays)
-                self.to_webm(new_delays, frame_dir, out_file)
+                new_delays = [int(d / factor * 1000) / 1000 for d in delays]
+                encode(new_delays, out_file)
                 new_duration_seconds = self.probe_duration(file=out_file)
                 if new_duration_seconds > WEBM_DURATION_SEC_MAX:
-                    print(
-                        f"WARNING: Duration too long, cap again: {new_duration_seconds} seconds"
-                    )
+                    with _print_lock:
+                        print(
+                            f"WARNING: {self._current_sticker_id} duration too long,"
+                            f" cap again: {new_duration_seconds} seconds"
+                        )
                     factor = factor * 1.05
                 else:
                     break
@@ -285,28 +1033,34 @@ class ImageProcessorThread(Thread):
 
         # see if file size is OK
         if os.path.getsize(out_file) > WEBM_SIZE_KB_MAX * 1024:
+            metrics.inc("webm_over_size_total")
             # TODO optimize file size
             with _print_lock:
                 print(
-                    f"WARNING: File size too large, {os.path.getsize(out_file) / 1024} KB"
+                    f"WARNING: {self._current_sticker_id} file size too large,"
+                    f" {os.path.getsize(out_file) / 1024:.1f} KB"
                 )
 
     def remove_alpha(self, in_file, out_file):
         if self._sticker_has_animation:
-            ffmpeg.input(in_file, f="apng").filter(
-                "geq",
-                r="(r(X,Y)*alpha(X,Y)/255)+(255-alpha(X,Y))",
-                g="(g(X,Y)*alpha(X,Y)/255)+(255-alpha(X,Y))",
-                b="(b(X,Y)*alpha(X,Y)/255)+(255-alpha(X,Y))",
-                a=255,
-            ).output(out_file, f="apng", pix_fmt="rgb24").overwrite_output().run(
-                quiet=True
+            _run_ffmpeg(
+                ffmpeg.input(in_file, f="apng")
+                .filter(
+                    "geq",
+                    r="(r(X,Y)*alpha(X,Y)/255)+(255-alpha(X,Y))",
+                    g="(g(X,Y)*alpha(X,Y)/255)+(255-alpha(X,Y))",
+                    b="(b(X,Y)*alpha(X,Y)/255)+(255-alpha(X,Y))",
+                    a=255,
+                )
+                .output(out_file, f="apng", pix_fmt="rgb24")
+                .overwrite_output(),
+                quiet=True,
             )
         else:
             # use magick for static image
-            subprocess.call(
+            _call(
                 [
-                    "magick",
+                    find_magick(),
                     "convert",
                     "PNG:" + in_file,
                     "-background",
@@ -319,21 +1073,75 @@ class ImageProcessorThread(Thread):
                 ]
             )
 
+    def optimize_png(self, in_file, out_file, min_quality=None):
+        # in this worker thread, no spawn; returns the bytes saved
+        import pngopt
+
+        result = pngopt.optimize_png(in_file, out_file, min_quality)
+        metrics.inc("png_optimize_bytes_total", result.size_before, stage="before")
+        metrics.inc("png_optimize_bytes_total", result.size_after, stage="after")
+        if result.quantized:
+            metrics.inc("png_quantized_total")
+        return result.saved
+
+    def optimize_apng(self, in_file, out_file, verify=False):
+        # in this worker thread, no spawn; returns the bytes saved
+        import apngopt
+
+        result = apngopt.optimize_apng(in_file, out_file, verify)
+        metrics.inc("png_optimize_bytes_total", result.size_before, stage="before")
+        metrics.inc("png_optimize_bytes_total", result.size_after, stage="after")
+        metrics.inc("apng_frames_total", result.frames_before, stage="before")
+        metrics.inc("apng_frames_total", result.frames_after, stage="after")
+        if result.verified is False:
+            metrics.inc("apng_verify_failures_total")
+        return result.saved
+
+    def webp_options(self):
+        # the preset plus the WEBP_LOSSLESS=1 and WEBP_QUALITY=0-100 extra params
+        options = dict(WEBP_PRESETS[self.encoder_preset(OutputFormat.WEBP)])
+        lossless = str(self.extra_params.get("WEBP_LOSSLESS", ""))
+        options["lossless"] = lossless.lower() not in ("", "0", "false")
+        options["quality"] = DEFAULT_WEBP_QUALITY
+        if self.extra_params.get("WEBP_QUALITY"):
+            try:
+                quality = int(self.extra_params["WEBP_QUALITY"])
+                options["quality"] = max(0, min(100, quality))
+            except ValueError:
+                pass
+        return options
+
+    def buffer_to_webp(self, buffer, out_file):
+        # in this worker thread with Pillow's libwebp, no spawn
+        options = self.webp_options()
+        buffer.write_webp(out_file, **options)
+        mode = "lossless" if options["lossless"] else "lossy"
+        metrics.inc("webp_encoded_total", mode=mode)
+
     def to_gif(self, in_file, out_file, alpha_threshold):
         if self._sticker_has_animation:
             f = "apng"
         else:
             f = "image2"
+        palettegen_options, paletteuse_options = GIF_PRESETS[
+            self.encoder_preset(OutputFormat.GIF)
+        ]
         palette_stream = ffmpeg.input(in_file, f=f).filter(
-            "palettegen", reserve_transparent=1
+            "palettegen", reserve_transparent=1, **palettegen_options
+        )
+        _run_ffmpeg(
+            ffmpeg.filter(
+                [ffmpeg.input(in_file, f=f), palette_stream],
+                "paletteuse",
+                alpha_threshold=alpha_threshold,
+                **paletteuse_options,
+            )
+            .output(out_file, f="gif")
+            .overwrite_output(),
+            quiet=True,
         )
-        ffmpeg.filter(
-            [ffmpeg.input(in_file, f=f), palette_stream],
-            "paletteuse",
-            alpha_threshold=alpha_threshold,
-        ).output(out_file, f="gif").overwrite_output().run(quiet=True)
         # issue with tencent qq/tim
-        subprocess.call(["magick", out_file, "-coalesce", out_file])
+        _call([find_magick(), out_file, "-coalesce", out_file])
 
     def to_video(self, in_pic, in_audio, out_file):
         streams = []
@@ -343,21 +1151,61 @@ class ImageProcessorThread(Thread):
             h="ceil(ih/2)*2",  # make w,h divisible by 2, enable H.264
         )
         streams.append(in_pic_stream)
-        if in_audio:
-            audio_input = ffmpeg.input(in_audio)
-            streams.append(audio_input)
-        ffmpeg.output(
-            *streams, out_file, pix_fmt="yuv420p", movflags="faststart"
-        ).overwrite_output().run(quiet=True)
+        audio_options = {}
+        # in_audio is set for every sticker, most of them have no sound file
+        if in_audio and os.path.isfile(in_audio):
+            streams.append(ffmpeg.input(in_audio).audio)
+            # AAC goes into MP4 as is, only other codecs are re-encoded
+            audio_options["acodec"] = "copy" if m4a_is_aac(in_audio) else "aac"
+            try:
+                duration = apng.animation_duration(in_pic)
+            except (OSError, apng.PNGFormatError):
+                duration = 0
+            if duration:
+                # a longer sound is cut at the end of the animation (at a
+                # packet boundary when copied); a shorter one just ends early
+                audio_options["t"] = round(duration, 3)
+        metrics.inc("mp4_audio_total", mode=audio_options.get("acodec", "none"))
+        _run_ffmpeg(
+            ffmpeg.output(
+                *streams,
+                out_file,
+                f="mp4",
+                pix_fmt="yuv420p",
+                movflags="faststart",
+                vcodec="libx264",
+                **X264_PRESETS[self.encoder_preset(OutputFormat.MP4)],
+                **audio_options,
+            ).overwrite_output(),
+            quiet=True,
+        )
+
+
+class ImageProcessorThread(Thread):
+    def __init__(self, task_queue, config: ProcessorConfig):
+        Thread.__init__(self, name="ImageProcessorThread")
+        self.queue = task_queue
+        self.processor = ImageProcessor(config)
+
+    def run(self):
+        while not self.queue.empty():
+            try:
+                task: ProcessTask = self.queue.get_nowait()
+            except queue.Empty:
+                continue
+            try:
+                self.processor.run_task(task)
+            finally:
+                self.queue.task_done()
+                increase_counter()
 
 
 def process_sticker_icon(in_file, out_file):
-    ffmpeg.input(in_file, f="apng").filter(
-        "scale", w="if(gt(iw,ih),100,-1)", h="if(gt(iw,ih),-1,100)"
-    ).filter(
-        "pad", w="100", h="100", x="(ow-iw)/2", y="(oh-ih)/2", color="black@0"
-    ).output(
-        out_file
-    ).overwrite_output().run(
-        quiet=True
+    _run_ffmpeg(
+        ffmpeg.input(in_file, f="apng")
+        .filter("scale", w="if(gt(iw,ih),100,-1)", h="if(gt(iw,ih),-1,100)")
+        .filter("pad", w="100", h="100", x="(ow-iw)/2", y="(oh-ih)/2", color="black@0")
+        .output(out_file)
+        .overwrite_output(),
+        quiet=True,
     )
@@ -0,0 +1,373 @@
+"""
+Long-running conversion service.
+
+Pack conversion jobs are accepted over HTTP (TCP or a Unix socket) and run on
+one shared, warm Pipeline. Identical jobs that are still queued or running are
+deduplicated. Finished jobs are forgotten after JOB_TTL seconds, or sooner once
+more than MAX_FINISHED_JOBS have finished.
+
+    python service.py --port 8080
+    curl -X POST localhost:8080/jobs -d '{"pack": "11537", "options": {"output_fmt": "webm"}}'
+    curl localhost:8080/jobs/<job id>
+
+Endpoints:
+    POST /jobs        {"pack": id or url, "options": {PackOptions fields}}
+    GET  /jobs        all jobs
+    GET  /jobs/<id>   one job, including the result once it is done
+    GET  /metrics     counters and latencies in the Prometheus text format
+    GET  /health
+"""
+import argparse
+import json
+import os
+import socketserver
+import threading
+import time
+import traceback
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import metrics
+import tuning
+import webreq
+from catalog import DEFAULT_CATALOG_PATH, Catalog
+from pipeline import (
+    DEFAULT_DOWNLOAD_THREADS,
+    DEFAULT_PROCESS_THREADS,
+    PackOptions,
+    Pipeline,
+)
+
+DEFAULT_PORT = 8080
+DEFAULT_CONCURRENT_JOBS = 2
+# finished jobs stay queryable this many seconds, and at most this many of them
+JOB_TTL = 3600.0
+MAX_FINISHED_JOBS = 1000
+# PackOptions fields clients may set; output locations are decided by the service
+JOB_OPTION_FIELDS = {
+    "pack_type",
+    "lang",
+    "output_fmt",
+    "scale",
+    "remove_alpha",
+    "extra_params",
+    "no_default_txt_overlay",
+    "no_sub_dir",
+    "redownload",
+    "reprocess",
+    "update",
+    "optimize_png",
+    "task_timeout",
+    "task_retries",
+}
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+
+class JobRequestError(ValueError):
+    pass
+
+
+class Job:
+    def __init__(self, key, pack, options: dict):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.pack = pack
+        self.options = options
+        self.status = JOB_QUEUED
+        # stage -> [done, total]
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "pack": self.pack,
+            "options": self.options,
+            "status": self.status,
+            "progress": self.progress,
+            "result": self.result,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+def job_key(pack, options: dict):
+    return json.dumps([pack, options], sort_keys=True)
+
+
+def validate_job_request(body):
+    if not isinstance(body, dict) or not isinstance(body.get("pack"), str):
+        raise JobRequestError('"pack" (pack id or url) is required')
+    options = body.get("options") or {}
+    if not isinstance(options, dict):
+        raise JobRequestError('"options" must be an object')
+    unknown = set(options) - JOB_OPTION_FIELDS
+    if unknown:
+        raise JobRequestError(f"Unknown options: {', '.join(sorted(unknown))}")
+    return body["pack"].strip(), options
+
+
+class JobManager:
+    def __init__(
+        self,
+        pipeline: Pipeline,
+        concurrent_jobs=DEFAULT_CONCURRENT_JOBS,
+        log=print,
+        job_ttl=JOB_TTL,
+        max_finished_jobs=MAX_FINISHED_JOBS,
+    ):
+        self.pipeline = pipeline
+        self.log = log
+        self.job_ttl = job_ttl
+        self.max_finished_jobs = max_finished_jobs
+        self._executor = ThreadPoolExecutor(concurrent_jobs, thread_name_prefix="Job")
+        self._lock = threading.Lock()
+        self._jobs = {}
+        # key -> queued or running job with that key
+        self._in_flight = {}
+        # finished jobs, oldest first
+        self._finished = deque()
+
+    def _evict(self):
+        # with self._lock held
+        expired = time.time() - self.job_ttl
+        while self._finished and (
+            len(self._finished) > self.max_finished_jobs
+            or self._finished[0].finished < expired
+        ):
+            del self._jobs[self._finished.popleft().id]
+
+    def submit(self, pack, options: dict):
+        """Return (job, deduplicated)."""
+        key = job_key(pack, options)
+        with self._lock:
+            self._evict()
+            existing = self._in_flight.get(key)
+            if existing is not None:
+                return existing, True
+            job = Job(key, pack, options)
+            self._jobs[job.id] = job
+            self._in_flight[key] = job
+        self._executor.submit(self._run, job)
+        self.log(f"Job {job.id} queued: {pack}")
+        return job, False
+
+    def _run(self, job: Job):
+        job.status = JOB_RUNNING
+        job.started = time.time()
+
+        def progress(stage, done, total):
+            job.progress[stage] = [done, total]
+
+        try:
+            result = self.pipeline.run(
+                job.pack, PackOptions(**job.options), progress=progress
+            )
+            job.result = result.to_dict()
+            job.status = JOB_DONE
+        except Exception as e:
+            job.error = repr(e)
+            job.status = JOB_FAILED
+            traceback.print_exc()
+        finally:
+            job.finished = time.time()
+            with self._lock:
+                self._in_flight.pop(job.key, None)
+                self._finished.append(job)
+                self._evict()
+        self.log(f"Job {job.id} {job.status} in {job.finished - job.started:.1f}s")
+
+    def get(self, job_id):
+        with self._lock:
+            self._evict()
+            return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            self._evict()
+            return list(self._jobs.values())
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+class _ServiceHandler(BaseHTTPRequestHandler):
+    def _send_json(self, status, body):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        jobs: JobManager = self.server.jobs
+        path = self.path.rstrip("/")
+        if path == "/health":
+            self._send_json(200, {"status": "ok"})
+        elif path == "/metrics":
+            content = metrics.to_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        elif path == "/jobs":
+            self._send_json(200, {"jobs": [j.to_dict() for j in jobs.list()]})
+        elif path.startswith("/jobs/"):
+            job = jobs.get(path[len("/jobs/") :])
+            if job is None:
+                self._send_json(404, {"error": "No such job"})
+            else:
+                self._send_json(200, {"job": job.to_dict()})
+        else:
+            self._send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            self._send_json(404, {"error": "Not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"null")
+            pack, options = validate_job_request(body)
+        except (ValueError, JobRequestError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        job, deduplicated = self.server.jobs.submit(pack, options)
+        self._send_json(
+            200 if deduplicated else 202,
+            {"job": job.to_dict(), "deduplicated": deduplicated},
+        )
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ServiceHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, jobs: JobManager):
+        super().__init__(address, _ServiceHandler)
+        self.jobs = jobs
+
+
+class UnixServiceHTTPServer(
+    socketserver.ThreadingMixIn, socketserver.UnixStreamServer
+):
+    daemon_threads = True
+
+    def __init__(self, path, jobs: JobManager):
+        super().__init__(path, _ServiceHandler)
+        self.jobs = jobs
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ("unix", 0)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Sticker conversion service")
+    arg_parser.add_argument("--host", type=str, default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    arg_parser.add_argument(
+        "--unix", type=str, help="Listen on this Unix socket instead of TCP"
+    )
+    arg_parser.add_argument("--proxy", type=str, help="proxy, http(s)://addr:port")
+    arg_parser.add_argument(
+        "--cdn-base-url", type=str, help="Use this host instead of the LINE CDN"
+    )
+    arg_parser.add_argument(
+        "-o", "--output-dir", type=str, help="Output directory for processed stickers"
+    )
+    arg_parser.add_argument(
+        "-t",
+        "--threads",
+        type=tuning.parse_threads,
+        default=DEFAULT_PROCESS_THREADS,
+        help='Processing threads shared by all jobs, or "auto" to size them per pack',
+    )
+    arg_parser.add_argument(
+        "--catalog",
+        type=str,
+        default=DEFAULT_CATALOG_PATH,
+        help="Local pack catalog checked before fetching metadata or yabe pages",
+    )
+    arg_parser.add_argument(
+        "--no-catalog", action="store_true", help="Do not use the local pack catalog"
+    )
+    arg_parser.add_argument(
+        "--jobs",
+        type=int,
+        default=DEFAULT_CONCURRENT_JOBS,
+        help="Packs converted at the same time",
+    )
+    arg_parser.add_argument(
+        "--job-ttl",
+        type=float,
+        default=JOB_TTL,
+        help="Seconds finished jobs can still be queried",
+    )
+    arg_parser.add_argument(
+        "--max-finished-jobs",
+        type=int,
+        default=MAX_FINISHED_JOBS,
+        help="Finished jobs kept, the oldest are forgotten first",
+    )
+    args = arg_parser.parse_args()
+
+    if args.cdn_base_url:
+        webreq.set_base_urls(cdn=args.cdn_base_url)
+    catalog = None if args.no_catalog else Catalog(args.catalog)
+    pipeline = Pipeline(
+        output_dir=args.output_dir,
+        threads=args.threads,
+        download_threads=(
+            tuning.AUTO if args.threads == tuning.AUTO else DEFAULT_DOWNLOAD_THREADS
+        ),
+        proxy=args.proxy,
+        catalog=catalog,
+    )
+    jobs = JobManager(
+        pipeline,
+        args.jobs,
+        job_ttl=args.job_ttl,
+        max_finished_jobs=args.max_finished_jobs,
+    )
+    if args.unix:
+        if os.path.exists(args.unix):
+            os.remove(args.unix)
+        server = UnixServiceHTTPServer(args.unix, jobs)
+        print("Listening on", args.unix)
+    else:
+        server = ServiceHTTPServer((args.host, args.port), jobs)
+        print(f"Listening on http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        jobs.close()
+        pipeline.close()
+        if catalog:
+            catalog.close()
+        if args.unix and os.path.exists(args.unix):
+            os.remove(args.unix)
+
+
+if __name__ == "__main__":
+    main()
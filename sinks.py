@@ -0,0 +1,315 @@
+"""
+Output sinks for processed stickers.
+
+A sink receives every finished file as soon as its task completes. The default
+DirectorySink copies files into the output tree; ZipSink and TarSink stream
+them into a single archive (a file or a non-seekable stream such as stdout)
+without an intermediate directory; S3Sink uploads them to an S3-compatible
+bucket. Files are copied in fixed-size chunks, so memory use does not depend on
+the sticker size.
+
+Paths given to a sink are the regular output paths; archive sinks store them
+relative to the sink root, and S3Sink under its key prefix.
+"""
+import hashlib
+import mimetypes
+import os
+import shutil
+import sys
+import tarfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import metrics
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+S3_SCHEME = "s3://"
+# uploads of the files of one add_tree call in parallel, and connections kept
+UPLOAD_THREADS = 8
+UPLOAD_RETRIES = 5
+# files above the threshold are uploaded in parts, several at a time
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+MULTIPART_CONCURRENCY = 4
+# object metadata holding the SHA-256 of the content, to skip unchanged files
+CHECKSUM_METADATA = "sha256"
+
+CONTENT_TYPES = {
+    "webm": "video/webm",
+    "webp": "image/webp",
+    "png": "image/png",
+    "gif": "image/gif",
+    "mp4": "video/mp4",
+    "m4a": "audio/mp4",
+}
+
+# endpoint of S3-compatible services (MinIO, mock_s3.py), None for AWS or the
+# AWS_ENDPOINT_URL environment variable
+_s3_endpoint_url = None
+
+# already compressed formats gain nothing from deflate
+DEFAULT_ZIP_COMPRESSION = {
+    "webm": zipfile.ZIP_STORED,
+    "gif": zipfile.ZIP_STORED,
+    "mp4": zipfile.ZIP_STORED,
+    "webp": zipfile.ZIP_STORED,
+    "m4a": zipfile.ZIP_STORED,
+    "png": zipfile.ZIP_DEFLATED,
+}
+
+ARCHIVE_COMPRESSION_CHOICES = ["auto", "stored", "deflate"]
+
+
+class OutputSink:
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def arcname(self, dest_path):
+        return os.path.relpath(os.path.abspath(dest_path), self.root).replace(
+            os.sep, "/"
+        )
+
+    def add_file(self, src_path, dest_path):
+        raise NotImplementedError
+
+    def add_tree(self, src_dir, dest_dir):
+        for dir_path, _, file_names in os.walk(src_dir):
+            for fn in sorted(file_names):
+                src = os.path.join(dir_path, fn)
+                dest = os.path.join(dest_dir, os.path.relpath(src, src_dir))
+                self.add_file(src, dest)
+
+    @property
+    def writes_files(self):
+        # whether dest paths exist on disk once added
+        return False
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+class DirectorySink(OutputSink):
+    def add_file(self, src_path, dest_path):
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        shutil.copy(src_path, dest_path)
+
+    def add_tree(self, src_dir, dest_dir):
+        shutil.copytree(src_dir, dest_dir, dirs_exist_ok=True)
+
+    @property
+    def writes_files(self):
+        return True
+
+
+class ZipSink(OutputSink):
+    def __init__(
+        self, root, file, compression=None, default_compression=zipfile.ZIP_DEFLATED
+    ):
+        """
+        file is a path or a binary file object, which does not need to be seekable.
+        compression maps file extensions to zipfile.ZIP_STORED/ZIP_DEFLATED,
+        extensions not listed use default_compression.
+        """
+        super().__init__(root)
+        if compression is None:
+            compression = DEFAULT_ZIP_COMPRESSION
+        self.compression = compression
+        self.default_compression = default_compression
+        self._lock = Lock()
+        self._zip = zipfile.ZipFile(file, "w", allowZip64=True)
+
+    def add_file(self, src_path, dest_path):
+        ext = os.path.splitext(dest_path)[1].lstrip(".").lower()
+        info = zipfile.ZipInfo.from_file(src_path, self.arcname(dest_path))
+        info.compress_type = self.compression.get(ext, self.default_compression)
+        # one writer at a time, entries can not be interleaved
+        with self._lock, open(src_path, "rb") as src:
+            with self._zip.open(info, "w", force_zip64=True) as dest:
+                shutil.copyfileobj(src, dest, COPY_CHUNK_SIZE)
+
+    def close(self):
+        with self._lock:
+            self._zip.close()
+
+
+class TarSink(OutputSink):
+    def __init__(self, root, file, compression=""):
+        """
+        file is a path or a binary file object, which does not need to be seekable.
+        compression is "", "gz", "bz2" or "xz" and applies to the whole stream.
+        """
+        super().__init__(root)
+        self._lock = Lock()
+        mode = f"w|{compression}"
+        if isinstance(file, str):
+            self._tar = tarfile.open(file, mode)
+        else:
+            self._tar = tarfile.open(fileobj=file, mode=mode)
+
+    def add_file(self, src_path, dest_path):
+        info = tarfile.TarInfo(self.arcname(dest_path))
+        info.size = os.path.getsize(src_path)
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        with self._lock, open(src_path, "rb") as src:
+            self._tar.addfile(info, src)
+
+    def close(self):
+        with self._lock:
+            self._tar.close()
+
+
+def set_s3_endpoint(url):
+    global _s3_endpoint_url
+    _s3_endpoint_url = url
+
+
+def file_digests(path):
+    """(hex MD5, hex SHA-256) of a file, read once."""
+    md5, sha256 = hashlib.md5(), hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(COPY_CHUNK_SIZE):
+            md5.update(chunk)
+            sha256.update(chunk)
+    return md5.hexdigest(), sha256.hexdigest()
+
+
+class S3Sink(OutputSink):
+    def __init__(self, root, url, endpoint_url=None, threads=UPLOAD_THREADS):
+        """
+        url is s3://bucket/prefix. Objects whose SHA-256 metadata (or, for
+        objects uploaded in one piece by something else, ETag) matches the
+        local file are not uploaded again. Needs boto3.
+        """
+        super().__init__(root)
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+            from botocore.config import Config
+        except ImportError:
+            raise RuntimeError("s3:// output needs boto3, pip install boto3") from None
+        bucket, _, prefix = url[len(S3_SCHEME) :].partition("/")
+        if not bucket:
+            raise ValueError(f"No bucket in {url}")
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        endpoint_url = endpoint_url or _s3_endpoint_url
+        config = Config(
+            max_pool_connections=threads * MULTIPART_CONCURRENCY,
+            retries={"max_attempts": UPLOAD_RETRIES, "mode": "standard"},
+            # local stand-ins serve one host, without bucket subdomains
+            s3={"addressing_style": "path"} if endpoint_url else None,
+        )
+        # boto3 clients are thread safe and share their connection pool
+        self._client = boto3.session.Session().client(
+            "s3", endpoint_url=endpoint_url, config=config
+        )
+        self._transfer_config = TransferConfig(
+            multipart_threshold=MULTIPART_THRESHOLD,
+            multipart_chunksize=MULTIPART_CHUNK_SIZE,
+            max_concurrency=MULTIPART_CONCURRENCY,
+        )
+        self._pool = ThreadPoolExecutor(threads, thread_name_prefix="S3Upload")
+        self._lock = Lock()
+        self.uploaded = 0
+        self.skipped = 0
+
+    def key(self, dest_path):
+        name = self.arcname(dest_path)
+        return f"{self.prefix}/{name}" if self.prefix else name
+
+    def _remote_matches(self, key, md5, sha256):
+        from botocore.exceptions import ClientError
+
+        try:
+            head = self._client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        if CHECKSUM_METADATA in head.get("Metadata", {}):
+            return head["Metadata"][CHECKSUM_METADATA] == sha256
+        return head.get("ETag", "").strip('"') == md5
+
+    def add_file(self, src_path, dest_path):
+        key = self.key(dest_path)
+        md5, sha256 = file_digests(src_path)
+        if self._remote_matches(key, md5, sha256):
+            with self._lock:
+                self.skipped += 1
+            metrics.inc("s3_objects_total", result="skipped")
+            return
+        ext = os.path.splitext(dest_path)[1].lstrip(".").lower()
+        content_type = CONTENT_TYPES.get(ext) or (
+            mimetypes.guess_type(dest_path)[0] or "application/octet-stream"
+        )
+        start = time.perf_counter()
+        self._client.upload_file(
+            src_path,
+            self.bucket,
+            key,
+            ExtraArgs={
+                "ContentType": content_type,
+                "Metadata": {CHECKSUM_METADATA: sha256},
+            },
+            Config=self._transfer_config,
+        )
+        metrics.observe("s3_upload_seconds", time.perf_counter() - start)
+        metrics.inc("s3_upload_bytes_total", os.path.getsize(src_path))
+        metrics.inc("s3_objects_total", result="uploaded")
+        with self._lock:
+            self.uploaded += 1
+
+    def add_tree(self, src_dir, dest_dir):
+        jobs = []
+        for dir_path, _, file_names in os.walk(src_dir):
+            for fn in sorted(file_names):
+                src = os.path.join(dir_path, fn)
+                dest = os.path.join(dest_dir, os.path.relpath(src, src_dir))
+                jobs.append(self._pool.submit(self.add_file, src, dest))
+        for job in jobs:
+            job.result()
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+
+
+def open_sink(root, output_archive=None, compression="auto"):
+    """
+    Return the sink for an output root. output_archive is None (plain
+    directory tree), "-" (zip on stdout), an s3://bucket/prefix url or a path
+    ending in .zip, .tar, .tar.gz/.tgz, .tar.bz2 or .tar.xz. compression is
+    one of ARCHIVE_COMPRESSION_CHOICES and only applies to zip archives.
+    """
+    if not output_archive:
+        return DirectorySink(root)
+    if output_archive.startswith(S3_SCHEME):
+        return S3Sink(root, output_archive)
+    zip_args = {}
+    if compression == "stored":
+        zip_args = {"compression": {}, "default_compression": zipfile.ZIP_STORED}
+    elif compression == "deflate":
+        zip_args = {"compression": {}, "default_compression": zipfile.ZIP_DEFLATED}
+    if output_archive == "-":
+        return ZipSink(root, sys.__stdout__.buffer, **zip_args)
+    name = output_archive.lower()
+    for suffixes, tar_compression in (
+        ((".tar",), ""),
+        ((".tar.gz", ".tgz"), "gz"),
+        ((".tar.bz2",), "bz2"),
+        ((".tar.xz",), "xz"),
+    ):
+        if name.endswith(suffixes):
+            return TarSink(root, output_archive, tar_compression)
+    return ZipSink(root, output_archive, **zip_args)
+
@@ -0,0 +1,43 @@
+import os
+import sys
+
+import pytest
+
+# the modules live at the top of the repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import webreq  # noqa: E402
+from mock_cdn import MockCDNServer, build_pack, mock_pack_id  # noqa: E402
+from utils import StickerType, sticker_type_properties  # noqa: E402
+
+
+@pytest.fixture
+def make_cdn(tmp_path, monkeypatch):
+    """
+    Return make_cdn(sticker_type, count), which builds one mock pack and serves
+    it from a MockCDNServer, as (server, pack_id).
+    """
+    servers = []
+
+    def make_cdn(sticker_type=StickerType.STATIC_STICKER, count=4):
+        root = tmp_path / f"cdn{len(servers)}"
+        is_emoji = sticker_type_properties(sticker_type)[4]
+        pack_id = mock_pack_id(len(servers), is_emoji)
+        build_pack(str(root), pack_id, sticker_type, count)
+        server = MockCDNServer(str(root)).start()
+        servers.append(server)
+        monkeypatch.setattr(webreq, "RETRY_BACKOFF", 0)
+        monkeypatch.setattr(webreq, "_base_url_overrides", {})
+        webreq.set_base_urls(cdn=server.base_url)
+        return server, pack_id
+
+    yield make_cdn
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def cdn(make_cdn):
+    """A MockCDNServer with one static pack of 4 stickers, as (server, pack_id)."""
+    return make_cdn()
@@ -0,0 +1,48 @@
+from analyze import COMPLIANT, NOT_ANIMATED, TOO_LONG
+from pipeline import Pipeline
+from utils import WEBM_DURATION_SEC_MAX, StickerType
+
+# the column titles of the table, split on blanks
+COLUMNS = "sticker size w x h frames dur(s) enc(s) webm KB webm".split()
+
+
+def analyze(make_cdn, tmp_path, sticker_type, count):
+    _, pack_id = make_cdn(sticker_type, count)
+    with Pipeline(str(tmp_path / "data")) as pipeline:
+        return pack_id, pipeline.analyze(pack_id)
+
+
+def test_analyze_animated_pack(make_cdn, tmp_path):
+    pack_id, analysis = analyze(make_cdn, tmp_path, StickerType.ANIMATED_STICKER, 6)
+    assert (analysis.pack_id, analysis.sticker_type) == (pack_id, "ANIMATION")
+    assert [s.sticker_id for s in analysis.stickers] == [
+        f"{pack_id}{i:02d}" for i in range(6)
+    ]
+    # the mock stickers are 100 ms frames, some of them held for longer
+    durations = [round(s.duration, 3) for s in analysis.stickers]
+    assert durations == [0.8, 1.8, 3.0, 1.1, 2.4, 3.9]
+    for s in analysis.stickers:
+        assert (s.width, s.height, s.error) == (320, 270, None)
+        assert s.webm == (TOO_LONG if s.duration > WEBM_DURATION_SEC_MAX else COMPLIANT)
+    # exactly at the limit still fits
+    assert [s.webm for s in analysis.stickers].count(TOO_LONG) == 1
+
+    header, *rows, summary = analysis.table_lines()
+    assert header.split() == COLUMNS
+    assert len(rows) == 6
+    for s, row in zip(analysis.stickers, rows):
+        cells = row.split()
+        assert cells[0] == s.sticker_id
+        assert cells[2:5] == ["320x270", str(s.frames), f"{s.duration:.2f}"]
+        assert cells[-1] == s.webm
+    frames = sum(s.frames for s in analysis.stickers)
+    assert summary.startswith(f"6 sticker(s), {frames} frame(s)")
+    assert f"{COMPLIANT}: 5, {TOO_LONG}: 1" in summary
+
+
+def test_analyze_static_pack(make_cdn, tmp_path):
+    _, analysis = analyze(make_cdn, tmp_path, StickerType.STATIC_STICKER, 3)
+    assert [(s.frames, s.duration, s.webm) for s in analysis.stickers] == [
+        (1, 0.0, NOT_ANIMATED)
+    ] * 3
+    assert analysis.to_dict()["summary"]["est_encode_seconds"] == 0
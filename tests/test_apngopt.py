@@ -0,0 +1,58 @@
+import copy
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from apngopt import merge_identical, optimize_apng, read_delays
+from corpus import CORPUS, generate_case
+from framebuf import FrameBuffer
+
+ANIMATED = [case for case in CORPUS if case.has_animation]
+
+
+@pytest.mark.parametrize("case", ANIMATED, ids=lambda case: case.name)
+def test_optimized_corpus_decodes_to_source_frames(case, tmp_path):
+    # the image is all that is needed, no sound (and ffmpeg)
+    case = copy.copy(case)
+    case.sound_sec = 0.0
+    src = generate_case(case, str(tmp_path))[0]
+    out = str(tmp_path / "optimized.png")
+
+    result = optimize_apng(src, out)
+
+    source = FrameBuffer.from_file(src)
+    frames, delays = merge_identical(source.frames, read_delays(src)[0])
+    optimized = FrameBuffer.from_file(out)
+    assert np.array_equal(optimized.frames, frames)
+    assert read_delays(out)[0] == delays
+    assert sum(delays) == sum(read_delays(src)[0])
+    assert result.size_after < result.size_before
+    assert result.frames_after == len(frames)
+
+
+def test_verify_keeps_valid_output(tmp_path):
+    case = next(case for case in ANIMATED if case.hold)
+    src = generate_case(case, str(tmp_path))[0]
+    result = optimize_apng(src, str(tmp_path / "optimized.png"), verify=True)
+    assert result.verified
+    assert result.frames_after < result.frames_before
+
+
+def test_still_image_is_copied(tmp_path):
+    case = next(case for case in CORPUS if not case.has_animation)
+    src = generate_case(case, str(tmp_path))[0]
+    out = tmp_path / "optimized.png"
+    result = optimize_apng(src, str(out))
+    assert result.saved == 0
+    assert out.read_bytes() == open(src, "rb").read()
+
+
+def test_16_bit_animation_is_copied(tmp_path):
+    ramp = np.arange(64 * 64, dtype=np.uint16).reshape(64, 64) * 16
+    frames = [Image.fromarray(ramp + i * 100) for i in range(3)]
+    src, out = tmp_path / "in.png", tmp_path / "out.png"
+    frames[0].save(src, save_all=True, append_images=frames[1:], duration=100)
+    result = optimize_apng(str(src), str(out))
+    assert result.saved == 0
+    assert out.read_bytes() == src.read_bytes()
@@ -0,0 +1,171 @@
+import json
+import time
+
+import pytest
+
+from catalog import CATALOG_MAX_AGE, Catalog, refresh
+from mock_cdn import _cdn_path
+from pipeline import PackOptions, Pipeline
+from utils import STICKER_SET_META_URL, STICKER_ZIP_TEMPLATES, StickerType
+
+STORE_PAGE = """<html lang="ja"><body>
+<a href="https://store.line.me/stickershop/product/12345/ja">store</a>
+<p data-test="sticker-name-title">白熊の日常</p>
+<a data-test="sticker-author"
+ href="https://store.line.me/stickershop/author/678/ja">Shirokuma Studio</a>
+</body></html>"""
+
+YABE_PAGE = """<html><body>
+<a href="https://yabeline.tw/Emoji_Data.php?Number=4321">yabeline</a>
+<p>https://line.me/S/emoji/?id=5f0123456789abcdef012345</p>
+</body></html>"""
+
+
+def sticker_metadata(pack_id, titles, authors=None, stickers=(1, 2)):
+    return {
+        "packageId": int(pack_id),
+        "title": titles,
+        "author": authors or {lang: "Mock author" for lang in titles},
+        "stickers": [{"id": i} for i in stickers],
+        "hasAnimation": False,
+        "hasSound": False,
+    }
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    with Catalog(str(tmp_path / "catalog.sqlite3")) as catalog:
+        yield catalog
+
+
+def test_metadata_max_age(catalog):
+    metadata = sticker_metadata("1", {"en": "Bears"})
+    catalog.add_metadata("1", False, metadata, fetched_at=time.time() - 3600)
+    assert catalog.metadata("1", False) == metadata
+    assert catalog.metadata("1", False, max_age=7200) == metadata
+    assert catalog.metadata("1", False, max_age=60) is None
+    assert catalog.metadata("1", True) is None
+
+
+def test_search(catalog):
+    catalog.add_metadata(
+        "1", False, sticker_metadata("1", {"en": "Polar Bear", "ja": "白熊"})
+    )
+    catalog.add_metadata("2", False, sticker_metadata("2", {"en": "Brown bear"}))
+    catalog.add_metadata("3", False, sticker_metadata("3", {"en": "100% bear"}))
+
+    # prefixes ignore ASCII case
+    assert [r["pack_id"] for r in catalog.search("polar")] == ["1"]
+    assert [r["pack_id"] for r in catalog.search("BROWN")] == ["2"]
+    assert [(r["pack_id"], r["lang"]) for r in catalog.search("白")] == [("1", "ja")]
+    assert catalog.search("bear") == []
+    assert sorted(r["pack_id"] for r in catalog.search("bear", contains=True)) == [
+        "1",
+        "2",
+        "3",
+    ]
+    assert catalog.search("bear", lang="ja", contains=True) == []
+    # LIKE wildcards in the query are matched literally
+    assert [r["pack_id"] for r in catalog.search("100%")] == ["3"]
+    assert catalog.search("1_0") == []
+    assert len(catalog.search("mock", by="author")) == 4
+    row = catalog.search("polar")[0]
+    assert (row["sticker_type"], row["title"]) == ("STATIC", "Polar Bear")
+    with pytest.raises(ValueError):
+        catalog.search("x", by="sticker_type")
+
+
+@pytest.mark.parametrize("by", ["title", "author"])
+def test_prefix_search_uses_the_nocase_index(catalog, monkeypatch, by):
+    queries = []
+    query = catalog._query
+    monkeypatch.setattr(
+        catalog, "_query", lambda sql, params=(): queries.append((sql, params)) or []
+    )
+    catalog.search("pol", by=by)
+    catalog.search("pol", by=by, contains=True)
+    (prefix_sql, prefix_params), (contains_sql, contains_params) = queries
+    prefix_plan = query("EXPLAIN QUERY PLAN " + prefix_sql, prefix_params)
+    contains_plan = query("EXPLAIN QUERY PLAN " + contains_sql, contains_params)
+    # a prefix is a range of the index, a substring has to scan every name
+    assert f"SEARCH n USING INDEX names_{by} ({by}>? AND {by}<?)" in [
+        row["detail"] for row in prefix_plan
+    ]
+    assert not any(row["detail"].startswith("SEARCH n") for row in contains_plan)
+
+
+def test_import_files(catalog, cdn, tmp_path):
+    server, pack_id = cdn
+    archive = _cdn_path(
+        server.root,
+        STICKER_ZIP_TEMPLATES[StickerType.STATIC_STICKER].format(pack_id=pack_id),
+    )
+    assert catalog.import_file(archive) == f"metadata of sticker pack {pack_id}"
+    assert catalog.metadata(pack_id, False)["packageId"] == int(pack_id)
+    # the archive's time is when the metadata was fetched
+    assert catalog.packs(older_than=0) == [(pack_id, False)]
+
+    meta = tmp_path / "meta.json"
+    meta.write_text(
+        json.dumps(
+            {
+                "packageId": "5f0123456789abcdef012345",
+                "title": {"en": "Emoji"},
+                "author": {"en": "Mock author"},
+                "orders": ["001"],
+                "sticonResourceType": "STATIC",
+            }
+        )
+    )
+    assert catalog.import_file(str(meta)).startswith("metadata of emoji pack")
+    assert catalog.metadata("5f0123456789abcdef012345", True)["orders"] == ["001"]
+
+    store = tmp_path / "store.html"
+    store.write_text(STORE_PAGE, encoding="utf-8")
+    assert catalog.import_file(str(store)) == (
+        "store page of pack 12345 (ja): 白熊の日常"
+    )
+    (row,) = catalog.search("白熊")
+    assert (row["pack_id"], row["lang"], row["author_id"]) == ("12345", "ja", "678")
+    assert row["author"] == "Shirokuma Studio"
+
+    yabe = tmp_path / "yabe.html"
+    yabe.write_text(YABE_PAGE, encoding="utf-8")
+    assert catalog.import_file(str(yabe)) == (
+        "yabe emoji 4321 -> 5f0123456789abcdef012345"
+    )
+    assert catalog.yabe_pack_id("4321") == "5f0123456789abcdef012345"
+
+    other = tmp_path / "other.html"
+    other.write_text("<html></html>")
+    with pytest.raises(ValueError):
+        catalog.import_file(str(other))
+
+
+def test_refresh_only_stale_packs(catalog, cdn):
+    server, pack_id = cdn
+    stale = sticker_metadata(pack_id, {"en": "Old title"})
+    catalog.add_metadata(pack_id, False, stale, fetched_at=time.time() - 10 * 86400)
+    catalog.add_metadata("1", False, sticker_metadata("1", {"en": "Fresh"}))
+
+    assert refresh(catalog, older_than=86400, threads=2) == (1, 0)
+    assert catalog.metadata(pack_id, False)["title"] == {"en": f"Mock pack {pack_id}"}
+    assert catalog.metadata("1", False)["title"] == {"en": "Fresh"}
+    # pack 1 is not on the CDN
+    assert refresh(catalog, threads=2) == (1, 1)
+
+
+def test_download_is_planned_from_fresh_metadata(catalog, cdn, tmp_path):
+    # the catalog row is well within CATALOG_MAX_AGE, but lists other stickers
+    server, pack_id = cdn
+    outdated = sticker_metadata(pack_id, {"en": "Before the revision"}, stickers=[7])
+    catalog.add_metadata(
+        pack_id, False, outdated, fetched_at=time.time() - CATALOG_MAX_AGE / 2
+    )
+    with Pipeline(str(tmp_path / "dl"), str(tmp_path / "out"), catalog=catalog) as p:
+        plan = p.plan(pack_id, PackOptions())
+    meta_path = _cdn_path(server.root, STICKER_SET_META_URL.format(pack_id=pack_id))
+    with open(meta_path) as f:
+        fresh = json.load(f)
+    assert plan.metadata == fresh
+    assert catalog.metadata(pack_id, False, max_age=60) == fresh
@@ -0,0 +1,61 @@
+import sys
+
+import numpy as np
+import pytest
+
+from framebuf import FrameBuffer
+from processing import OperationTimeout, _spawn, subprocess_limits
+
+# counts the bytes on stdin
+COUNT_STDIN = "import sys; print(len(sys.stdin.buffer.read()))"
+
+
+def make_buffer(count=3, size=64):
+    frames = np.zeros((count, size, size, 4), dtype=np.uint8)
+    for i in range(count):
+        frames[i] = i + 1
+    return FrameBuffer(frames, [0.1, 0.25, 0.05][:count], 0)
+
+
+def test_raw_video_yields_a_view_per_step():
+    buffer = make_buffer()
+    chunks = list(buffer.raw_video(fps=20))
+    # 0.4 s at 20 fps: 2 steps of frame 1, 5 of frame 2, 1 of frame 3
+    assert [chunk[0] for chunk in chunks] == [1] * 2 + [2] * 5 + [3]
+    assert all(len(chunk) == buffer.frames[0].nbytes for chunk in chunks)
+    # views of the frames, nothing is copied for held frames
+    assert all(np.shares_memory(np.asarray(c), buffer.frames) for c in chunks)
+
+
+def test_raw_video_with_other_delays():
+    chunks = list(make_buffer().raw_video(fps=10, delays=[0.1, 0.1, 0.1]))
+    assert [chunk[0] for chunk in chunks] == [1, 2, 3]
+
+
+def test_spawn_streams_iterable_input():
+    chunks = make_buffer().raw_video(fps=20)
+    returncode, out, _ = _spawn(
+        [sys.executable, "-c", COUNT_STDIN], capture=True, input=chunks
+    )
+    assert returncode == 0
+    assert int(out) == 8 * 64 * 64 * 4
+
+
+def test_spawn_stops_feeding_a_child_that_exits():
+    endless = (b"x" * 65536 for _ in iter(int, 1))
+    returncode, _, _ = _spawn(
+        [sys.executable, "-c", "import sys; sys.stdin.buffer.read(10)"],
+        capture=True,
+        input=endless,
+    )
+    assert returncode == 0
+
+
+def test_spawn_timeout_while_feeding():
+    endless = (b"x" * 65536 for _ in iter(int, 1))
+    with subprocess_limits(0.5, None), pytest.raises(OperationTimeout):
+        _spawn(
+            [sys.executable, "-c", "import time; time.sleep(30)"],
+            capture=True,
+            input=endless,
+        )
@@ -0,0 +1,37 @@
+import json
+
+from manifest import MANIFEST_FILENAME, STATUS_DONE, STATUS_FAILED, PackManifest
+
+
+def saved(tmp_path):
+    path = tmp_path / MANIFEST_FILENAME
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text())["stickers"]
+
+
+def test_records_are_written_in_batches(tmp_path):
+    output = tmp_path / "1.png"
+    output.write_bytes(b"png")
+    manifest = PackManifest(str(tmp_path), flush_every=3)
+    manifest.record(1, "hash1", "chain", str(output))
+    manifest.record(2, "hash2", "chain", str(tmp_path / "2.png"))
+    assert saved(tmp_path) == {}
+    manifest.record(3, "hash3", "chain", str(output), error=ValueError("bad"))
+    assert list(saved(tmp_path)) == ["1", "2", "3"]
+    assert [e["status"] for e in saved(tmp_path).values()] == [
+        STATUS_DONE,
+        STATUS_FAILED,
+        STATUS_FAILED,
+    ]
+
+    manifest.forget(1)
+    manifest.record(4, "hash4", "chain", str(output))
+    assert list(saved(tmp_path)) == ["1", "2", "3"]
+    manifest.flush()
+    assert list(saved(tmp_path)) == ["2", "3", "4"]
+
+    reloaded = PackManifest(str(tmp_path))
+    assert reloaded.is_up_to_date(4, "hash4", "chain", str(output))
+    assert not reloaded.is_up_to_date(4, "hash4", "other chain", str(output))
+    assert not reloaded.is_up_to_date(2, "hash2", "chain", str(output))
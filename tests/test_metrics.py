@@ -0,0 +1,52 @@
+import json
+
+import metrics
+from metrics import Registry
+
+
+def test_prometheus_text():
+    registry = Registry()
+    registry.inc("runs_total")
+    registry.inc("http_requests_total", kind="sticker", status=200)
+    registry.inc("http_requests_total", 2, kind="archive", status=200)
+    registry.inc("http_requests_total", kind="archive", status=200)
+    registry.inc("errors_total", error='bad "name"\\\n')
+    for seconds in range(1, 21):
+        registry.observe("operation_seconds", seconds, op="to_webm")
+
+    assert registry.to_prometheus() == (
+        "# TYPE sticker_errors_total counter\n"
+        'sticker_errors_total{error="bad \\"name\\"\\\\\\n"} 1\n'
+        "# TYPE sticker_http_requests_total counter\n"
+        'sticker_http_requests_total{kind="archive",status="200"} 3\n'
+        'sticker_http_requests_total{kind="sticker",status="200"} 1\n'
+        "# TYPE sticker_runs_total counter\n"
+        "sticker_runs_total 1\n"
+        "# TYPE sticker_operation_seconds summary\n"
+        'sticker_operation_seconds{op="to_webm",quantile="0.5"} 10\n'
+        'sticker_operation_seconds{op="to_webm",quantile="0.95"} 19\n'
+        'sticker_operation_seconds_sum{op="to_webm"} 210\n'
+        'sticker_operation_seconds_count{op="to_webm"} 20\n'
+    )
+
+
+def test_export(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "_registry", Registry())
+    metrics.inc("stickers_total", 4, format="webm", status="done")
+    metrics.observe("operation_seconds", 0.5, op="to_webm")
+
+    metrics.export(str(tmp_path / "run.prom"))
+    text = (tmp_path / "run.prom").read_text()
+    assert 'sticker_stickers_total{format="webm",status="done"} 4\n' in text
+
+    metrics.export(str(tmp_path / "run.json"))
+    snapshot = json.loads((tmp_path / "run.json").read_text())
+    assert snapshot["counters"] == [
+        {
+            "name": "stickers_total",
+            "labels": {"format": "webm", "status": "done"},
+            "value": 4,
+        }
+    ]
+    (histogram,) = snapshot["histograms"]
+    assert (histogram["count"], histogram["p95"], histogram["max"]) == (1, 0.5, 0.5)
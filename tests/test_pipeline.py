@@ -0,0 +1,101 @@
+import os
+
+import pytest
+
+import processing
+import webreq
+from pipeline import (
+    STICKER_DONE,
+    STICKER_SKIPPED,
+    PackOptions,
+    Pipeline,
+    PipelineError,
+)
+from processing import needs_magick
+from utils import Operation
+
+
+@pytest.fixture
+def no_magick(monkeypatch):
+    monkeypatch.setattr(processing, "find_magick", lambda: None)
+
+
+def test_needs_magick():
+    assert needs_magick([Operation.TO_GIF], True)
+    assert not needs_magick([Operation.TO_WEBP], True)
+    assert not needs_magick([Operation.OPTIMIZE_PNG], False)
+    assert not needs_magick([Operation.OPTIMIZE_APNG], True)
+    # still images are scaled by magick, animations by ffmpeg
+    assert not needs_magick([Operation.SCALE], False)
+    assert needs_magick([Operation.SCALE], False, {"FRAMEBUF": "0"})
+    assert not needs_magick([Operation.SCALE], True, {"FRAMEBUF": "0"})
+    assert needs_magick([Operation.OVERLAY], True, {"FRAMEBUF": "0"})
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        PackOptions(output_fmt="webp"),
+        PackOptions(output_fmt="png", optimize_png=True),
+        PackOptions(output_fmt="png", scale=True, remove_alpha=True),
+    ],
+    ids=["webp", "optimize_png", "framebuf"],
+)
+def test_pillow_chains_run_without_magick(cdn, tmp_path, no_magick, options):
+    _, pack_id = cdn
+    with Pipeline(str(tmp_path / "data"), str(tmp_path / "out"), 2) as pipeline:
+        result = pipeline.run(pack_id, options)
+    assert (result.done_count, result.failed_count) == (4, 0)
+    assert len(os.listdir(result.output_dir)) >= 4
+
+
+def test_magick_chain_fails_without_magick(cdn, tmp_path, no_magick):
+    _, pack_id = cdn
+    with Pipeline(str(tmp_path / "data"), str(tmp_path / "out"), 2) as pipeline:
+        with pytest.raises(PipelineError, match="ImageMagick"):
+            pipeline.run(pack_id, PackOptions(output_fmt="gif"))
+
+
+@pytest.mark.parametrize("cache_ttl, fetches", [(3600, 1), (0, 2)])
+def test_metadata_cache_expires(cdn, tmp_path, monkeypatch, cache_ttl, fetches):
+    _, pack_id = cdn
+    calls = []
+    get_metadata = webreq.get_metadata
+    monkeypatch.setattr(
+        webreq, "get_metadata", lambda *args: calls.append(args) or get_metadata(*args)
+    )
+    with Pipeline(str(tmp_path / "data"), cache_ttl=cache_ttl) as pipeline:
+        first = pipeline.get_metadata(pack_id, False)
+        assert pipeline.get_metadata(pack_id, False) == first
+    assert len(calls) == fetches
+
+
+def test_resume_reprocesses_only_what_changed(cdn, tmp_path):
+    _, pack_id = cdn
+
+    def run(**options):
+        with Pipeline(str(tmp_path / "data"), str(tmp_path / "out"), 2) as pipeline:
+            result = pipeline.run(pack_id, PackOptions(output_fmt="webp", **options))
+        return {s.sticker_id: s for s in result.stickers}
+
+    first = run()
+    assert {s.status for s in first.values()} == {STICKER_DONE}
+    assert {s.status for s in run().values()} == {STICKER_SKIPPED}
+
+    deleted = sorted(first)[1]
+    os.remove(first[deleted].output_path)
+    statuses = {i: s.status for i, s in run().items()}
+    assert statuses.pop(deleted) == STICKER_DONE
+    assert set(statuses.values()) == {STICKER_SKIPPED}
+
+    # options that change the chain apply to every sticker
+    assert {s.status for s in run(scale=True).values()} == {STICKER_DONE}
+    assert {s.status for s in run(scale=True).values()} == {STICKER_SKIPPED}
+    extra_params = {"WEBP_QUALITY": "50"}
+    assert {s.status for s in run(extra_params=extra_params).values()} == {
+        STICKER_DONE
+    }
+    assert {s.status for s in run(extra_params=extra_params).values()} == {
+        STICKER_SKIPPED
+    }
+    assert {s.status for s in run(reprocess=True).values()} == {STICKER_DONE}
@@ -0,0 +1,28 @@
+import numpy as np
+from PIL import Image
+
+from pngopt import optimize_png
+
+
+def test_palette_image_is_reduced_losslessly(tmp_path):
+    pixels = np.zeros((64, 64, 4), dtype=np.uint8)
+    pixels[16:48, 16:48] = (200, 30, 30, 255)
+    src, out = tmp_path / "in.png", tmp_path / "out.png"
+    Image.fromarray(pixels, "RGBA").save(src, compress_level=0)
+
+    result = optimize_png(str(src), str(out))
+    assert result.size_after < result.size_before
+    assert (result.quantized, result.quality) == (False, 100)
+    with Image.open(out) as im:
+        assert np.array_equal(np.asarray(im.convert("RGBA")), pixels)
+
+
+def test_16_bit_image_is_kept(tmp_path):
+    pixels = (np.arange(64 * 64, dtype=np.uint16).reshape(64, 64) * 16) | 1
+    src, out = tmp_path / "in.png", tmp_path / "out.png"
+    Image.fromarray(pixels).save(src, compress_level=0)
+
+    for min_quality in (None, 0):
+        result = optimize_png(str(src), str(out), min_quality)
+        assert result.saved == 0
+        assert out.read_bytes() == src.read_bytes()
@@ -0,0 +1,196 @@
+import copy
+import os
+import struct
+
+import numpy as np
+import pytest
+
+import processing
+from corpus import CORPUS, generate_case
+from framebuf import FrameBuffer
+from processing import (
+    Cancelled,
+    ImageProcessor,
+    OperationTimeout,
+    ProcessorConfig,
+    ProcessTask,
+    m4a_is_aac,
+)
+from utils import Operation, OutputFormat, StickerType
+
+
+def make_batch(tmp_path, count=3):
+    tasks = []
+    (tmp_path / "out").mkdir(exist_ok=True)
+    for i in range(count):
+        in_img = tmp_path / f"{i}.png"
+        in_img.write_bytes(b"")
+        tasks.append(
+            ProcessTask(
+                i,
+                str(in_img),
+                "",
+                "",
+                512,
+                [Operation.SCALE],
+                str(tmp_path / "out" / f"{i}.png"),
+            )
+        )
+    return tasks
+
+
+@pytest.fixture(params=[StickerType.EMOJI])
+def processor(request, tmp_path, monkeypatch):
+    # FRAMEBUF=0: scaling goes through a (batched) magick spawn
+    config = ProcessorConfig(
+        str(tmp_path),
+        request.param,
+        OutputFormat.APNG,
+        {"FRAMEBUF": "0"},
+        retries=0,
+    )
+    singles = []
+    monkeypatch.setattr(
+        ImageProcessor,
+        "scale_image",
+        lambda self, in_file, out_file, size: singles.append(in_file),
+    )
+    processor = ImageProcessor(config)
+    processor.singles = singles
+    return processor
+
+
+@pytest.mark.parametrize("error", [OperationTimeout("magick"), Cancelled("magick")])
+def test_batch_timeout_and_cancel_are_not_retried_one_by_one(
+    processor, tmp_path, monkeypatch, error
+):
+    def scale_images(self, pairs, size):
+        raise error
+
+    monkeypatch.setattr(ImageProcessor, "scale_images", scale_images)
+    tasks = processor.run_batch(make_batch(tmp_path))
+    assert [task.error for task in tasks] == [error] * 3
+    assert processor.singles == []
+
+
+def test_failed_batch_is_redone_one_by_one(processor, tmp_path, monkeypatch):
+    def scale_images(self, pairs, size):
+        raise processing.ffmpeg.Error("magick", b"", b"bad input")
+
+    monkeypatch.setattr(ImageProcessor, "scale_images", scale_images)
+    processor.run_batch(make_batch(tmp_path))
+    assert len(processor.singles) == 3
+
+
+@pytest.mark.parametrize("processor", [StickerType.ANIMATED_EMOJI], indirect=True)
+def test_missing_input_only_fails_its_own_task(processor, tmp_path, monkeypatch):
+    def scale_images(self, pairs, size):
+        for _, out_file in pairs:
+            with open(out_file, "wb") as f:
+                f.write(b"scaled")
+
+    monkeypatch.setattr(ImageProcessor, "scale_images", scale_images)
+    tasks = make_batch(tmp_path)
+    os.remove(tasks[1].in_img)
+    processor.run_batch(tasks)
+    assert isinstance(tasks[1].error, FileNotFoundError)
+    assert [tasks[0].error, tasks[2].error] == [None, None]
+    assert sorted(os.listdir(tmp_path / "out")) == ["0.png", "2.png"]
+
+
+def _box(box_type, payload):
+    return struct.pack(">I", 8 + len(payload)) + box_type + payload
+
+
+def write_m4a(path, object_type):
+    # just enough of an .m4a for m4a_is_aac: moov/.../stsd/mp4a/esds
+    decoder_config = bytes([0x04, 13, object_type]) + bytes(12)
+    es_descriptor = bytes([0x03, 3 + len(decoder_config), 0, 1, 0]) + decoder_config
+    esds = _box(b"esds", bytes(4) + es_descriptor)
+    mp4a = _box(b"mp4a", bytes(28) + esds)
+    stsd = _box(b"stsd", bytes(4) + struct.pack(">I", 1) + mp4a)
+    moov = _box(b"moov", _box(b"trak", _box(b"mdia", _box(b"stbl", stsd))))
+    with open(path, "wb") as f:
+        f.write(_box(b"ftyp", b"M4A \0\0\0\0") + moov)
+
+
+@pytest.mark.parametrize(
+    "object_type, is_aac", [(0x40, True), (0x67, True), (0x6B, False), (0x69, False)]
+)
+def test_m4a_is_aac(tmp_path, object_type, is_aac):
+    path = str(tmp_path / "sound.m4a")
+    write_m4a(path, object_type)
+    assert m4a_is_aac(path) is is_aac
+
+
+def test_m4a_is_aac_is_false_when_unsure(tmp_path):
+    assert not m4a_is_aac(str(tmp_path / "missing.m4a"))
+    path = tmp_path / "truncated.m4a"
+    path.write_bytes(b"mp4a esds")
+    assert not m4a_is_aac(str(path))
+
+
+@pytest.fixture
+def video_args(tmp_path, monkeypatch):
+    # the ffmpeg command line to_video builds for the 2 s anim_320_20f case
+    case = copy.copy(next(c for c in CORPUS if c.name == "anim_320_20f"))
+    case.sound_sec = 0.0
+    in_pic = generate_case(case, str(tmp_path))[0]
+    calls = []
+    monkeypatch.setattr(
+        processing, "_run_ffmpeg", lambda stream, **kwargs: calls.append(stream)
+    )
+    config = ProcessorConfig(str(tmp_path), case.sticker_type, OutputFormat.MP4, {})
+    processor = ImageProcessor(config)
+
+    def to_video(in_audio):
+        processor.to_video(in_pic, in_audio, str(tmp_path / "interim.tmp"))
+        args = calls.pop().get_args()
+        # the output options, after the last input
+        inputs = [i for i, arg in enumerate(args) if arg == "-i"]
+        return len(inputs), args[inputs[-1] + 2 :]
+
+    return to_video
+
+
+def _option(args, name):
+    return args[args.index(f"-{name}") + 1] if f"-{name}" in args else None
+
+
+@pytest.mark.parametrize("object_type, acodec", [(0x40, "copy"), (0x6B, "aac")])
+def test_to_video_sound(video_args, tmp_path, object_type, acodec):
+    in_audio = str(tmp_path / "sound.m4a")
+    write_m4a(in_audio, object_type)
+    inputs, args = video_args(in_audio)
+    assert inputs == 2
+    assert _option(args, "acodec") == acodec
+    # cut to one play of the animation
+    assert _option(args, "t") == "2.0"
+    # the interim path has no extension to guess the format from
+    assert _option(args, "f") == "mp4"
+    assert args[-2].endswith("interim.tmp")
+
+
+def test_to_video_without_sound(video_args, tmp_path):
+    inputs, args = video_args(str(tmp_path / "missing.m4a"))
+    assert inputs == 1
+    assert _option(args, "acodec") is None and _option(args, "t") is None
+    assert _option(args, "f") == "mp4"
+
+
+def test_webm_encoders_capture_ffmpeg_output(tmp_path, monkeypatch):
+    # shown through _report_error if ffmpeg fails, not printed for every sticker
+    calls = []
+    monkeypatch.setattr(
+        processing, "_run_ffmpeg", lambda stream, **kwargs: calls.append(kwargs)
+    )
+    config = ProcessorConfig(
+        str(tmp_path), StickerType.ANIMATED_STICKER, OutputFormat.WEBM, {}
+    )
+    processor = ImageProcessor(config)
+    processor._current_sticker_id = "1"
+    frame_dir = processor.make_frame_temp_dir()
+    processor.to_webm([("0.png", 0.1)], frame_dir, str(tmp_path / "out.webm"))
+    buffer = FrameBuffer(np.zeros((2, 4, 4, 4), np.uint8), [0.1, 0.1])
+    processor.buffer_to_webm(buffer, buffer.delays, str(tmp_path / "out.webm"))
+    assert [kwargs["quiet"] for kwargs in calls] == [True, True]
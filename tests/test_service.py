@@ -0,0 +1,154 @@
+import http.client
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+from service import JobManager, ServiceHTTPServer, UnixServiceHTTPServer
+
+
+class _Result:
+    def to_dict(self):
+        return {"done": 1}
+
+
+class BlockingPipeline:
+    """Stands in for Pipeline; runs block until release() so jobs stay in flight."""
+
+    def __init__(self):
+        self.runs = []
+        self._release = threading.Event()
+
+    def run(self, pack, options, progress=None):
+        self.runs.append((pack, options.output_fmt))
+        self._release.wait(10)
+        return _Result()
+
+    def release(self):
+        self._release.set()
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super().__init__("localhost")
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def request(connect, method, path, body=None):
+    conn = connect()
+    try:
+        if body is not None and not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        conn.request(method, path, body=body)
+        response = conn.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        conn.close()
+
+
+def wait_for(job, status):
+    deadline = time.time() + 10
+    while job.status != status:
+        assert time.time() < deadline, job.to_dict()
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def pipeline():
+    pipeline = BlockingPipeline()
+    yield pipeline
+    pipeline.release()
+
+
+@pytest.fixture(params=["tcp", "unix"])
+def service(request, pipeline, tmp_path):
+    """(JobManager, connection factory) of a running service."""
+    jobs = JobManager(pipeline, concurrent_jobs=2, log=lambda *args: None)
+    if request.param == "tcp":
+        server = ServiceHTTPServer(("127.0.0.1", 0), jobs)
+        port = server.server_address[1]
+
+        def connect():
+            return http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+
+    else:
+        path = str(tmp_path / "service.sock")
+        server = UnixServiceHTTPServer(path, jobs)
+
+        def connect():
+            return UnixHTTPConnection(path)
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield jobs, connect
+    pipeline.release()
+    server.shutdown()
+    server.server_close()
+    jobs.close()
+
+
+@pytest.mark.parametrize(
+    "body, error",
+    [
+        (b"{not json", "Expecting"),
+        ({"options": {}}, '"pack"'),
+        ({"pack": 11537}, '"pack"'),
+        ({"pack": "11537", "options": ["webm"]}, '"options"'),
+        ({"pack": "11537", "options": {"output_dir": "/"}}, "output_dir"),
+    ],
+)
+def test_invalid_jobs_are_rejected(service, body, error):
+    jobs, connect = service
+    status, response = request(connect, "POST", "/jobs", body)
+    assert status == 400
+    assert error in response["error"]
+    assert jobs.list() == []
+
+
+def test_identical_jobs_in_flight_are_deduplicated(service, pipeline):
+    jobs, connect = service
+    body = {"pack": "11537", "options": {"output_fmt": "webm"}}
+    status, first = request(connect, "POST", "/jobs", body)
+    assert (status, first["deduplicated"]) == (202, False)
+    status, second = request(connect, "POST", "/jobs", body)
+    assert (status, second["deduplicated"]) == (200, True)
+    assert second["job"]["id"] == first["job"]["id"]
+
+    status, other = request(
+        connect, "POST", "/jobs", {"pack": "11537", "options": {"output_fmt": "gif"}}
+    )
+    assert status == 202
+    assert other["job"]["id"] != first["job"]["id"]
+
+    pipeline.release()
+    job_id = first["job"]["id"]
+    wait_for(jobs.get(job_id), "done")
+    status, response = request(connect, "GET", f"/jobs/{job_id}")
+    assert (status, response["job"]["result"]) == (200, {"done": 1})
+    # finished jobs are not reused
+    status, again = request(connect, "POST", "/jobs", body)
+    assert status == 202
+    assert again["job"]["id"] != job_id
+    assert request(connect, "GET", "/jobs/unknown")[0] == 404
+
+
+def test_finished_jobs_are_evicted(pipeline):
+    pipeline.release()
+    jobs = JobManager(pipeline, log=lambda *args: None, max_finished_jobs=2)
+    try:
+        submitted = [jobs.submit(str(pack), {})[0] for pack in range(3)]
+        for job in submitted:
+            wait_for(job, "done")
+        assert [job.id for job in jobs.list()] == [job.id for job in submitted[1:]]
+
+        jobs.job_ttl = 0
+        assert jobs.list() == []
+        assert jobs.get(submitted[-1].id) is None
+    finally:
+        jobs.close()
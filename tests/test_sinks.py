@@ -0,0 +1,167 @@
+import hashlib
+import io
+import os
+import subprocess
+import sys
+import tarfile
+import zipfile
+
+import pytest
+
+from conftest import ROOT
+from mock_s3 import MockS3Server, S3Object
+from pipeline import PackOptions, Pipeline
+from sinks import MULTIPART_THRESHOLD, S3Sink
+
+BUCKET = "stickers"
+
+
+def pack_members(pack_id, count=4):
+    # <title>(<id>)/<fmt>/<sticker>.webp, as in the output directory tree
+    return sorted(
+        f"Mock_pack_{pack_id}({pack_id})/webp/{int(pack_id) * 100 + i}.webp"
+        for i in range(count)
+    )
+
+
+@pytest.mark.parametrize("name", ["pack.zip", "pack.tar.gz"])
+def test_archive_members(cdn, tmp_path, name):
+    _, pack_id = cdn
+    archive = tmp_path / name
+    options = PackOptions(output_fmt="webp", output_archive=str(archive))
+    with Pipeline(str(tmp_path / "data"), str(tmp_path / "out"), 2) as pipeline:
+        result = pipeline.run(pack_id, options)
+    assert (result.done_count, result.failed_count) == (4, 0)
+    # nothing is written next to the archive, not even a manifest
+    assert not (tmp_path / "out").exists()
+    if name.endswith(".zip"):
+        with zipfile.ZipFile(archive) as z:
+            names = z.namelist()
+            data = [z.read(n) for n in names]
+    else:
+        with tarfile.open(archive, "r:gz") as t:
+            names = t.getnames()
+            data = [t.extractfile(n).read() for n in names]
+    assert sorted(names) == pack_members(pack_id)
+    assert all(d[:4] == b"RIFF" and d[8:12] == b"WEBP" for d in data)
+
+
+def test_archive_to_stdout(cdn, tmp_path):
+    server, pack_id = cdn
+    out = subprocess.run(
+        [
+            sys.executable,
+            os.path.join(ROOT, "downloader.py"),
+            pack_id,
+            "-y",
+            "--no-catalog",
+            "--output-fmt",
+            "webp",
+            "--output-archive",
+            "-",
+            "--cdn-base-url",
+            server.base_url,
+        ],
+        cwd=tmp_path,
+        capture_output=True,
+        timeout=120,
+    )
+    assert out.returncode == 0, out.stderr.decode()
+    # stdout is the zip alone, the messages went to stderr
+    with zipfile.ZipFile(io.BytesIO(out.stdout)) as z:
+        assert z.testzip() is None
+        assert sorted(z.namelist()) == pack_members(pack_id)
+    assert b"Sticker pack info" in out.stderr
+    assert b"Process done!" in out.stderr
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    pytest.importorskip("boto3")
+    # boto3 wants credentials, the mock does not check them
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "test")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "test")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    server = MockS3Server().start()
+    server.create_bucket(BUCKET)
+    yield server
+    server.stop()
+
+
+def make_tree(root, files):
+    for name, content in files.items():
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+
+
+def upload(server, src_dir, out_root):
+    # one run: a fresh sink, as every Pipeline.run opens its own
+    with S3Sink(
+        str(out_root), f"s3://{BUCKET}/packs", endpoint_url=server.base_url
+    ) as sink:
+        sink.add_tree(str(src_dir), str(out_root / "pack"))
+    return sink
+
+
+def test_unchanged_files_are_skipped(s3, tmp_path):
+    src = tmp_path / "src"
+    make_tree(src, {"1.webm": b"webm" * 100, "2.png": b"png", "sub/3.gif": b"gif"})
+
+    sink = upload(s3, src, tmp_path)
+    assert (sink.uploaded, sink.skipped) == (3, 0)
+    obj = s3.get(BUCKET, "packs/pack/1.webm")
+    assert obj.data == b"webm" * 100
+    assert obj.content_type == "video/webm"
+    assert obj.metadata["sha256"] == hashlib.sha256(obj.data).hexdigest()
+    assert s3.get(BUCKET, "packs/pack/sub/3.gif").data == b"gif"
+
+    sink = upload(s3, src, tmp_path)
+    assert (sink.uploaded, sink.skipped) == (0, 3)
+
+    (src / "2.png").write_bytes(b"changed")
+    sink = upload(s3, src, tmp_path)
+    assert (sink.uploaded, sink.skipped) == (1, 2)
+    assert s3.get(BUCKET, "packs/pack/2.png").data == b"changed"
+
+
+def test_objects_without_checksum_fall_back_to_etag(s3, tmp_path):
+    src = tmp_path / "src"
+    make_tree(src, {"same.png": b"same", "other.png": b"new"})
+    # uploaded by another tool: no sha256 metadata, ETag is the MD5
+    for name, data in (("same.png", b"same"), ("other.png", b"old")):
+        etag = hashlib.md5(data).hexdigest()
+        s3.put(BUCKET, f"packs/pack/{name}", S3Object(data, etag, {}, "image/png"))
+
+    sink = upload(s3, src, tmp_path)
+    assert (sink.uploaded, sink.skipped) == (1, 1)
+    assert s3.get(BUCKET, "packs/pack/other.png").data == b"new"
+
+
+def test_large_files_are_uploaded_in_parts(s3, tmp_path):
+    src = tmp_path / "src"
+    data = os.urandom(MULTIPART_THRESHOLD + 1024 * 1024)
+    make_tree(src, {"big.mp4": data})
+
+    sink = upload(s3, src, tmp_path)
+    assert sink.uploaded == 1
+    assert s3.stats["multipart_uploads"] == 1
+    obj = s3.get(BUCKET, "packs/pack/big.mp4")
+    assert obj.data == data
+    # a multipart ETag is not an MD5, the sha256 metadata decides the skip
+    assert obj.etag.endswith("-2")
+    sink = upload(s3, src, tmp_path)
+    assert (sink.uploaded, sink.skipped) == (0, 1)
+
+
+def test_uploads_retry_errors(s3, tmp_path):
+    src = tmp_path / "src"
+    files = {f"{i}.png": bytes([i]) * 1000 for i in range(10)}
+    make_tree(src, files)
+    s3.error_rate = 0.3
+
+    sink = upload(s3, src, tmp_path)
+    assert sink.uploaded == 10
+    assert s3.stats["errors"] > 0
+    for name, content in files.items():
+        assert s3.get(BUCKET, f"packs/pack/{name}").data == content
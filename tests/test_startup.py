@@ -0,0 +1,62 @@
+import os
+import subprocess
+import sys
+
+from check_startup import HEAVY_MODULES
+from conftest import ROOT
+
+# never needed to print help or to copy raw stickers
+PROCESSING_MODULES = ["processing", "ffmpeg", "numpy", "PIL"]
+
+# runs downloader.py as __main__, then prints the heavy modules it loaded
+DRIVER = f"""
+import runpy, sys
+sys.argv = ["downloader.py"] + sys.argv[1:]
+try:
+    runpy.run_path({os.path.join(ROOT, "downloader.py")!r}, run_name="__main__")
+except SystemExit as e:
+    if e.code:
+        raise
+print("LOADED:" + ",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))
+"""
+
+
+def loaded_modules(args, cwd, env=None):
+    out = subprocess.run(
+        [sys.executable, "-c", DRIVER, *args],
+        cwd=cwd,
+        env={**os.environ, "PYTHONPATH": ROOT, **(env or {})},
+        capture_output=True,
+        text=True,
+        timeout=120,
+    )
+    assert out.returncode == 0, out.stderr
+    line = out.stdout.strip().splitlines()[-1]
+    assert line.startswith("LOADED:"), out.stdout
+    return [m for m in line[len("LOADED:") :].split(",") if m]
+
+
+def test_import_loads_no_heavy_module():
+    out = subprocess.run(
+        [sys.executable, "-c", "import sys, downloader; print(sorted(sys.modules))"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    assert out.returncode == 0, out.stderr
+    assert not [m for m in HEAVY_MODULES if f"'{m}'" in out.stdout]
+
+
+def test_help_loads_no_heavy_module(tmp_path):
+    assert loaded_modules(["--help"], tmp_path) == []
+
+
+def test_raw_run_loads_no_processing_module(cdn, tmp_path):
+    server, pack_id = cdn
+    loaded = loaded_modules(
+        [pack_id, "--output-fmt", "none", "-y", "--no-catalog", "-o", "out"],
+        tmp_path,
+        {"LINE_CDN_BASE_URL": server.base_url},
+    )
+    assert os.listdir(tmp_path / "out")
+    assert not set(loaded) & set(PROCESSING_MODULES), loaded
@@ -0,0 +1,72 @@
+import pytest
+
+import tuning
+from tuning import AUTO, AdaptiveLimiter, choose_workers, parse_threads
+
+GIB = 1024**3
+
+
+@pytest.fixture
+def machine(monkeypatch):
+    def machine(cpus, memory):
+        monkeypatch.setattr(tuning, "cpu_count", lambda: cpus)
+        monkeypatch.setattr(tuning, "available_memory", lambda: memory)
+
+    return machine
+
+
+@pytest.mark.parametrize(
+    "cpus, memory, fmt, is_emoji, count, downloads, expected",
+    [
+        # two cores per VP9 encode
+        (8, 16 * GIB, "webm", False, 40, 0, (4, 4)),
+        # 0.7 GiB for 300 MiB encodes
+        (8, 1 * GIB, "webm", False, 40, 0, (2, 4)),
+        # emoji take a quarter of the memory, cores decide again
+        (8, 1 * GIB, "webm", True, 40, 0, (4, 4)),
+        (1, 16 * GIB, "webm", False, 40, 0, (1, 4)),
+        # no more threads than stickers; unknown memory is not a limit
+        (8, None, "png", False, 3, 0, (3, 4)),
+        # overlay downloads scale with the cores, up to the maximum
+        (8, None, "raw", False, 40, 100, (32, 16)),
+        (2, None, "raw", False, 40, 100, (32, 4)),
+        (4, None, "raw", False, 40, 6, (32, 6)),
+    ],
+)
+def test_choose_workers(
+    machine, cpus, memory, fmt, is_emoji, count, downloads, expected
+):
+    machine(cpus, memory)
+    choice = choose_workers(fmt, is_emoji, count, downloads)
+    assert (choice.process_threads, choice.download_threads) == expected
+    assert f"{cpus} CPUs" in choice.reason
+
+
+def test_parse_threads():
+    assert parse_threads("auto") == AUTO
+    assert parse_threads("3") == 3
+    with pytest.raises(ValueError):
+        parse_threads("0")
+
+
+def test_limiter_sheds_a_worker_when_cpu_bound(monkeypatch):
+    clock = {"wall": 0.0, "cpu": 0.0}
+    monkeypatch.setattr(tuning.time, "perf_counter", lambda: clock["wall"])
+    monkeypatch.setattr(tuning, "process_cpu_seconds", lambda: clock["cpu"])
+    limiter = AdaptiveLimiter(2, 4, cpus=2)
+
+    def run_task(wall, cpu):
+        with limiter:
+            clock["wall"], clock["cpu"] = wall, cpu
+
+    # too soon to judge
+    run_task(1.0, 2.0)
+    assert limiter.limit == 2
+    # both cores busy for 3 s
+    run_task(3.0, 6.0)
+    assert limiter.limit == 1
+    run_task(6.0, 12.0)
+    assert limiter.limit == 1  # never below one
+    # idle, but nothing is waiting for a slot
+    run_task(9.0, 12.0)
+    assert limiter.limit == 1
@@ -0,0 +1,173 @@
+import json
+import os
+import shutil
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import pytest
+
+from mock_cdn import MockCDNServer, _cdn_path
+from update import UpdateUnavailable, update_archive
+from utils import (
+    STICKER_SET_META_URL,
+    STICKER_URL_TEMPLATES,
+    STICKER_ZIP_TEMPLATES,
+    StickerType,
+)
+
+
+@pytest.fixture
+def pool():
+    with ThreadPoolExecutor(4) as pool:
+        yield pool
+
+
+class LocalPack:
+    """A pack on the mock CDN and a copy of its archive as downloaded before."""
+
+    def __init__(self, server: MockCDNServer, pack_id, sticker_type, archive_path):
+        self.server = server
+        self.pack_id = pack_id
+        self.sticker_type = sticker_type
+        self.archive_path = archive_path
+        self.metadata = self.read_metadata()
+
+    def cdn_path(self, template, **fields):
+        return _cdn_path(self.server.root, template.format(**fields))
+
+    def read_metadata(self):
+        with open(self.cdn_path(STICKER_SET_META_URL, pack_id=self.pack_id)) as f:
+            return json.load(f)
+
+    def sticker_ids(self):
+        return [str(s["id"]) for s in self.metadata["stickers"]]
+
+    def revise(self, **changes):
+        # metadata as LINE serves it after a revision of the pack
+        metadata = dict(self.metadata, **changes)
+        metadata["title"] = {"en": "Revised " + self.metadata["title"]["en"]}
+        return metadata
+
+    def update(self, metadata, pool):
+        self.server.requests.clear()
+        return update_archive(self.archive_path, metadata, self.pack_id, False, pool)
+
+    def gets(self):
+        return [path for method, path in self.server.requests if method == "GET"]
+
+
+@pytest.fixture
+def make_pack(make_cdn, tmp_path):
+    def make_pack(sticker_type=StickerType.STATIC_STICKER, count=4):
+        server, pack_id = make_cdn(sticker_type, count)
+        download_dir = tmp_path / "dl" / pack_id
+        download_dir.mkdir(parents=True)
+        archive_path = str(download_dir / "pack.zip")
+        shutil.copyfile(
+            _cdn_path(
+                server.root, STICKER_ZIP_TEMPLATES[sticker_type].format(pack_id=pack_id)
+            ),
+            archive_path,
+        )
+        return LocalPack(server, pack_id, sticker_type, archive_path)
+
+    return make_pack
+
+
+def test_unrevised_pack_makes_no_requests(make_pack, pool):
+    pack = make_pack()
+    result = pack.update(pack.metadata, pool)
+    assert (result.unchanged, result.changed, result.requests) == (4, [], 0)
+    assert pack.server.requests == []
+
+
+def test_revised_pack_with_same_stickers_is_not_fetched(make_pack, pool):
+    pack = make_pack()
+    result = pack.update(pack.revise(), pool)
+    assert (result.unchanged, result.added, result.changed, result.removed) == (
+        4,
+        [],
+        [],
+        [],
+    )
+    assert pack.gets() == []
+    # one HEAD per sticker
+    assert result.requests == len(pack.server.requests) == 4
+    with zipfile.ZipFile(pack.archive_path) as archive:
+        assert json.loads(archive.read("productInfo.meta"))["title"]["en"].startswith(
+            "Revised"
+        )
+
+
+def test_only_the_changed_sticker_is_fetched(make_pack, pool):
+    pack = make_pack()
+    sticker_id = pack.sticker_ids()[2]
+    url = STICKER_URL_TEMPLATES[StickerType.STATIC_STICKER]
+    path = pack.cdn_path(url, sticker_id=sticker_id)
+    with open(path, "ab") as f:
+        f.write(b"revised")
+    with open(path, "rb") as f:
+        revised = f.read()
+
+    result = pack.update(pack.revise(), pool)
+
+    assert result.changed == [sticker_id]
+    assert result.unchanged == 3
+    assert pack.gets() == [urlsplit(url.format(sticker_id=sticker_id)).path]
+    with zipfile.ZipFile(pack.archive_path) as archive:
+        assert archive.read(f"{sticker_id}@2x.png") == revised
+        assert len(archive.namelist()) == 6  # 4 stickers, tab icon, metadata
+
+    # the ETags are remembered, a second update finds nothing to fetch
+    result = pack.update(pack.revise(), pool)
+    assert (result.changed, result.unchanged) == ([], 4)
+    assert pack.gets() == []
+
+
+def test_added_and_removed_stickers(make_pack, pool):
+    pack = make_pack()
+    stickers = pack.metadata["stickers"]
+    new_id = int(stickers[-1]["id"]) + 1
+    url = STICKER_URL_TEMPLATES[StickerType.STATIC_STICKER]
+    new_path = pack.cdn_path(url, sticker_id=new_id)
+    os.makedirs(os.path.dirname(new_path))
+    shutil.copyfile(pack.cdn_path(url, sticker_id=stickers[0]["id"]), new_path)
+    result = pack.update(pack.revise(stickers=stickers[1:] + [{"id": new_id}]), pool)
+    assert (result.added, result.removed) == ([str(new_id)], [str(stickers[0]["id"])])
+    assert len(pack.gets()) == 1
+    with zipfile.ZipFile(pack.archive_path) as archive:
+        names = archive.namelist()
+    assert f"{new_id}@2x.png" in names
+    assert f"{stickers[0]['id']}@2x.png" not in names
+
+
+def test_type_change_is_unavailable(make_pack, pool):
+    pack = make_pack()
+    metadata = pack.revise(
+        stickerResourceType=StickerType.ANIMATED_STICKER.value, hasAnimation=True
+    )
+    with pytest.raises(UpdateUnavailable, match="type changed"):
+        pack.update(metadata, pool)
+    assert pack.server.requests == []
+
+
+def test_message_stickers_are_unavailable(make_pack, pool):
+    pack = make_pack(StickerType.MESSAGE_STICKER)
+    with pytest.raises(UpdateUnavailable, match="per-sticker URLs"):
+        pack.update(pack.revise(), pool)
+    assert pack.server.requests == []
+
+
+def test_sticker_files_unlike_the_archive_are_unavailable(make_pack, pool):
+    # every size differs: download the archive instead of every sticker
+    pack = make_pack()
+    for sticker_id in pack.sticker_ids():
+        path = pack.cdn_path(
+            STICKER_URL_TEMPLATES[StickerType.STATIC_STICKER], sticker_id=sticker_id
+        )
+        with open(path, "ab") as f:
+            f.write(b"\0")
+    with pytest.raises(UpdateUnavailable, match="differ from the archive"):
+        pack.update(pack.revise(), pool)
+    assert pack.gets() == []
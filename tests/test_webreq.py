@@ -0,0 +1,33 @@
+import os
+
+import pytest
+
+from pipeline import PackOptions, Pipeline, PipelineError
+
+
+def test_failed_archive_download_is_not_kept(cdn, tmp_path):
+    server, pack_id = cdn
+    archive = tmp_path / "data" / pack_id / "pack.zip"
+    with Pipeline(str(tmp_path / "data"), str(tmp_path / "out")) as pipeline:
+        # metadata is cached, so only the archive request fails
+        pipeline.get_metadata(pack_id, False)
+        server.error_rate = 1.0
+        with pytest.raises(PipelineError):
+            pipeline.run(pack_id)
+        assert not os.path.exists(archive)
+
+        server.error_rate = 0.0
+        result = pipeline.run(pack_id)
+    assert archive.is_file()
+    assert os.listdir(result.output_dir)
+
+
+def test_corrupt_local_archive_is_downloaded_again(cdn, tmp_path):
+    _, pack_id = cdn
+    archive = tmp_path / "data" / pack_id / "pack.zip"
+    archive.parent.mkdir(parents=True)
+    archive.write_bytes(b"<html>503 Service Unavailable</html>")
+    with Pipeline(str(tmp_path / "data"), str(tmp_path / "out")) as pipeline:
+        result = pipeline.run(pack_id)
+    assert archive.read_bytes().startswith(b"PK")
+    assert os.listdir(result.output_dir)
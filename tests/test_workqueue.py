@@ -0,0 +1,139 @@
+import multiprocessing
+import os
+import time
+
+import pytest
+
+import workqueue
+from pipeline import Pipeline
+from workqueue import DONE, FAILED, QUEUED, RUNNING, WorkQueue, work
+
+
+@pytest.fixture
+def queue_path(tmp_path):
+    return str(tmp_path / "queue.sqlite3")
+
+
+def _drain(path, worker, claimed):
+    # claim and complete jobs until none are left, like racing workers do
+    with WorkQueue(path) as queue:
+        while (job := queue.claim(worker, lease=30)) is not None:
+            claimed.put((worker, job.id))
+            time.sleep(0.01)
+            assert queue.complete(job, {"worker": worker})
+
+
+def _claim_and_die(path):
+    # a worker killed mid-job: the lease is never extended or given back
+    queue = WorkQueue(path)
+    assert queue.claim("doomed", lease=0.5) is not None
+    os._exit(1)
+
+
+def test_claim_leases_each_pack_to_one_worker(queue_path):
+    with WorkQueue(queue_path) as queue:
+        assert queue.enqueue("1", {"output_fmt": "gif"})
+        assert queue.enqueue("1", {"output_fmt": "webm"})
+        assert queue.enqueue("2")
+        first = queue.claim("a")
+        assert (first.pack, first.status, first.attempts) == ("1", RUNNING, 1)
+        # the other job of pack 1 shares its download directory, it waits
+        second = queue.claim("b")
+        assert second.pack == "2"
+        assert queue.claim("c") is None
+        assert queue.complete(first, {})
+        assert queue.claim("c").options == {"output_fmt": "webm"}
+
+
+def test_heartbeat_keeps_and_expiry_loses_the_lease(queue_path):
+    with WorkQueue(queue_path) as queue:
+        queue.enqueue("1")
+        job = queue.claim("a", lease=0.3)
+        time.sleep(0.2)
+        assert queue.heartbeat(job, lease=0.3)
+        time.sleep(0.2)
+        assert queue.claim("b") is None
+        time.sleep(0.2)
+        reclaimed = queue.claim("b", lease=30)
+        assert (reclaimed.id, reclaimed.attempts) == (job.id, 2)
+        # the first worker finds out and its result is discarded
+        assert not queue.heartbeat(job)
+        assert not queue.complete(job, {})
+        assert queue.complete(reclaimed, {})
+        assert queue.counts() == {DONE: 1}
+
+
+def test_expired_lease_on_the_last_attempt_fails(queue_path):
+    with WorkQueue(queue_path, max_attempts=1) as queue:
+        queue.enqueue("1")
+        job = queue.claim("a", lease=0.1)
+        time.sleep(0.2)
+        assert queue.claim("b") is None
+        assert queue.jobs()[0].status == FAILED
+        assert queue.retry_failed() == 1
+        assert queue.claim("b").id == job.id
+
+
+def test_enqueue_requeues_finished_jobs(queue_path):
+    with WorkQueue(queue_path) as queue:
+        assert queue.enqueue("1")
+        assert not queue.enqueue("1")
+        job = queue.claim("a")
+        assert not queue.enqueue("1")
+        queue.complete(job, {"done": 1})
+        assert queue.enqueue("1")
+        (requeued,) = queue.jobs()
+        assert (requeued.status, requeued.attempts, requeued.result) == (
+            QUEUED,
+            0,
+            None,
+        )
+
+
+def test_processes_share_the_queue(queue_path):
+    with WorkQueue(queue_path) as queue:
+        for pack in range(30):
+            queue.enqueue(str(pack))
+    context = multiprocessing.get_context("spawn")
+    claimed = context.Queue()
+    processes = [
+        context.Process(target=_drain, args=(queue_path, f"w{i}", claimed))
+        for i in range(3)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+    claims = [claimed.get(timeout=5) for _ in range(30)]
+    assert claimed.empty()
+
+    # every job claimed once, by the worker that completed it
+    assert sorted(job_id for _, job_id in claims) == list(range(1, 31))
+    with WorkQueue(queue_path) as queue:
+        jobs = queue.jobs()
+    assert all(job.status == DONE and job.attempts == 1 for job in jobs)
+    assert all(job.result["worker"] == job.worker for job in jobs)
+
+
+def test_job_of_a_dead_worker_is_reclaimed(cdn, queue_path, tmp_path, monkeypatch):
+    _, pack_id = cdn
+    monkeypatch.setattr(workqueue, "POLL_SECONDS", 0.1)
+    with WorkQueue(queue_path) as queue:
+        queue.enqueue(pack_id, {"output_fmt": "none"})
+    process = multiprocessing.get_context("spawn").Process(
+        target=_claim_and_die, args=(queue_path,)
+    )
+    process.start()
+    process.join(60)
+    assert process.exitcode == 1
+
+    with WorkQueue(queue_path) as queue, Pipeline(
+        str(tmp_path / "data"), str(tmp_path / "out"), threads=2
+    ) as pipeline:
+        # polls while the dead worker's lease runs out, then takes the job over
+        assert work(queue, pipeline, "survivor", lease=5, log=lambda *a: None) == 1
+        (job,) = queue.jobs()
+    assert (job.status, job.worker, job.attempts) == (DONE, "survivor", 2)
+    assert job.result is not None
+    assert os.listdir(tmp_path / "out")
@@ -0,0 +1,189 @@
+"""
+Worker-count tuning for "-t auto".
+
+choose_workers() picks processing and download concurrency for a pack from
+the CPU count, the available memory and what the pack needs (VP9 encodes of
+512 px frames use far more memory and cores than scaling a PNG).
+AdaptiveLimiter then moves the processing limit at runtime: down when the
+process and its ffmpeg/magick children keep every core busy, up when cores are
+idle while tasks are queued.
+"""
+import os
+import threading
+import time
+
+AUTO = "auto"
+
+MAX_PROCESS_THREADS = 32
+MAX_DOWNLOAD_THREADS = 16
+MIN_DOWNLOAD_THREADS = 4
+# share of the available memory the workers may plan for
+MEMORY_BUDGET = 0.7
+
+# rough peak memory of one task (encoder plus decoded frames) for a 512 px
+# sticker, and how many cores that task keeps busy; emoji are ~4x smaller
+TASK_COST = {
+    # output format value: (MiB, cores)
+    "webm": (300, 2),
+    "mp4": (200, 2),
+    "gif": (150, 1),
+    "webp": (150, 1),
+    "png": (100, 1),
+    "raw": (0, 0),
+}
+EMOJI_COST_FACTOR = 0.25
+
+# AdaptiveLimiter: seconds between adjustments, and CPU utilisation (share of
+# all cores) above which to shed a worker / below which to add one
+ADJUST_INTERVAL = 2.0
+CPU_BUSY = 0.9
+CPU_IDLE = 0.6
+
+
+def parse_threads(value):
+    """argparse type for thread options: a positive integer or "auto"."""
+    if value == AUTO:
+        return AUTO
+    threads = int(value)
+    if threads < 1:
+        raise ValueError("thread count must be at least 1")
+    return threads
+
+
+def cpu_count():
+    # cores this process may actually run on
+    try:
+        return len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        return os.cpu_count() or 1
+
+
+def available_memory():
+    """Available memory in bytes, or None if it can not be determined."""
+    try:
+        with open("/proc/meminfo", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def process_cpu_seconds():
+    # CPU time of this process plus its finished children (ffmpeg, magick)
+    try:
+        import resource
+    except ImportError:
+        return time.process_time()
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (
+        self_usage.ru_utime
+        + self_usage.ru_stime
+        + children.ru_utime
+        + children.ru_stime
+    )
+
+
+class WorkerChoice:
+    def __init__(self, process_threads, download_threads, reason):
+        self.process_threads = process_threads
+        self.download_threads = download_threads
+        self.reason = reason
+
+    def __str__(self):
+        return (
+            f"{self.process_threads} processing thread(s), "
+            f"{self.download_threads} download thread(s) ({self.reason})"
+        )
+
+
+def choose_workers(output_format, is_emoji, sticker_count, downloads=0):
+    """
+    output_format is an OutputFormat value ("webm", "gif", ...); downloads is
+    the number of files fetched one by one besides the archive (overlays).
+    """
+    cpus = cpu_count()
+    memory = available_memory()
+    task_mib, task_cores = TASK_COST.get(output_format, TASK_COST["png"])
+    if is_emoji:
+        task_mib *= EMOJI_COST_FACTOR
+    reasons = [f"{cpus} CPUs"]
+
+    process_threads = MAX_PROCESS_THREADS
+    if task_cores:
+        process_threads = max(1, int(cpus / task_cores))
+    if memory is not None and task_mib:
+        by_memory = max(1, int(memory * MEMORY_BUDGET / (task_mib * 1024 * 1024)))
+        reasons.append(
+            f"{memory / 1024 ** 3:.1f} GiB available, ~{task_mib:.0f} MiB per task"
+        )
+        process_threads = min(process_threads, by_memory)
+    process_threads = max(1, min(process_threads, sticker_count, MAX_PROCESS_THREADS))
+
+    # downloads wait on the network, not on the CPU
+    download_threads = max(
+        MIN_DOWNLOAD_THREADS, min(downloads, cpus * 2, MAX_DOWNLOAD_THREADS)
+    )
+    reasons.append(f"{output_format} output")
+    return WorkerChoice(process_threads, download_threads, ", ".join(reasons))
+
+
+class AdaptiveLimiter:
+    """
+    Lets at most `limit` tasks run at a time; use `with limiter:` around each
+    task. Every ADJUST_INTERVAL seconds the limit is lowered when the CPU is
+    saturated and raised when it is underused while tasks wait for a slot.
+    """
+
+    def __init__(self, limit, maximum, cpus=None, log=None):
+        self.limit = limit
+        self.minimum = 1
+        self.maximum = max(limit, maximum)
+        self.cpus = cpus or cpu_count()
+        self.log = log or (lambda *args, **kwargs: None)
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._last_wall = time.perf_counter()
+        self._last_cpu = process_cpu_seconds()
+
+    def __enter__(self):
+        with self._cond:
+            self._waiting += 1
+            while self._active >= self.limit:
+                self._cond.wait()
+            self._waiting -= 1
+            self._active += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        with self._cond:
+            self._active -= 1
+            self._maybe_adjust()
+            self._cond.notify_all()
+        return False
+
+    def _maybe_adjust(self):
+        # called with the lock held
+        now = time.perf_counter()
+        elapsed = now - self._last_wall
+        if elapsed < ADJUST_INTERVAL:
+            return
+        cpu = process_cpu_seconds()
+        utilisation = (cpu - self._last_cpu) / elapsed / self.cpus
+        self._last_wall, self._last_cpu = now, cpu
+        old = self.limit
+        if utilisation > CPU_BUSY and self.limit > self.minimum:
+            self.limit -= 1
+        elif utilisation < CPU_IDLE and self._waiting and self.limit < self.maximum:
+            self.limit += 1
+        if self.limit != old:
+            self.log(
+                f"Auto tuning: processing threads {old} -> {self.limit} "
+                f"(CPU {utilisation:.0%} busy, {self._waiting} task(s) queued)"
+            )
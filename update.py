@@ -0,0 +1,307 @@
+"""
+Differential updates of a downloaded pack (--update).
+
+LINE revises packs now and then, replacing or adding stickers. Instead of
+downloading the whole archive again, the fresh metadata is compared with the
+one inside the local pack.zip. If the pack changed, the CDN is asked (HEAD) for
+the ETag and size of every remaining sticker's own file; new and changed
+stickers are downloaded through the per-sticker URLs of STICKER_URL_TEMPLATES
+and patched into pack.zip, removed ones are dropped from it. The output
+manifest then reprocesses exactly the stickers whose files changed.
+
+The ETags and sizes seen are kept in sources.json next to pack.zip, so later
+updates compare ETags instead of the sizes of the archive members.
+"""
+import json
+import os
+import re
+import tempfile
+import zipfile
+from threading import Lock
+
+import metrics
+import webreq
+from pipeline import extract_pack_info_from_metadata
+from utils import (
+    STICKER_SOUND_URL,
+    STICKER_URL_TEMPLATES,
+    StickerType,
+    sticker_type_properties,
+)
+
+SOURCES_FILENAME = "sources.json"
+
+ADDED = "added"
+CHANGED = "changed"
+REMOVED = "removed"
+UNCHANGED = "unchanged"
+# why changed_on_cdn took a sticker for changed
+ETAG = "etag"
+SIZE = "size"
+
+
+class UpdateUnavailable(Exception):
+    """The pack can not be updated sticker by sticker, download the archive."""
+
+
+class PackUpdate:
+    def __init__(self, pack_id):
+        self.pack_id = pack_id
+        self.added = []
+        self.changed = []
+        self.removed = []
+        self.unchanged = 0
+        # requests made besides the metadata, and bytes downloaded
+        self.requests = 0
+        self.bytes = 0
+        self._lock = Lock()
+
+    def count(self, size=None):
+        # one more request, which downloaded size bytes
+        with self._lock:
+            self.requests += 1
+            self.bytes += size or 0
+
+    def to_dict(self):
+        return {
+            "pack_id": self.pack_id,
+            ADDED: self.added,
+            CHANGED: self.changed,
+            REMOVED: self.removed,
+            UNCHANGED: self.unchanged,
+            "requests": self.requests,
+            "bytes": self.bytes,
+        }
+
+    def __str__(self):
+        return (
+            f"{len(self.added)} added, {len(self.changed)} changed,"
+            f" {len(self.removed)} removed, {self.unchanged} unchanged"
+            f" ({self.requests} request(s), {self.bytes:,} bytes)"
+        )
+
+
+def sticker_members(sticker_type: StickerType, pack_id, sticker_id):
+    """
+    Return [(archive member, url, required)] of the files of one sticker that
+    can be fetched one by one. Required files are the image the sticker is
+    converted from and its sound; the static image of an animated sticker is
+    taken along when available.
+    """
+    if sticker_type not in STICKER_URL_TEMPLATES:
+        raise UpdateUnavailable(f"no per-sticker URLs for {sticker_type.name}")
+    has_animation, has_sound, has_popup, _, is_emoji = sticker_type_properties(
+        sticker_type
+    )
+    url = STICKER_URL_TEMPLATES[sticker_type].format(
+        pack_id=pack_id, sticker_id=sticker_id
+    )
+    if is_emoji:
+        suffix = "_animation" if has_animation else ""
+        return [(f"{sticker_id}{suffix}.png", url, True)]
+    static_url = STICKER_URL_TEMPLATES[StickerType.STATIC_STICKER].format(
+        sticker_id=sticker_id
+    )
+    if has_popup:
+        members = [(f"popup/{sticker_id}.png", url, True)]
+        members.append((f"{sticker_id}@2x.png", static_url, False))
+    elif has_animation:
+        members = [(f"animation@2x/{sticker_id}@2x.png", url, True)]
+        members.append((f"{sticker_id}@2x.png", static_url, False))
+    else:
+        members = [(f"{sticker_id}@2x.png", url, True)]
+    if has_sound:
+        sound_url = STICKER_SOUND_URL.format(sticker_id=sticker_id)
+        members.append((f"sound/{sticker_id}.m4a", sound_url, True))
+    return members
+
+
+class StickerSources:
+    """ETag and size of every archive member fetched or checked one by one."""
+
+    def __init__(self, download_dir):
+        self.path = os.path.join(download_dir, SOURCES_FILENAME)
+        self._lock = Lock()
+        self.members = {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                self.members = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def get(self, member):
+        with self._lock:
+            return self.members.get(member)
+
+    def set(self, member, etag, size):
+        with self._lock:
+            self.members[member] = {"etag": etag, "size": size}
+
+    def forget(self, members):
+        with self._lock:
+            for member in members:
+                self.members.pop(member, None)
+
+    def save(self):
+        with self._lock:
+            data = dict(self.members)
+        _write_atomic(self.path, json.dumps(data, indent=1).encode())
+
+
+def _write_atomic(path, content: bytes):
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=os.path.basename(path), suffix=".tmp", dir=os.path.dirname(path)
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _entries(metadata, is_emoji):
+    # sticker id -> its metadata entry (width, height, ... where LINE has them)
+    if is_emoji:
+        return {str(i): {} for i in metadata["orders"]}
+    return {str(s["id"]): s for s in metadata["stickers"]}
+
+
+def _sticker_member_names(names, sticker_id):
+    # all archive members of a sticker: 123@2x.png, popup/123.png, 001_animation.png
+    pattern = re.compile(rf"(?:.*/)?{re.escape(sticker_id)}(?:\D.*)?")
+    return [n for n in names if pattern.fullmatch(n)]
+
+
+def update_archive(archive_path, metadata, pack_id, is_emoji, pool):
+    """
+    Bring archive_path up to date with metadata (freshly fetched), fetching
+    files on pool (an Executor). Return a PackUpdate, or raise
+    UpdateUnavailable if the whole archive has to be downloaded instead.
+    """
+    meta_name = "meta.json" if is_emoji else "productInfo.meta"
+    with zipfile.ZipFile(archive_path) as archive:
+        infos = {info.filename: info for info in archive.infolist()}
+        old_metadata = json.loads(archive.read(meta_name))
+    result = PackUpdate(pack_id)
+    new_entries = _entries(metadata, is_emoji)
+    if old_metadata == metadata:
+        # not revised since it was downloaded
+        result.unchanged = len(new_entries)
+        metrics.inc("update_stickers_total", len(new_entries), change=UNCHANGED)
+        return result
+
+    old_info = extract_pack_info_from_metadata(old_metadata, pack_id, "en", is_emoji)
+    new_info = extract_pack_info_from_metadata(metadata, pack_id, "en", is_emoji)
+    if old_info["sticker_type"] != new_info["sticker_type"]:
+        raise UpdateUnavailable("the sticker type changed")
+    sticker_type = StickerType(new_info["sticker_type"])
+    old_entries = _entries(old_metadata, is_emoji)
+    members = {
+        sticker_id: sticker_members(sticker_type, pack_id, sticker_id)
+        for sticker_id in new_entries
+    }
+    sources = StickerSources(os.path.dirname(archive_path))
+
+    def changed_on_cdn(sticker_id):
+        # compare ETags seen before, or else the sizes of the archive members;
+        # returns None if unchanged, else ETAG or SIZE
+        for member, url, required in members[sticker_id]:
+            if not required:
+                continue
+            etag, size = webreq.head_file(url)
+            result.count()
+            known = sources.get(member)
+            if etag is None and size is None:
+                # not on the CDN, the archive copy is all there is
+                continue
+            if known and known.get("etag") and etag:
+                if etag != known["etag"]:
+                    return ETAG
+            elif member not in infos or (
+                size is not None and size != infos[member].file_size
+            ):
+                return SIZE
+            sources.set(member, etag, size)
+        return None
+
+    candidates = []
+    for sticker_id, entry in new_entries.items():
+        if sticker_id not in old_entries:
+            result.added.append(sticker_id)
+        elif entry != old_entries[sticker_id]:
+            result.changed.append(sticker_id)
+        else:
+            candidates.append(sticker_id)
+    result.removed = [i for i in old_entries if i not in new_entries]
+    reasons = list(pool.map(changed_on_cdn, candidates))
+    if len(candidates) > 1 and all(reason == SIZE for reason in reasons):
+        # the per-sticker files are not the archive members byte for byte,
+        # fetching every sticker one by one would cost more than the archive
+        metrics.inc("update_unavailable_total", reason="size_mismatch")
+        raise UpdateUnavailable("the sticker files differ from the archive members")
+    for sticker_id, reason in zip(candidates, reasons):
+        if reason:
+            result.changed.append(sticker_id)
+        else:
+            result.unchanged += 1
+
+    def fetch(sticker_id):
+        files = {}
+        for member, url, required in members[sticker_id]:
+            content, etag = webreq.get_file(url, "sticker")
+            result.count(len(content) if content else 0)
+            if content is None:
+                if required:
+                    raise UpdateUnavailable(f"{url} is not available")
+                continue
+            files[member] = content
+            sources.set(member, etag, len(content))
+        return files
+
+    fetched = {}
+    for files in pool.map(fetch, result.added + result.changed):
+        fetched.update(files)
+    dropped = set()
+    for sticker_id in result.removed:
+        dropped.update(_sticker_member_names(infos, sticker_id))
+    sources.forget(dropped)
+    _rewrite_archive(archive_path, meta_name, metadata, fetched, dropped)
+    sources.save()
+    for change, count in (
+        (ADDED, len(result.added)),
+        (CHANGED, len(result.changed)),
+        (REMOVED, len(result.removed)),
+        (UNCHANGED, result.unchanged),
+    ):
+        metrics.inc("update_stickers_total", count, change=change)
+    return result
+
+
+def _rewrite_archive(path, meta_name, metadata, files, dropped):
+    # copy the untouched members, then add the fetched files and the metadata
+    fd, tmp_path = tempfile.mkstemp(
+        prefix="pack", suffix=".zip.tmp", dir=os.path.dirname(path)
+    )
+    os.close(fd)
+    try:
+        with zipfile.ZipFile(path) as src, zipfile.ZipFile(tmp_path, "w") as dst:
+            for info in src.infolist():
+                name = info.filename
+                if name in files or name in dropped or name == meta_name:
+                    continue
+                dst.writestr(info, src.read(name))
+            for name, content in files.items():
+                dst.writestr(name, content)
+            dst.writestr(
+                meta_name,
+                json.dumps(metadata, ensure_ascii=False).encode(),
+                compress_type=zipfile.ZIP_DEFLATED,
+            )
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
@@ -24,6 +24,40 @@ class StickerType(Enum):
     # MAIN_POPUP = '_main_popup'
 
 
+class OutputFormat(Enum):
+    # this will also be the file extension
+    GIF = "gif"
+    WEBM = "webm"
+    MP4 = "mp4"
+    APNG = "png"
+    WEBP = "webp"
+    RAW = "raw"
+
+
+class Operation(Enum):
+    SCALE = "scale"
+    OVERLAY = "overlay"
+    REMOVE_ALPHA = "remove_alpha"
+    TO_GIF = "to_gif"
+    TO_WEBM = "to_webm"
+    TO_MP4 = "to_mp4"
+    TO_WEBP = "to_webp"
+    OPTIMIZE_PNG = "optimize_png"
+    OPTIMIZE_APNG = "optimize_apng"
+
+
+# encoder presets, see processing.VP9_PRESETS and friends
+PRESET_FAST = "fast"
+PRESET_BALANCED = "balanced"
+PRESET_SMALLEST = "smallest"
+ENCODER_PRESETS = [PRESET_FAST, PRESET_BALANCED, PRESET_SMALLEST]
+DEFAULT_ENCODER_PRESET = PRESET_BALANCED
+
+# Telegram video sticker limits
+WEBM_SIZE_KB_MAX = 256
+WEBM_DURATION_SEC_MAX = 3
+
+
 # match the pack id (int for sticker and hex for emoji)
 PACK_ID_REGEX = re.compile(r"/([a-f0-9]+)/")
 
@@ -91,6 +125,12 @@ STICKER_SET_URL_TEMPLATES = {
     SourceUrlType.YABE: "https://yabeline.tw/Stickers_Data.php?Number={pack_id}",
     SourceUrlType.YABE_EMOJI: "https://yabeline.tw/Emoji_Data.php?Number={pack_id}",
 }
+# hosts the templates below point at, see webreq.set_base_urls
+LINE_CDN_BASE_URL = "https://stickershop.line-scdn.net"
+LINE_STORE_BASE_URL = "https://store.line.me"
+# environment variables overriding the hosts above, e.g. to use a local mock CDN
+LINE_CDN_BASE_URL_ENV = "LINE_CDN_BASE_URL"
+LINE_STORE_BASE_URL_ENV = "LINE_STORE_BASE_URL"
 # metadata
 STICKER_SET_META_URL = "https://stickershop.line-scdn.net/stickershop/v1/product/{pack_id}/iphone/productInfo.meta"
 EMOJI_SET_META_URL = (
@@ -134,6 +174,7 @@ STICKER_URL_TEMPLATES = {
     StickerType.ANIMATED_EMOJI: "https://stickershop.line-scdn.net/sticonshop/v1/sticon/{pack_id}/iPhone/{sticker_id}_animation.png",
     StickerType.EMOJI: "https://stickershop.line-scdn.net/sticonshop/v1/sticon/{pack_id}/iPhone/{sticker_id}.png",
 }
+STICKER_SOUND_URL = "https://stickershop.line-scdn.net/stickershop/v1/sticker/{sticker_id}/IOS/sticker_sound.m4a"
 # request headers
 FAKE_HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/63.0.3239.132 Safari/537.36"
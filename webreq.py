@@ -1,13 +1,19 @@
 import os
 import re
-from threading import Thread
+import time
+from threading import Lock, Thread
 
-import requests
-from bs4 import BeautifulSoup
+import metrics
 
+# requests and bs4 are imported where they are used, so that runs which never
+# touch the network (e.g. a local pack.zip) do not pay for importing them
 from utils import (
     EMOJI_SET_META_URL,
     FAKE_HEADERS,
+    LINE_CDN_BASE_URL,
+    LINE_CDN_BASE_URL_ENV,
+    LINE_STORE_BASE_URL,
+    LINE_STORE_BASE_URL_ENV,
     PackNotFoundException,
     STICKER_SET_META_URL,
     STICKER_SET_URL_TEMPLATES,
@@ -17,7 +23,19 @@ from utils import (
     increase_counter,
 )
 
+# (connect, read) timeout of every request in seconds; the read timeout is the
+# longest silence allowed between bytes, not a limit on the whole download
+REQUEST_TIMEOUT = (10, 60)
+# attempts after the first for connection errors, timeouts, 429 and 5xx
+REQUEST_RETRIES = 3
+# seconds before the first retry, doubled for every further one
+RETRY_BACKOFF = 1.0
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
 _proxies = None
+_base_url_overrides = {}
+_session = None
+_session_lock = Lock()
 
 
 def set_proxy(proxies):
@@ -25,22 +43,138 @@ def set_proxy(proxies):
     _proxies = proxies
 
 
+def get_session():
+    # one pooled session per process, so connections are reused across packs
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                import requests
+
+                session = requests.Session()
+                session.headers.update(FAKE_HEADERS)
+                _session = session
+    return _session
+
+
+def close_session():
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def set_base_urls(cdn=None, store=None):
+    # redirect requests for the LINE CDN/store to another host, e.g. mock_cdn.py
+    # hosts passed as None keep their current setting
+    if cdn:
+        _base_url_overrides[LINE_CDN_BASE_URL] = cdn.rstrip("/")
+    if store:
+        _base_url_overrides[LINE_STORE_BASE_URL] = store.rstrip("/")
+
+
+def rebase_url(url):
+    for base, override in _base_url_overrides.items():
+        if url.startswith(base):
+            return override + url[len(base) :]
+    return url
+
+
+set_base_urls(
+    os.environ.get(LINE_CDN_BASE_URL_ENV), os.environ.get(LINE_STORE_BASE_URL_ENV)
+)
+
+
+def _get(url, kind):
+    return _request("GET", url, kind)
+
+
+def _request(method, url, kind):
+    # every request goes through here so it is counted; kind labels the metrics
+    import requests
+
+    for attempt in range(REQUEST_RETRIES + 1):
+        last_attempt = attempt == REQUEST_RETRIES
+        start = time.perf_counter()
+        try:
+            r = get_session().request(
+                method, rebase_url(url), proxies=_proxies, timeout=REQUEST_TIMEOUT
+            )
+            size = len(r.content)
+        except (
+            requests.ConnectionError,
+            requests.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+        ) as e:
+            metrics.inc("http_requests_total", kind=kind, status=type(e).__name__)
+            if last_attempt:
+                raise
+        else:
+            metrics.observe(
+                "http_request_seconds", time.perf_counter() - start, kind=kind
+            )
+            metrics.inc("http_requests_total", kind=kind, status=r.status_code)
+            metrics.inc("http_downloaded_bytes_total", size, kind=kind)
+            if r.status_code not in RETRY_STATUS or last_attempt:
+                return r
+        metrics.inc("http_retries_total", kind=kind)
+        time.sleep(RETRY_BACKOFF * 2**attempt)
+
+
 def download_file(url, filename, overwrite=False):
     if os.path.isfile(filename) and not overwrite:
         # file exist
+        metrics.inc("download_cache_hits_total")
         return
-    r = requests.get(url, proxies=_proxies, headers=FAKE_HEADERS)
-    with open(filename, "wb") as f:
-        f.write(r.content)
+    r = _get(url, "file")
+    r.raise_for_status()
+    # an interrupted write must not look like a finished download next time
+    write_atomic(filename, r.content)
+
+
+def write_atomic(filename, content):
+    tmp_file = filename + ".part"
+    with open(tmp_file, "wb") as f:
+        f.write(content)
+    os.replace(tmp_file, filename)
+
+
+def head_file(url):
+    """
+    Return (ETag, size) of url without downloading it, (None, None) if it does
+    not exist. Either may be None if the server does not send it.
+    """
+    r = _request("HEAD", url, "head")
+    if r.status_code == 404:
+        return None, None
+    r.raise_for_status()
+    size = r.headers.get("Content-Length")
+    return r.headers.get("ETag"), int(size) if size and size.isdigit() else None
+
+
+def get_file(url, kind="file"):
+    """Return (content, ETag) of url, (None, None) if it does not exist."""
+    r = _get(url, kind)
+    if r.status_code == 404:
+        return None, None
+    r.raise_for_status()
+    return r.content, r.headers.get("ETag")
 
 
 def get_real_pack_id_from_yabe_emoji(pack_id):
-    r = requests.get(
+    r = _get(
         STICKER_SET_URL_TEMPLATES[SourceUrlType.YABE_EMOJI].format(pack_id=pack_id),
-        proxies=_proxies,
-        headers=FAKE_HEADERS,
+        "yabe_page",
     )
-    soup = BeautifulSoup(r.content, "html5lib")
+    return parse_yabe_emoji_page(r.content)
+
+
+def parse_yabe_emoji_page(content):
+    # the LINE pack id a yabe emoji page links to
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(content, "html5lib")
     if match := re.search(r"line.me/S/emoji/\?id=([a-f0-9]+)", soup.text):
         pack_id = match.group(1)
     else:
@@ -58,8 +192,15 @@ def get_sticker_info_from_line_page(pack_id, is_emoji, lang):
             pack_id=pack_id, lang=lang
         )
     )
-    r = requests.get(url, proxies=_proxies, headers=FAKE_HEADERS)
-    soup = BeautifulSoup(r.content, "html5lib")
+    r = _get(url, "store_page")
+    return parse_line_store_page(r.content, is_emoji, pack_id)
+
+
+def parse_line_store_page(content, is_emoji, pack_id=None):
+    # (title, author name, author id) from a LINE store page
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(content, "html5lib")
     if soup.select_one('[data-test="not-on-sale-description"]'):
         # the sticker is not available, maybe due to region restriction or no longer available
         # we can still get title and head image though
@@ -99,15 +240,17 @@ def get_metadata(pack_id: str, is_emoji: bool) -> dict:
         metadata_url = EMOJI_SET_META_URL.format(pack_id=pack_id)
     else:
         metadata_url = STICKER_SET_META_URL.format(pack_id=pack_id)
-    r = requests.get(metadata_url, proxies=_proxies, headers=FAKE_HEADERS)
+    r = _get(metadata_url, "metadata")
     if r.status_code == 404:
         raise PackNotFoundException(f"Sticker pack {pack_id} not found!")
+    r.raise_for_status()
     return r.json()
 
 
 def get_sticker_archive(pack_id, sticker_type: StickerType):
     url = STICKER_ZIP_TEMPLATES[sticker_type].format(pack_id=pack_id)
-    r = requests.get(url, proxies=_proxies, headers=FAKE_HEADERS)
+    r = _get(url, "archive")
+    r.raise_for_status()
     return r.content
 
 
@@ -118,12 +261,15 @@ class MultiThreadDownloader(Thread):
         self.overwrite = overwrite
 
     def run(self):
+        import requests
+
         while not self.queue.empty():
             _id, url, path = self.queue.get()
             try:
                 download_file(url, path, overwrite=self.overwrite)
-            except requests.RequestException:
-                self.queue.put((_id, url, path))
+            except requests.RequestException as e:
+                # _get has retried already, requeueing could loop forever
+                print(f"Failed to download {url}: {e!r}")
 
             else:
                 increase_counter()
@@ -0,0 +1,542 @@
+"""
+Work queue shared by several worker processes or machines, for big backfills.
+
+The queue is a SQLite file on a directory every worker can reach. A job is one
+pack with its PackOptions. Workers claim jobs with a lease. While a pack
+converts, a heartbeat thread extends the lease. If a worker dies, its lease
+runs out and the next worker claims the job again. That worker resumes at
+sticker level from the output manifest and the downloaded pack.zip. A job
+fails for good after MAX_ATTEMPTS claims. Every worker writes into the same
+data and output directories:
+
+    python workqueue.py enqueue /shared/queue.sqlite3 11537 11538 --output-fmt webm
+    python downloader.py 11539 --output-fmt gif --enqueue /shared/queue.sqlite3
+    python workqueue.py work /shared/queue.sqlite3 -o /shared/out --data-dir /shared/dl
+    python workqueue.py work /shared/queue.sqlite3 -o /shared/out --processes 4
+    python workqueue.py status /shared/queue.sqlite3
+
+Leases are compared against wall-clock time, so the machines' clocks must
+agree to well within LEASE_SECONDS. The file needs a filesystem with working
+POSIX locks. Local disks and most NFSv4 mounts have them; SMB shares often
+do not.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+from threading import Lock
+
+import tuning
+import webreq
+from pipeline import (
+    DEFAULT_DOWNLOAD_THREADS,
+    DEFAULT_PROCESS_THREADS,
+    PackOptions,
+    Pipeline,
+)
+from service import JOB_OPTION_FIELDS
+
+LEASE_SECONDS = 60.0
+# the heartbeat extends the lease this many times per lease period
+HEARTBEATS_PER_LEASE = 3
+MAX_ATTEMPTS = 3
+POLL_SECONDS = 2.0
+# how long a connection waits for another worker's write lock
+BUSY_TIMEOUT = 30.0
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    pack TEXT NOT NULL,
+    options TEXT NOT NULL,
+    status TEXT NOT NULL,
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    created REAL,
+    started REAL,
+    finished REAL,
+    UNIQUE (pack, options)
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_until);
+"""
+
+
+class Job:
+    def __init__(self, row):
+        self.id = row["id"]
+        self.pack = row["pack"]
+        # PackOptions fields, see service.JOB_OPTION_FIELDS
+        self.options = json.loads(row["options"])
+        self.status = row["status"]
+        self.worker = row["worker"]
+        self.lease_until = row["lease_until"]
+        self.attempts = row["attempts"]
+        self.result = json.loads(row["result"]) if row["result"] else None
+        self.error = row["error"]
+        self.created = row["created"]
+        self.started = row["started"]
+        self.finished = row["finished"]
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "pack": self.pack,
+            "options": self.options,
+            "status": self.status,
+            "worker": self.worker,
+            "lease_until": self.lease_until,
+            "attempts": self.attempts,
+            "result": self.result,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+def job_options(options: PackOptions):
+    """The queueable fields of options, as stored with a job."""
+    return {field: getattr(options, field) for field in sorted(JOB_OPTION_FIELDS)}
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    """
+    Thread safe; one connection is shared behind a lock. Every process opens
+    its own WorkQueue on the same file.
+    """
+
+    def __init__(self, path, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = Lock()
+        # autocommit, transactions are opened with BEGIN IMMEDIATE so that a
+        # claim takes the write lock before it reads
+        self._conn = sqlite3.connect(
+            path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False
+        )
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _write(self, sql, params=()):
+        # one statement in its own transaction, returns the changed row count
+        with self._lock:
+            return self._conn.execute(sql, params).rowcount
+
+    def enqueue(self, pack, options: dict = None):
+        """
+        Add a job, or queue a done or failed one again with fresh attempts.
+        Return False if the same job is already queued or running.
+        """
+        options = json.dumps(options or {}, sort_keys=True)
+        return bool(
+            self._write(
+                "INSERT INTO jobs (pack, options, status, created)"
+                " VALUES (?, ?, ?, ?) ON CONFLICT (pack, options) DO UPDATE SET"
+                " status = excluded.status, worker = NULL, lease_until = NULL,"
+                " attempts = 0, result = NULL, error = NULL,"
+                " created = excluded.created, started = NULL, finished = NULL"
+                " WHERE jobs.status IN (?, ?)",
+                (pack, options, QUEUED, time.time(), DONE, FAILED),
+            )
+        )
+
+    def claim(self, worker, lease=LEASE_SECONDS):
+        """
+        Lease the oldest queued job, or a running job whose lease expired, to
+        worker. Return the Job, or None if there is nothing to claim.
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # abandoned too often, probably a pack that kills its worker
+                conn.execute(
+                    "UPDATE jobs SET status = ?, finished = ?,"
+                    " error = 'lease expired on the last attempt'"
+                    " WHERE status = ? AND lease_until < ? AND attempts >= ?",
+                    (FAILED, now, RUNNING, now, self.max_attempts),
+                )
+                # the same pack with other options waits, the jobs would share
+                # the download directory
+                row = conn.execute(
+                    "SELECT id FROM jobs WHERE (status = ?"
+                    " OR (status = ? AND lease_until < ?)) AND pack NOT IN ("
+                    "  SELECT pack FROM jobs WHERE status = ? AND lease_until >= ?)"
+                    " ORDER BY id LIMIT 1",
+                    (QUEUED, RUNNING, now, RUNNING, now),
+                ).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                conn.execute(
+                    "UPDATE jobs SET status = ?, worker = ?, lease_until = ?,"
+                    " attempts = attempts + 1, started = ?, error = NULL"
+                    " WHERE id = ?",
+                    (RUNNING, worker, now + lease, now, row["id"]),
+                )
+                job = conn.execute(
+                    "SELECT * FROM jobs WHERE id = ?", (row["id"],)
+                ).fetchone()
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return Job(job)
+
+    def heartbeat(self, job: Job, lease=LEASE_SECONDS):
+        """Extend the lease, return False if the job is no longer ours."""
+        return bool(
+            self._write(
+                "UPDATE jobs SET lease_until = ?"
+                " WHERE id = ? AND worker = ? AND status = ?",
+                (time.time() + lease, job.id, job.worker, RUNNING),
+            )
+        )
+
+    def complete(self, job: Job, result: dict):
+        return bool(
+            self._write(
+                "UPDATE jobs SET status = ?, result = ?, finished = ?,"
+                " lease_until = NULL WHERE id = ? AND worker = ? AND status = ?",
+                (DONE, json.dumps(result), time.time(), job.id, job.worker, RUNNING),
+            )
+        )
+
+    def fail(self, job: Job, error):
+        """Queue the job again, or fail it for good after max_attempts."""
+        return bool(
+            self._write(
+                "UPDATE jobs SET status = CASE WHEN attempts < ? THEN ? ELSE ? END,"
+                " error = ?, finished = ?, lease_until = NULL"
+                " WHERE id = ? AND worker = ? AND status = ?",
+                (
+                    self.max_attempts,
+                    QUEUED,
+                    FAILED,
+                    error,
+                    time.time(),
+                    job.id,
+                    job.worker,
+                    RUNNING,
+                ),
+            )
+        )
+
+    def release(self, job: Job):
+        """Give the job back without counting the attempt (worker interrupted)."""
+        return bool(
+            self._write(
+                "UPDATE jobs SET status = ?, worker = NULL, lease_until = NULL,"
+                " attempts = attempts - 1 WHERE id = ? AND worker = ? AND status = ?",
+                (QUEUED, job.id, job.worker, RUNNING),
+            )
+        )
+
+    def retry_failed(self):
+        """Queue every failed job again with fresh attempts."""
+        return self._write(
+            "UPDATE jobs SET status = ?, attempts = 0, worker = NULL WHERE status = ?",
+            (QUEUED, FAILED),
+        )
+
+    def pending(self):
+        """Whether any job is queued or running (and might need reclaiming)."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM jobs WHERE status IN (?, ?) LIMIT 1", (QUEUED, RUNNING)
+            ).fetchone()
+        return row is not None
+
+    def counts(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*) FROM jobs GROUP BY status"
+            ).fetchall()
+        return {status: count for status, count in rows}
+
+    def jobs(self, status=None):
+        sql, params = "SELECT * FROM jobs", ()
+        if status:
+            sql, params = sql + " WHERE status = ?", (status,)
+        with self._lock:
+            rows = self._conn.execute(sql + " ORDER BY id", params).fetchall()
+        return [Job(row) for row in rows]
+
+
+class _Heartbeat:
+    """Extends a job's lease from a background thread while the pack runs."""
+
+    def __init__(self, queue: WorkQueue, job: Job, lease, log):
+        self.queue = queue
+        self.job = job
+        self.lease = lease
+        self.log = log
+        # another worker reclaimed the job, our result will be discarded
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name=f"Heartbeat-{job.id}", daemon=True
+        )
+
+    def _run(self):
+        while not self._stop.wait(self.lease / HEARTBEATS_PER_LEASE):
+            try:
+                alive = self.queue.heartbeat(self.job, self.lease)
+            except sqlite3.Error as e:
+                # the next beat may get through before the lease runs out
+                self.log(f"Heartbeat of job {self.job.id} failed: {e}")
+                continue
+            if not alive:
+                self.lost = True
+                self.log(f"Lost the lease of job {self.job.id} ({self.job.pack})")
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def _result_summary(result):
+    summary = result.to_dict()
+    summary.pop("stickers")
+    summary.update(
+        done=result.done_count,
+        failed=result.failed_count,
+        skipped=result.skipped_count,
+    )
+    return summary
+
+
+def work(
+    queue: WorkQueue,
+    pipeline: Pipeline,
+    worker=None,
+    lease=LEASE_SECONDS,
+    max_jobs=None,
+    wait=False,
+    log=print,
+):
+    """
+    Claim and run jobs until the queue is drained (or forever with wait).
+    While other workers still hold leases, keep polling, so their jobs are
+    taken over if they die. Returns the number of jobs completed.
+    """
+    worker = worker or default_worker_id()
+    completed = 0
+    while max_jobs is None or completed < max_jobs:
+        job = queue.claim(worker, lease)
+        if job is None:
+            if not wait and not queue.pending():
+                break
+            time.sleep(POLL_SECONDS)
+            continue
+        log(f"[{worker}] job {job.id}: {job.pack} (attempt {job.attempts})")
+        start = time.perf_counter()
+        try:
+            with _Heartbeat(queue, job, lease, log) as heartbeat:
+                result = pipeline.run(job.pack, PackOptions(**job.options))
+        except KeyboardInterrupt:
+            queue.release(job)
+            raise
+        except Exception as e:
+            traceback.print_exc()
+            queue.fail(job, repr(e))
+            log(f"[{worker}] job {job.id} failed: {e!r}")
+            continue
+        if heartbeat.lost or not queue.complete(job, _result_summary(result)):
+            log(f"[{worker}] job {job.id} finished after its lease was taken over")
+            continue
+        completed += 1
+        log(
+            f"[{worker}] job {job.id} done in {time.perf_counter() - start:.1f}s:"
+            f" {result.done_count} done, {result.failed_count} failed,"
+            f" {result.skipped_count} skipped"
+        )
+    return completed
+
+
+def _work_process(args, index=0):
+    # one worker: its own Pipeline and queue connection
+    if args.proxy:
+        webreq.set_proxy({"https": args.proxy})
+    if args.cdn_base_url:
+        webreq.set_base_urls(cdn=args.cdn_base_url)
+    worker = args.worker_id or default_worker_id()
+    if args.worker_id and args.processes > 1:
+        worker = f"{worker}-{index}"
+    with WorkQueue(args.queue, args.max_attempts) as queue, Pipeline(
+        data_dir=args.data_dir,
+        output_dir=args.output_dir,
+        threads=args.threads,
+        download_threads=(
+            tuning.AUTO if args.threads == tuning.AUTO else DEFAULT_DOWNLOAD_THREADS
+        ),
+    ) as pipeline:
+        try:
+            completed = work(
+                queue,
+                pipeline,
+                worker,
+                lease=args.lease,
+                max_jobs=args.max_jobs,
+                wait=args.wait,
+            )
+        except KeyboardInterrupt:
+            print(f"[{worker}] interrupted, running job released")
+            return
+    print(f"[{worker}] completed {completed} job(s)")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description="Work queue of packs shared by several workers"
+    )
+    commands = arg_parser.add_subparsers(dest="command", required=True)
+
+    enqueue_parser = commands.add_parser("enqueue", help="Add packs to the queue")
+    enqueue_parser.add_argument("queue", type=str, help="Queue file")
+    enqueue_parser.add_argument("packs", nargs="+", help="Pack ids or urls")
+    enqueue_parser.add_argument(
+        "--options",
+        type=str,
+        default="{}",
+        help='PackOptions fields as JSON, e.g. \'{"output_fmt": "webm"}\'',
+    )
+    enqueue_parser.add_argument(
+        "--output-fmt", type=str, help="Shorthand for the output_fmt option"
+    )
+
+    work_parser = commands.add_parser("work", help="Run jobs from the queue")
+    work_parser.add_argument("queue", type=str, help="Queue file")
+    work_parser.add_argument(
+        "-o", "--output-dir", type=str, help="Output directory shared by all workers"
+    )
+    work_parser.add_argument(
+        "--data-dir", type=str, help="Download directory shared by all workers"
+    )
+    work_parser.add_argument(
+        "--processes", type=int, default=1, help="Worker processes on this machine"
+    )
+    work_parser.add_argument(
+        "-t",
+        "--threads",
+        type=tuning.parse_threads,
+        default=DEFAULT_PROCESS_THREADS,
+        help='Processing threads of each worker, or "auto"',
+    )
+    work_parser.add_argument(
+        "--lease", type=float, default=LEASE_SECONDS, help="Lease length in seconds"
+    )
+    work_parser.add_argument("--max-attempts", type=int, default=MAX_ATTEMPTS)
+    work_parser.add_argument(
+        "--max-jobs", type=int, help="Stop after this many jobs per worker"
+    )
+    work_parser.add_argument(
+        "--wait", action="store_true", help="Keep polling once the queue is empty"
+    )
+    work_parser.add_argument(
+        "--worker-id", type=str, help="Name in the queue, default host:pid"
+    )
+    work_parser.add_argument("--proxy", type=str, help="proxy, http(s)://addr:port")
+    work_parser.add_argument("--cdn-base-url", type=str)
+
+    status_parser = commands.add_parser("status", help="Show the jobs")
+    status_parser.add_argument("queue", type=str, help="Queue file")
+    status_parser.add_argument("--json", action="store_true", help="All jobs as JSON")
+
+    retry_parser = commands.add_parser("retry", help="Queue failed jobs again")
+    retry_parser.add_argument("queue", type=str, help="Queue file")
+    args = arg_parser.parse_args()
+
+    if args.command == "work":
+        if args.processes <= 1:
+            return _work_process(args)
+        # spawn, so no worker inherits another's threads or connections
+        context = multiprocessing.get_context("spawn")
+        processes = [
+            context.Process(target=_work_process, args=(args, i))
+            for i in range(args.processes)
+        ]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            # the workers got the interrupt too and release their jobs
+            for process in processes:
+                process.join()
+        return
+
+    with WorkQueue(args.queue) as queue:
+        if args.command == "enqueue":
+            options = json.loads(args.options)
+            if args.output_fmt:
+                options["output_fmt"] = args.output_fmt
+            unknown = set(options) - JOB_OPTION_FIELDS
+            if unknown:
+                arg_parser.error(f"Unknown options: {', '.join(sorted(unknown))}")
+            added = sum(queue.enqueue(pack.strip(), options) for pack in args.packs)
+            pending = len(args.packs) - added
+            print(f"Queued {added} job(s), {pending} already queued or running")
+        elif args.command == "status":
+            jobs = queue.jobs()
+            if args.json:
+                print(json.dumps([job.to_dict() for job in jobs], indent=2))
+                return
+            now = time.time()
+            for job in jobs:
+                line = f"{job.id:>6} {job.status:<8} {job.pack:<26} {job.attempts}"
+                if job.status == RUNNING:
+                    expired = " (expired)" if job.lease_until < now else ""
+                    line += f" {job.worker}{expired}"
+                elif job.error:
+                    line += f" {job.error}"
+                print(line)
+            counts = queue.counts()
+            print(
+                ", ".join(
+                    f"{counts.get(s, 0)} {s}" for s in (QUEUED, RUNNING, DONE, FAILED)
+                )
+            )
+        elif args.command == "retry":
+            print(f"Queued {queue.retry_failed()} failed job(s) again")
+
+
+if __name__ == "__main__":
+    main()